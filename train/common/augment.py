@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# This file is covered by the LICENSE file in the root of this project.
+
+import math
+
+import torch
+
+
+class BatchAugment:
+    """Augmentations of whole batches of collated range images.
+
+    They run after collate, on the device the batch is on, so they cost the
+    dataloader workers nothing. Each scan of the batch is independently:
+      flip   : mirrored left-right (y -> -y, like LaserScan.flip_sign)
+      roll   : rolled in azimuth by a random number of columns (the scene
+               starts at another yaw, the points are not moved)
+      rotate : rotated around z by a random multiple of the column angle,
+               which is the same roll plus the rotation of x and y
+    with the given probabilities. The input is the normalized [B,5,H,W]
+    range, x, y, z, remission image of the dataset, so img_means and
+    img_stds are needed to move the coordinates.
+    """
+
+    def __init__(self, img_means, img_stds, flip=0.0, roll=0.0, rotate=0.0):
+        self.means = torch.tensor(img_means, dtype=torch.float)
+        self.stds = torch.tensor(img_stds, dtype=torch.float)
+        self.flip = flip
+        self.roll = roll
+        self.rotate = rotate
+
+    def __call__(self, proj, proj_mask, proj_labels):
+        """ Augmented proj [B,5,H,W], proj_mask [B,H,W] and proj_labels [B,H,W]
+            (scans that draw no augmentation are returned untouched)
+        """
+        assert proj.shape[1] == 5
+        B, _, H, W = proj.shape
+        device = proj.device
+
+        flip = torch.rand(B, device=device) < self.flip
+        roll = torch.rand(B, device=device) < self.roll
+        rotate = torch.rand(B, device=device) < self.rotate
+        roll_cols = torch.randint(0, W, (B,), device=device) * roll.long()
+        rotate_cols = torch.randint(0, W, (B,), device=device) * rotate.long()
+        changed = flip | (roll_cols > 0) | (rotate_cols > 0)
+        if not changed.any():
+            return proj, proj_mask, proj_labels
+
+        # column each output column comes from: flipped, then rolled right
+        cols = (torch.arange(W, device=device)[None] -
+                (roll_cols + rotate_cols)[:, None]) % W
+        cols = torch.where(flip[:, None], W - 1 - cols, cols)
+
+        def gather(image):
+            index = cols.to(image.device)
+            index = index.view(B, *([1] * (image.dim() - 2)), W).expand_as(image)
+            return torch.gather(image, -1, index)
+
+        new_proj = gather(proj)
+        new_mask = gather(proj_mask)
+        new_labels = gather(proj_labels)
+
+        # move x and y: mirrored, then rotated by the angle of the rotate
+        # columns (a column further right is a smaller yaw)
+        means = self.means.to(device)[1:3, None, None]
+        stds = self.stds.to(device)[1:3, None, None]
+        xy = new_proj[:, 1:3] * stds + means
+        x = xy[:, 0]
+        y = torch.where(flip[:, None, None], -xy[:, 1], xy[:, 1])
+        angle = -2 * math.pi * rotate_cols.float() / W
+        cos = torch.cos(angle)[:, None, None]
+        sin = torch.sin(angle)[:, None, None]
+        xy = torch.stack([x * cos - y * sin, x * sin + y * cos], dim=1)
+        xy = (xy - means) / stds * new_mask.to(device)[:, None].float()
+        new_proj = torch.cat([new_proj[:, :1], xy, new_proj[:, 3:]], dim=1)
+
+        keep = changed == 0
+        new_proj = torch.where(keep[:, None, None, None], proj, new_proj)
+        new_mask = torch.where(keep.to(proj_mask.device)[:, None, None], proj_mask, new_mask)
+        new_labels = torch.where(keep.to(proj_labels.device)[:, None, None], proj_labels,
+                                 new_labels)
+        return new_proj, new_mask, new_labels
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# This file is covered by the LICENSE file in the root of this project.
+
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+
+from common.manifest import sidecar_file
+
+CLASS_INDEX_NAME = ".class_index.npz"
+
+
+class ClassIndex:
+    """Number of points of each (learning) class in each labelled scan.
+
+    Building it reads every label once; it is then stored as a sidecar of the
+    dataset (root/.class_index.npz, or ~/.cache/mambonet/class_index if the
+    root can't be written). Scans are keyed by their label file (path, mtime
+    and size, stat-ed in parallel by the manifest, or those of the shard plus
+    the frame) and the label map, so only the scans that changed are read
+    again.
+    """
+
+    def __init__(self, root, lut):
+        self.root = os.path.abspath(os.path.expanduser(root))
+        self.filename = sidecar_file(self.root, CLASS_INDEX_NAME, "class_index")
+        self.lut = lut
+        self.n_classes = int(lut.max()) + 1
+        self.lut_hash = hashlib.sha1(np.ascontiguousarray(lut).tobytes()).hexdigest()
+
+    @staticmethod
+    def stamp(path):
+        """ "<mtime>|<size>" of a file (a shard), from its stat """
+        st = os.stat(path)
+        return "{}|{}".format(st.st_mtime_ns, st.st_size)
+
+    @staticmethod
+    def key(path, stamp, frame=None):
+        """ Key of the labels of a scan in a file with stamp (Manifest.stamps
+            or ClassIndex.stamp), and frame for shards
+        """
+        key = "{}|{}".format(os.path.abspath(path), stamp)
+        if frame is not None:
+            key += "|{}".format(frame)
+        return key
+
+    def histogram(self, label):
+        """ [n_classes] points of each class in a raw label array """
+        return np.bincount(self.lut[label & 0xFFFF], minlength=self.n_classes)
+
+    def load(self):
+        try:
+            with np.load(self.filename) as index:
+                if str(index["lut"]) != self.lut_hash:
+                    return {}
+                return dict(zip(index["keys"].tolist(), index["histograms"]))
+        except (OSError, KeyError, ValueError):
+            return {}
+
+    def histograms(self, keys, read_label):
+        """ [len(keys), n_classes] int64 histograms of the scans, read_label(i)
+            returning the raw labels of scan i for the ones not indexed yet
+        """
+        index = self.load()
+        missing = False
+        for i, key in enumerate(keys):
+            if key not in index:
+                index[key] = self.histogram(read_label(i))
+                missing = True
+        if missing:
+            # the other splits of the dataset share the file
+            self.save(index)
+        histograms = np.zeros((len(keys), self.n_classes), dtype=np.int64)
+        for i, key in enumerate(keys):
+            histograms[i] = index[key]
+        return histograms
+
+    def save(self, index):
+        directory = os.path.dirname(self.filename)
+        try:
+            os.makedirs(directory, exist_ok=True)
+            # write and rename, other processes may be reading it
+            fd, tmp = tempfile.mkstemp(dir=directory, suffix=".npz")
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, lut=np.array(self.lut_hash),
+                         keys=np.array(list(index.keys())),
+                         histograms=np.array(list(index.values()), dtype=np.int64))
+            os.chmod(tmp, 0o644)
+            os.replace(tmp, self.filename)
+        except OSError:
+            # not being able to store it only costs reading the labels again
+            pass
@@ -7,12 +7,17 @@ import math
 import random
 from scipy.spatial.transform import Rotation as R
 
+from common.qbin import decode_scan
+
 class LaserScan:
     """Class that contains LaserScan with x,y,z,r"""
-    EXTENSIONS_SCAN = ['.bin']
+    EXTENSIONS_SCAN = ['.bin', '.qbin']
 
-    def __init__(self, project=False, H=64, W=1024, fov_up=3.0, fov_down=-25.0,DA=False,flip_sign=False,rot=False,drop_points=False):
+    def __init__(self, project=False, H=64, W=1024, fov_up=3.0, fov_down=-25.0,DA=False,flip_sign=False,rot=False,drop_points=False,reuse=False,seed=None):
         self.project = project
+        # reuse the projection buffers from scan to scan (overwritten by the
+        # next open, copy what has to be kept) instead of allocating them
+        self.reuse = reuse
         self.proj_H = H
         self.proj_W = W
         self.proj_fov_up = fov_up
@@ -21,41 +26,70 @@ class LaserScan:
         self.flip_sign = flip_sign
         self.rot = rot
         self.drop_points = drop_points
+        # points kept by drop_points (None = all), for the labels of the scan
+        self.keep = None
+        # draws of the augmentations, from numpy's global state unless seeded
+        self.rng = np.random
+        if seed is not None:
+            self.set_seed(seed)
 
         self.reset()
 
+    def set_seed(self, seed):
+        """ Make the following augmentation draws reproducible """
+        self.rng = np.random.RandomState(seed)
+
+    def drop_mask(self, n_points):
+        """ [n_points] bool mask of the points kept when dropping a fraction
+            drop_points of them (drawn with replacement, so a bit less are)
+        """
+        keep = np.ones(n_points, dtype=np.bool_)
+        keep[self.rng.randint(0, n_points - 1, int(n_points * self.drop_points))] = False
+        return keep
+
     def reset(self):
         """ Reset scan members. """
         self.points = np.zeros((0, 3), dtype=np.float32)  # [m, 3]: x, y, z
         self.remissions = np.zeros((0, 1), dtype=np.float32)  # [m ,1]: remission
 
         # projected range image - [H,W] range (-1 is no data)
-        self.proj_range = np.full((self.proj_H, self.proj_W), -1,
-                                  dtype=np.float32)
+        self.proj_range = self.buffer("proj_range", (self.proj_H, self.proj_W), -1,
+                                      dtype=np.float32)
 
         # unprojected range (list of depths for each point)
         self.unproj_range = np.zeros((0, 1), dtype=np.float32)
 
         # projected point cloud xyz - [H,W,3] xyz coord (-1 is no data)
-        self.proj_xyz = np.full((self.proj_H, self.proj_W, 3), -1,
-                                dtype=np.float32)
+        self.proj_xyz = self.buffer("proj_xyz", (self.proj_H, self.proj_W, 3), -1,
+                                    dtype=np.float32)
 
         # projected remission - [H,W] intensity (-1 is no data)
-        self.proj_remission = np.full((self.proj_H, self.proj_W), -1,
-                                      dtype=np.float32)
+        self.proj_remission = self.buffer("proj_remission", (self.proj_H, self.proj_W), -1,
+                                          dtype=np.float32)
 
         # projected index (for each pixel, what I am in the pointcloud)
         # [H,W] index (-1 is no data)
-        self.proj_idx = np.full((self.proj_H, self.proj_W), -1,
-                                dtype=np.int32)
+        self.proj_idx = self.buffer("proj_idx", (self.proj_H, self.proj_W), -1,
+                                    dtype=np.int32)
 
         # for each point, where it is in the range image
         self.proj_x = np.zeros((0, 1), dtype=np.int32)  # [m, 1]: x
         self.proj_y = np.zeros((0, 1), dtype=np.int32)  # [m, 1]: y
 
         # mask containing for each pixel, if it contains a point or not
-        self.proj_mask = np.zeros((self.proj_H, self.proj_W),
-                                  dtype=np.int32)  # [H,W] mask
+        self.proj_mask = self.buffer("proj_mask", (self.proj_H, self.proj_W), 0,
+                                     dtype=np.int32)  # [H,W] mask
+
+    def buffer(self, name, shape, value, dtype):
+        """ Array of shape filled with value: a new one, or the one in
+            attribute name when reusing buffers
+        """
+        array = getattr(self, name, None)
+        if (self.reuse and array is not None and array.shape == shape
+                and array.dtype == dtype):
+            array.fill(value)
+            return array
+        return np.full(shape, value, dtype=dtype)
 
     def size(self):
         """ Return the size of the point cloud. """
@@ -67,8 +101,7 @@ class LaserScan:
     def open_scan(self, filename):
         """ Open raw scan and fill in attributes
         """
-        # reset just in case there was an open structure
-        self.reset()
+        # (set_points resets the open structure)
 
         # check filename is string
         if not isinstance(filename, str):
@@ -86,9 +119,23 @@ class LaserScan:
 # 之後要轉回來，在 save_bins 函式使用
 
         # if all goes well, open pointcloud
-        scan = np.fromfile(filename, dtype=np.float32)
+        # (quantized .qbin scans are decoded to float32 x,y,z,r)
+        scan = decode_scan(filename, np.fromfile(filename, dtype=np.uint8))
+        self.open_scan_array(scan)
+
+    def open_scan_array(self, scan):
+        """ Same as open_scan, but from the raw x,y,z,r array of a scan that
+            was read already (e.g. a slice of a sequence shard)
+        """
         scan = scan.reshape((-1, 4))
 
+        # drop points with a single gather of x,y,z,r (and of the labels, in
+        # open_label_array, with the same mask)
+        self.keep = None
+        if self.drop_points is not False:
+            self.keep = self.drop_mask(len(scan))
+            scan = scan[self.keep]
+
         # scan.shape = (point_sum, 4_feature)
         # print("scan.shape: ",scan.shape)
 
@@ -98,11 +145,6 @@ class LaserScan:
 
         # print("point_x: ",points[0,0])
 
-        if self.drop_points is not False:
-            self.points_to_drop = np.random.randint(0, len(points)-1,int(len(points)*self.drop_points))
-            points = np.delete(points,self.points_to_drop,axis=0)
-            remissions = np.delete(remissions,self.points_to_drop)
-
         self.set_points(points, remissions)
 
 # JLLIU 
@@ -125,7 +167,8 @@ class LaserScan:
         # put in attribute
         self.points = points  # get
         if self.flip_sign:
-            self.points[:, 1] = -self.points[:, 1]
+            # not in place, points may be a view of a memory-mapped shard
+            self.points = self.points * np.array([1, -1, 1], dtype=self.points.dtype)
 
         #if self.DA:
         #    jitter_x = random.uniform(-5,5)
@@ -153,6 +196,75 @@ class LaserScan:
             Function takes no arguments because it can be also called externally
             if the value of the constructor was not set (in case you change your
             mind about wanting the projection)
+
+            Each pixel gets its nearest point, and of points at the same depth
+            (duplicated points) the one with the lowest index, which is what
+            do_range_projection_argsort gives too.
+        """
+        depth, proj_x, proj_y = self.project_points()
+
+        # for each pixel keep the nearest point, without sorting all the points
+        # by depth: scatter all indices (some point wins each pixel), then only
+        # the points nearer than the winner of their pixel are scattered again,
+        # until none is left. Each round is O(N) and the candidates shrink fast,
+        # there are just a few points per pixel
+        pixel = proj_y * self.proj_W + proj_x
+        proj_idx = self.proj_idx.reshape(-1)
+        candidates = np.arange(depth.shape[0], dtype=np.int32)
+        while candidates.size:
+            proj_idx[pixel[candidates]] = candidates
+            winner = proj_idx[pixel[candidates]]
+            d_cand = depth[candidates]
+            d_win = depth[winner]
+            # same depth (duplicated points): the lowest index wins
+            nearer = (d_cand < d_win) | ((d_cand == d_win) & (candidates < winner))
+            candidates = candidates[nearer]
+
+        # assing to images
+        mask = proj_idx >= 0
+        indices = proj_idx[mask]
+        self.proj_range.reshape(-1)[mask] = depth[indices]
+        self.proj_xyz.reshape(-1, 3)[mask] = self.points[indices]
+        self.proj_remission.reshape(-1)[mask] = self.remissions[indices]
+        self.proj_mask = (self.proj_idx > 0).astype(np.int32)
+
+    def do_range_projection_argsort(self):
+        """ Reference do_range_projection, that sorts all the points by depth
+            (O(N log N)). Kept to check and benchmark the sort-free version.
+        """
+        depth, proj_x, proj_y = self.project_points()
+
+        # order in decreasing depth, the stable sort puts the lowest index
+        # last (so it is the one written) among points at the same depth
+        indices = np.arange(depth.shape[0])
+        order = np.argsort(depth, kind="stable")[::-1]
+        depth = depth[order]
+        indices = indices[order]
+        points = self.points[order]
+        remission = self.remissions[order]
+        proj_y = proj_y[order]
+        proj_x = proj_x[order]
+
+        #print("\npoints.shape: ",self.points.shape)
+        #print("yaw.shape: ",yaw.shape)
+        #print("pitch.shape: ",pitch.shape)
+        #print("proj_x.shape: ",proj_x.shape)
+        #print("proj_y.shape: ",proj_y.shape)
+
+        #for doggy in range(0,100):
+            #print("proj_x[%d]: "%doggy, proj_x[doggy])
+            #print("proj_y[%d]: "%doggy, proj_y[doggy])
+
+        # assing to images
+        self.proj_range[proj_y, proj_x] = depth
+        self.proj_xyz[proj_y, proj_x] = points
+        self.proj_remission[proj_y, proj_x] = remission
+        self.proj_idx[proj_y, proj_x] = indices
+        self.proj_mask = (self.proj_idx > 0).astype(np.int32)
+
+    def project_points(self):
+        """ Spherical image coordinates of the points. Fills in proj_x, proj_y
+            and unproj_range, and returns depth, proj_x, proj_y
         """
         # JLLIU x, y, z, i, h, w
         # return_to_bin_table = np.zeros((64, 2048, 7), dtype=np.float32)
@@ -200,32 +312,7 @@ class LaserScan:
         # copy of depth in original order
         self.unproj_range = np.copy(depth)
 
-        # order in decreasing depth
-        indices = np.arange(depth.shape[0])
-        order = np.argsort(depth)[::-1]
-        depth = depth[order]
-        indices = indices[order]
-        points = self.points[order]
-        remission = self.remissions[order]
-        proj_y = proj_y[order]
-        proj_x = proj_x[order]
-
-        #print("\npoints.shape: ",self.points.shape)
-        #print("yaw.shape: ",yaw.shape)
-        #print("pitch.shape: ",pitch.shape)
-        #print("proj_x.shape: ",proj_x.shape)
-        #print("proj_y.shape: ",proj_y.shape)
-
-        #for doggy in range(0,100):
-            #print("proj_x[%d]: "%doggy, proj_x[doggy])
-            #print("proj_y[%d]: "%doggy, proj_y[doggy])
-
-        # assing to images
-        self.proj_range[proj_y, proj_x] = depth
-        self.proj_xyz[proj_y, proj_x] = points
-        self.proj_remission[proj_y, proj_x] = remission
-        self.proj_idx[proj_y, proj_x] = indices
-        self.proj_mask = (self.proj_idx > 0).astype(np.int32)
+        return depth, proj_x, proj_y
 
 #JLLIU: 
 # proj_xyz.shape:  (64, 2048, 3) 可知各個 H,W 對應的 x,y,z 座標都已經存在裡面了！
@@ -236,9 +323,15 @@ class SemLaserScan(LaserScan):
     """Class that contains LaserScan with x,y,z,r,sem_label,sem_color_label,inst_label,inst_color_label"""
     EXTENSIONS_LABEL = ['.label']
 
-    def __init__(self, sem_color_dict=None, project=False, H=64, W=1024, fov_up=3.0, fov_down=-25.0, max_classes=300,DA=False,flip_sign=False,drop_points=False):
-        super(SemLaserScan, self).__init__(project, H, W, fov_up, fov_down,DA=DA,flip_sign=flip_sign,drop_points=drop_points)
-        self.reset()
+    def __init__(self, sem_color_dict=None, project=False, H=64, W=1024, fov_up=3.0, fov_down=-25.0, max_classes=300,DA=False,flip_sign=False,drop_points=False,reuse=False,training=False,check_labels=True,seed=None):
+        # training mode only projects the semantic labels, the colors and the
+        # instances are projected the first time they are used
+        self.training = training
+        # check that the labels split in semantics and instances back and forth
+        self.check_labels = check_labels
+
+        # (the parent constructor resets the semantic members too)
+        super(SemLaserScan, self).__init__(project, H, W, fov_up, fov_down,DA=DA,flip_sign=flip_sign,drop_points=drop_points,reuse=reuse,seed=seed)
 
         # make semantic colors
         if sem_color_dict:
@@ -259,13 +352,20 @@ class SemLaserScan(LaserScan):
             # force zero to a gray-ish color
             self.sem_color_lut[0] = np.full((3), 0.1)
 
-        # make instance colors
-        max_inst_id = 100000
-        self.inst_color_lut = np.random.uniform(low=0.0,
-                                                high=1.0,
-                                                size=(max_inst_id, 3))
-        # force zero to a gray-ish color
-        self.inst_color_lut[0] = np.full((3), 0.1)
+        # instance colors are made the first time they are used
+        self._inst_color_lut = None
+
+    @property
+    def inst_color_lut(self):
+        if self._inst_color_lut is None:
+            # make instance colors
+            max_inst_id = 100000
+            self._inst_color_lut = np.random.uniform(low=0.0,
+                                                     high=1.0,
+                                                     size=(max_inst_id, 3))
+            # force zero to a gray-ish color
+            self._inst_color_lut[0] = np.full((3), 0.1)
+        return self._inst_color_lut
 
     def reset(self):
         """ Reset scan members. """
@@ -279,17 +379,14 @@ class SemLaserScan(LaserScan):
         self.inst_label = np.zeros((0, 1), dtype=np.int32)  # [m, 1]: label
         self.inst_label_color = np.zeros((0, 3), dtype=np.float32)  # [m ,3]: color
 
-        # projection color with semantic labels
-        self.proj_sem_label = np.zeros((self.proj_H, self.proj_W),
-                                       dtype=np.int32)  # [H,W]  label
-        self.proj_sem_color = np.zeros((self.proj_H, self.proj_W, 3),
-                                       dtype=np.float)  # [H,W,3] color
+        # projection with semantic labels
+        self.proj_sem_label = self.buffer("proj_sem_label", (self.proj_H, self.proj_W), 0,
+                                          dtype=np.int32)  # [H,W]  label
 
-        # projection color with instance labels
-        self.proj_inst_label = np.zeros((self.proj_H, self.proj_W),
-                                        dtype=np.int32)  # [H,W]  label
-        self.proj_inst_color = np.zeros((self.proj_H, self.proj_W, 3),
-                                        dtype=np.float)  # [H,W,3] color
+        # projection color with semantic labels, and projection with instance
+        # labels and colors: made by do_color_projection when first used
+        self.projected_labels = None
+        self.color_projected = False
 
     def open_label(self, filename):
         """ Open raw scan and fill in attributes
@@ -305,10 +402,16 @@ class SemLaserScan(LaserScan):
 
         # if all goes well, open label
         label = np.fromfile(filename, dtype=np.int32)
+        self.open_label_array(label)
+
+    def open_label_array(self, label):
+        """ Same as open_label, but from the raw label array of a scan that
+            was read already (e.g. a slice of a sequence shard)
+        """
         label = label.reshape((-1))
 
-        if self.drop_points is not False:
-            label = np.delete(label,self.points_to_drop)
+        if self.keep is not None:
+            label = label[self.keep]
         # set it
         self.set_label(label)
 
@@ -329,7 +432,8 @@ class SemLaserScan(LaserScan):
             raise ValueError("Scan and Label don't contain same number of points")
 
         # sanity check
-        assert ((self.sem_label + (self.inst_label << 16) == label).all())
+        if self.check_labels:
+            assert ((self.sem_label + (self.inst_label << 16) == label).all())
 
         if self.project:
             self.do_label_projection()
@@ -349,8 +453,51 @@ class SemLaserScan(LaserScan):
 
         # semantics
         self.proj_sem_label[mask] = self.sem_label[self.proj_idx[mask]]
-        self.proj_sem_color[mask] = self.sem_color_lut[self.sem_label[self.proj_idx[mask]]]
+
+        # colors and instances now, or when used (in training mode). Keep the
+        # labels, as the caller may map sem_label to other values meanwhile
+        self.projected_labels = (self.sem_label, self.inst_label)
+        self.color_projected = False
+        if not self.training:
+            self.do_color_projection()
+
+    def do_color_projection(self):
+        """ Fill in proj_sem_color, proj_inst_label and proj_inst_color from
+            the projected labels (empty if no labels were projected)
+        """
+        self._proj_sem_color = self.buffer("_proj_sem_color", (self.proj_H, self.proj_W, 3), 0,
+                                           dtype=np.float)  # [H,W,3] color
+        self._proj_inst_label = self.buffer("_proj_inst_label", (self.proj_H, self.proj_W), 0,
+                                            dtype=np.int32)  # [H,W]  label
+        self._proj_inst_color = self.buffer("_proj_inst_color", (self.proj_H, self.proj_W, 3), 0,
+                                            dtype=np.float)  # [H,W,3] color
+        self.color_projected = True
+        if self.projected_labels is None:
+            return
+        sem_label, inst_label = self.projected_labels
+        mask = self.proj_idx >= 0
+
+        # semantics
+        self._proj_sem_color[mask] = self.sem_color_lut[sem_label[self.proj_idx[mask]]]
 
         # instances
-        self.proj_inst_label[mask] = self.inst_label[self.proj_idx[mask]]
-        self.proj_inst_color[mask] = self.inst_color_lut[self.inst_label[self.proj_idx[mask]]]
+        self._proj_inst_label[mask] = inst_label[self.proj_idx[mask]]
+        self._proj_inst_color[mask] = self.inst_color_lut[inst_label[self.proj_idx[mask]]]
+
+    @property
+    def proj_sem_color(self):
+        if not self.color_projected:
+            self.do_color_projection()
+        return self._proj_sem_color
+
+    @property
+    def proj_inst_label(self):
+        if not self.color_projected:
+            self.do_color_projection()
+        return self._proj_inst_label
+
+    @property
+    def proj_inst_color(self):
+        if not self.color_projected:
+            self.do_color_projection()
+        return self._proj_inst_color
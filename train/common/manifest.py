@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# This file is covered by the LICENSE file in the root of this project.
+
+import hashlib
+import json
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from common.qbin import point_count, QBIN_EXTENSION
+
+MANIFEST_NAME = ".manifest.json"
+MANIFEST_VERSION = 1
+
+# files stat-ed at once when listing a folder (stat is all latency on
+# network filesystems)
+STAT_THREADS = 16
+
+
+def sidecar_file(root, name, cache):
+    """ File name in the dataset root, or in ~/.cache/mambonet/<cache> (named
+        after the root) if the root can't be written
+    """
+    if os.access(root, os.W_OK):
+        return os.path.join(root, name)
+    digest = hashlib.sha1(root.encode()).hexdigest()
+    return os.path.join(os.path.expanduser(os.path.join("~/.cache/mambonet", cache)),
+                        digest + os.path.splitext(name)[1])
+
+
+class Manifest:
+    """Cached listing of the sequences of a dataset root.
+
+    For each sequences/XX/<folder> (velodyne, labels, predictions...) it keeps
+    the sorted file names and sizes, so listing a split is a couple of stats
+    per sequence instead of walking thousands of files. A folder is listed
+    again only when its mtime changed (files added, removed or renamed).
+    The manifest is stored in the root, or in ~/.cache/mambonet/manifest if
+    the root can't be written, by save() once the listing is done.
+    """
+
+    def __init__(self, root):
+        self.root = os.path.abspath(os.path.expanduser(root))
+        self.filename = sidecar_file(self.root, MANIFEST_NAME, "manifest")
+        self.folders = {}
+        self.changed = False
+        try:
+            with open(self.filename, "r") as f:
+                manifest = json.load(f)
+            if manifest.get("version") == MANIFEST_VERSION and manifest.get("root") == self.root:
+                self.folders = manifest["folders"]
+        except (OSError, ValueError):
+            pass
+
+    def folder(self, sequence, folder):
+        """ Entry {"mtime", "names", "sizes"} of root/sequences/XX/folder,
+            listed again if the folder changed (None if it doesn't exist)
+        """
+        sequence = '{0:02d}'.format(int(sequence))
+        path = os.path.join(self.root, "sequences", sequence, folder)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+        key = sequence + "/" + folder
+        entry = self.folders.get(key)
+        if entry is None or entry["mtime"] != mtime:
+            entries = sorted((e for e in os.scandir(path) if e.is_file()),
+                             key=lambda e: e.name)
+            with ThreadPoolExecutor(STAT_THREADS) as pool:
+                sizes = list(pool.map(lambda e: e.stat().st_size, entries))
+            entry = {"mtime": mtime,
+                     "names": [e.name for e in entries],
+                     "sizes": sizes}
+            self.folders[key] = entry
+            self.changed = True
+        return entry
+
+    def files(self, sequence, folder, extension):
+        """ Sorted paths of the files with extension (or any of a tuple of
+            them) in sequences/XX/folder
+        """
+        entry = self.folder(sequence, folder)
+        if entry is None:
+            return []
+        path = os.path.join(self.root, "sequences", '{0:02d}'.format(int(sequence)), folder)
+        return [os.path.join(path, name) for name in entry["names"]
+                if name.endswith(extension)]
+
+    def stamps(self, sequence, folder, extension):
+        """ "<mtime>|<size>" of each file of files(), stat-ed again (a file
+            rewritten in place doesn't change the folder), STAT_THREADS at once
+        """
+        def stamp(path):
+            st = os.stat(path)
+            return "{}|{}".format(st.st_mtime_ns, st.st_size)
+
+        files = self.files(sequence, folder, extension)
+        with ThreadPoolExecutor(STAT_THREADS) as pool:
+            return list(pool.map(stamp, files))
+
+    def scans(self, sequence):
+        return self.files(sequence, "velodyne", (".bin", QBIN_EXTENSION))
+
+    def labels(self, sequence, folder="labels"):
+        return self.files(sequence, folder, ".label")
+
+    def frames(self, sequence):
+        """ Frame ids ("000123") of the scans of a sequence """
+        return [os.path.splitext(os.path.basename(f))[0] for f in self.scans(sequence)]
+
+    def point_counts(self, sequence):
+        """ Number of points of each scan (from the file sizes) """
+        entry = self.folder(sequence, "velodyne")
+        if entry is None:
+            return []
+        return [point_count(name, size) for name, size in zip(entry["names"], entry["sizes"])
+                if name.endswith((".bin", QBIN_EXTENSION))]
+
+    def save(self):
+        """ Store the manifest, if any folder was listed again """
+        if not self.changed:
+            return
+        self.changed = False
+        directory = os.path.dirname(self.filename)
+        try:
+            os.makedirs(directory, exist_ok=True)
+            # write and rename, other processes may be reading it
+            fd, tmp = tempfile.mkstemp(dir=directory, suffix=".tmp")
+            with os.fdopen(fd, "w") as f:
+                json.dump({"version": MANIFEST_VERSION,
+                           "root": self.root,
+                           "folders": self.folders}, f)
+            # readable by everybody using the dataset, as the scans are
+            os.chmod(tmp, 0o644)
+            os.replace(tmp, self.filename)
+        except OSError:
+            # not being able to store it only costs listing the folder again
+            pass
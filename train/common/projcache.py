@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# This file is covered by the LICENSE file in the root of this project.
+
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+
+class ProjectionCache:
+    """On-disk store of projected scans that is memory-mapped on read.
+
+    Each entry is a single file: a magic, a small json header describing the
+    arrays (dtype, shape, offset) and then the raw array bytes, each aligned
+    to 64 bytes. Entries are keyed by the source file paths, their mtime and
+    size, and a config blob (sensor, label maps...), so changing any of those
+    just produces a new key and stale entries are never read again.
+    """
+    MAGIC = b"MBPC"
+    ALIGN = 64
+
+    def __init__(self, directory, config=None):
+        self.directory = os.path.expanduser(directory)
+        os.makedirs(self.directory, exist_ok=True)
+        self.config = json.dumps(config, sort_keys=True, default=str)
+
+    def key(self, *paths, frame=None):
+        """ Key for the projection of the given source files (and frame,
+            when the files hold more than one scan, like sequence shards).
+        """
+        h = hashlib.sha1(self.config.encode())
+        if frame is not None:
+            h.update("frame|{}".format(frame).encode())
+        for path in paths:
+            st = os.stat(path)
+            h.update("{}|{}|{}".format(os.path.abspath(path),
+                                       st.st_mtime_ns,
+                                       st.st_size).encode())
+        return h.hexdigest()
+
+    def path(self, key):
+        # fan out in subfolders so no folder holds all the scans of a split
+        return os.path.join(self.directory, key[:2], key + ".npc")
+
+    def get(self, key):
+        """ Return dict of arrays mapped from disk, or None if not cached.
+            The arrays are copy-on-write views of the page cache, so reading
+            does not copy and writing to them never touches the file.
+        """
+        try:
+            data = np.memmap(self.path(key), dtype=np.uint8, mode="c")
+        except (FileNotFoundError, ValueError):
+            return None
+        if bytes(data[:4]) != self.MAGIC:
+            return None
+        header_len = int(data[4:8].view("<u4")[0])
+        header = json.loads(bytes(data[8:8 + header_len]).decode())
+        base = self._align(8 + header_len)
+        arrays = {}
+        for name, (dtype, shape, offset) in header.items():
+            dtype = np.dtype(dtype)
+            start = base + offset
+            stop = start + int(np.prod(shape)) * dtype.itemsize
+            arrays[name] = data[start:stop].view(dtype).reshape(shape)
+        return arrays
+
+    def put(self, key, arrays):
+        """ Store dict of numpy arrays under key (atomic, last writer wins). """
+        layout = {}
+        offset = 0
+        for name, array in arrays.items():
+            layout[name] = [array.dtype.str, list(array.shape), offset]
+            offset = self._align(offset + array.nbytes)
+        header = json.dumps(layout).encode()
+        base = self._align(8 + len(header))
+
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write next to the final file and rename, so that concurrent readers
+        # (other dataloader workers) never see a half written entry
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(self.MAGIC)
+                f.write(np.array([len(header)], dtype="<u4").tobytes())
+                f.write(header)
+                for name, array in arrays.items():
+                    f.seek(base + layout[name][2])
+                    f.write(np.ascontiguousarray(array).tobytes())
+                f.truncate(base + offset)
+            os.replace(tmp, path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    def _align(self, n):
+        return (n + self.ALIGN - 1) // self.ALIGN * self.ALIGN
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# This file is covered by the LICENSE file in the root of this project.
+
+import os
+
+import numpy as np
+
+# Quantized scan layout (little endian), 7 bytes per point instead of 16:
+#   header    : magic, version, n_points, scale (16 bytes)
+#   xyz       : int16[n_points, 3]  coordinates / scale, rounded
+#   remission : uint8[n_points]     remission * 255, rounded
+# The scale is the finest that fits the farthest coordinate of the scan in
+# int16, but never under QBIN_MIN_SCALE (1 mm): a scan within 32.7 m is
+# stored at millimetres, one up to 80 m at about 2.5 mm.
+QBIN_MAGIC = b"MBQB"
+QBIN_VERSION = 1
+QBIN_EXTENSION = ".qbin"
+QBIN_MIN_SCALE = 0.001
+_HEADER_DTYPE = np.dtype([("magic", "S4"), ("version", "<u4"),
+                          ("n_points", "<u4"), ("scale", "<f4")])
+_INT16_MAX = np.iinfo(np.int16).max
+
+
+def encode(scan):
+    """ Bytes of the quantized [n, 4] float32 x, y, z, remission scan """
+    scan = scan.reshape((-1, 4))
+    extent = float(np.abs(scan[:, 0:3]).max()) if len(scan) else 0.0
+    # float32 scale, rounded up so the extent still fits after rounding
+    scale = np.float32(max(extent / _INT16_MAX, QBIN_MIN_SCALE))
+    while extent / scale > _INT16_MAX:
+        scale = np.nextafter(scale, np.float32(np.inf))
+    header = np.zeros(1, dtype=_HEADER_DTYPE)
+    header["magic"] = QBIN_MAGIC
+    header["version"] = QBIN_VERSION
+    header["n_points"] = len(scan)
+    header["scale"] = scale
+    xyz = np.rint(scan[:, 0:3] / scale).astype("<i2")
+    remission = np.rint(np.clip(scan[:, 3], 0, 1) * 255).astype(np.uint8)
+    return header.tobytes() + xyz.tobytes() + remission.tobytes()
+
+
+def decode(data):
+    """ [n, 4] float32 x, y, z, remission scan from the uint8 bytes of a
+        quantized one (read as views, converted in one pass each)
+    """
+    header = data[:_HEADER_DTYPE.itemsize].view(_HEADER_DTYPE)[0]
+    if header["magic"] != QBIN_MAGIC:
+        raise RuntimeError("Not a quantized scan")
+    if header["version"] != QBIN_VERSION:
+        raise RuntimeError("Unsupported quantized scan version {}".format(header["version"]))
+    n_points = int(header["n_points"])
+    xyz_at = _HEADER_DTYPE.itemsize
+    remission_at = xyz_at + 6 * n_points
+    xyz = data[xyz_at:remission_at].view("<i2").reshape((n_points, 3))
+    remission = data[remission_at:remission_at + n_points]
+
+    scan = np.empty((n_points, 4), dtype=np.float32)
+    np.multiply(xyz, header["scale"], out=scan[:, 0:3], casting="unsafe")
+    np.multiply(remission, np.float32(1 / 255), out=scan[:, 3], casting="unsafe")
+    return scan
+
+
+def decode_scan(filename, data):
+    """ [n, 4] float32 scan from the uint8 bytes of a .bin or .qbin file """
+    if filename.endswith(QBIN_EXTENSION):
+        return decode(data)
+    return data.view(np.float32).reshape((-1, 4))
+
+
+def point_count(filename, size):
+    """ Number of points of a .bin or .qbin scan of size bytes """
+    if filename.endswith(QBIN_EXTENSION):
+        return (size - _HEADER_DTYPE.itemsize) // 7
+    return size // 16
+
+
+def quantize_file(scan_file, out_file):
+    """ Write the quantized copy of a .bin scan, return (original, decoded) """
+    scan = np.fromfile(scan_file, dtype=np.float32).reshape((-1, 4))
+    data = encode(scan)
+    tmp = out_file + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, out_file)
+    return scan, decode(np.frombuffer(data, dtype=np.uint8))
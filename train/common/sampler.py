@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# This file is covered by the LICENSE file in the root of this project.
+
+import numpy as np
+import torch
+from torch.utils.data import Sampler, WeightedRandomSampler
+
+
+def rare_class_weights(histograms, classes, weight, min_points=1):
+    """ Sampling weight of each scan: weight if it has at least min_points of
+        any of the classes, 1 otherwise
+    """
+    rare = (histograms[:, list(classes)] >= min_points).any(axis=1)
+    return np.where(rare, float(weight), 1.0)
+
+
+def rare_class_sampler(histograms, classes, weight, min_points=1):
+    """ Epoch of len(histograms) scans drawn (with replacement) with the scans
+        having rare classes weight times more likely
+    """
+    weights = rare_class_weights(histograms, classes, weight, min_points)
+    return WeightedRandomSampler(torch.from_numpy(weights), len(weights))
+
+
+class BlockShuffleSampler(Sampler):
+    """Shuffle of contiguous blocks of frames, for locality of the reads.
+
+    The frames of each group (sequence) are cut in blocks of block_size
+    consecutive frames, starting at a random offset each epoch so the blocks
+    change, and the order of all the blocks is shuffled. Frames are read in
+    order inside a block, so the storage read-ahead keeps working, and a
+    block_size of 1 is a plain shuffle.
+    """
+
+    def __init__(self, groups, block_size):
+        self.groups = list(groups)
+        self.block_size = max(int(block_size), 1)
+
+    def blocks(self):
+        blocks = []
+        start = 0
+        for end in range(1, len(self.groups) + 1):
+            if end < len(self.groups) and self.groups[end] == self.groups[start]:
+                continue
+            # group is [start, end)
+            first = start + np.random.randint(self.block_size) - self.block_size + 1
+            for block in range(first, end, self.block_size):
+                blocks.append(range(max(block, start), min(block + self.block_size, end)))
+            start = end
+        return blocks
+
+    def __iter__(self):
+        blocks = self.blocks()
+        return (i for b in np.random.permutation(len(blocks)) for i in blocks[b])
+
+    def __len__(self):
+        return len(self.groups)
+
+
+class BucketBatchSampler(Sampler):
+    """Batches of scans of similar size.
+
+    Each epoch the scans are shuffled (if asked), cut in pools of pool_batches
+    batches, and each pool is sorted by number of points before being split in
+    batches, so that padding to the largest scan of the batch wastes little.
+    The order of the batches is then shuffled again. Without shuffling, the
+    whole split is sorted by size. The scans of an epoch can also be drawn by
+    another sampler (e.g. rare_class_sampler) instead of being a permutation.
+    """
+
+    def __init__(self, sizes, batch_size, drop_last=False, shuffle=True,
+                 pool_batches=50, sampler=None):
+        self.sizes = np.asarray(sizes)
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+        self.shuffle = shuffle
+        self.pool_batches = pool_batches
+        self.sampler = sampler
+
+    def __iter__(self):
+        if self.sampler is not None:
+            indices = np.fromiter(iter(self.sampler), dtype=np.int64)
+            pool = self.pool_batches * self.batch_size
+        elif self.shuffle:
+            indices = np.random.permutation(len(self.sizes))
+            pool = self.pool_batches * self.batch_size
+        else:
+            indices = np.arange(len(self.sizes))
+            pool = len(indices)
+        if self.drop_last:
+            indices = indices[:len(indices) // self.batch_size * self.batch_size]
+
+        batches = []
+        for start in range(0, len(indices), max(pool, 1)):
+            chunk = indices[start:start + pool]
+            chunk = chunk[np.argsort(self.sizes[chunk], kind="stable")]
+            batches.extend(chunk[i:i + self.batch_size].tolist()
+                           for i in range(0, len(chunk), self.batch_size))
+        if self.shuffle:
+            batches = [batches[i] for i in np.random.permutation(len(batches))]
+        return iter(batches)
+
+    def __len__(self):
+        n_scans = len(self.sizes) if self.sampler is None else len(self.sampler)
+        if self.drop_last:
+            return n_scans // self.batch_size
+        return (n_scans + self.batch_size - 1) // self.batch_size
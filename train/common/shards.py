@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+# This file is covered by the LICENSE file in the root of this project.
+
+import os
+
+import numpy as np
+
+from common.qbin import decode_scan, point_count
+
+# Shard layout (little endian), one file per sequence:
+#   header  : magic, version, n_frames, n_points, has_labels (64 bytes)
+#   names   : S32[n_frames]     frame names without extension ("000123")
+#   offsets : int64[n_frames+1] first point of each frame, CSR style
+#   points  : float32[n_points, 4] x, y, z, remission (64 byte aligned)
+#   labels  : int32[n_points]   raw semantic + instance labels (optional)
+SHARD_MAGIC = b"MBSH"
+SHARD_VERSION = 1
+SHARD_EXTENSION = ".shard"
+_HEADER_DTYPE = np.dtype([("magic", "S4"), ("version", "<u4"),
+                          ("n_frames", "<u8"), ("n_points", "<u8"),
+                          ("has_labels", "<u4"), ("pad", "V36")])
+_ALIGN = 64
+
+
+def _align(n):
+    return (n + _ALIGN - 1) // _ALIGN * _ALIGN
+
+
+def _layout(n_frames, n_points):
+    names = _HEADER_DTYPE.itemsize
+    offsets = names + 32 * n_frames
+    points = _align(offsets + 8 * (n_frames + 1))
+    labels = points + 16 * n_points
+    return names, offsets, points, labels
+
+
+def pack_sequence(scan_files, label_files, out_file):
+    """ Pack the scans (and labels, if any) of one sequence in a shard file.
+        scan_files and label_files must be sorted in the same frame order.
+        Scans can be .bin or quantized .qbin, the shard stores the decoded
+        float32 points either way.
+    """
+    if label_files and len(label_files) != len(scan_files):
+        raise ValueError("Scans and labels don't contain the same frames")
+
+    # point counts come from the file sizes, so nothing is read twice
+    counts = np.array([point_count(f, os.path.getsize(f)) for f in scan_files],
+                      dtype=np.int64)
+    offsets = np.zeros(len(scan_files) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    names = np.array([os.path.splitext(os.path.basename(f))[0]
+                      for f in scan_files], dtype="S32")
+    if len(set(names)) != len(names):
+        raise ValueError("Some frames have more than one scan file (.bin and .qbin?)")
+
+    header = np.zeros(1, dtype=_HEADER_DTYPE)
+    header["magic"] = SHARD_MAGIC
+    header["version"] = SHARD_VERSION
+    header["n_frames"] = len(scan_files)
+    header["n_points"] = offsets[-1]
+    header["has_labels"] = int(bool(label_files))
+    _, _, points_at, labels_at = _layout(len(scan_files), int(offsets[-1]))
+
+    tmp = out_file + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(header.tobytes())
+        f.write(names.tobytes())
+        f.write(offsets.astype("<i8").tobytes())
+        f.seek(points_at)
+        for scan_file, n in zip(scan_files, counts):
+            data = np.fromfile(scan_file, dtype=np.uint8)
+            try:
+                scan = decode_scan(scan_file, data)
+            except ValueError:
+                scan = None
+            if scan is None or scan.shape[0] != n:
+                raise ValueError("Truncated scan {}".format(scan_file))
+            f.write(scan.tobytes())
+        if label_files:
+            f.seek(labels_at)
+            for label_file, scan_file, n in zip(label_files, scan_files, counts):
+                label = np.fromfile(label_file, dtype=np.int32)
+                if label.size != n:
+                    raise ValueError("Scan {} and label {} don't contain same "
+                                     "number of points".format(scan_file, label_file))
+                f.write(label.tobytes())
+    os.replace(tmp, out_file)
+    return len(scan_files), int(offsets[-1])
+
+
+class SequenceShard:
+    """Read-only view of a packed sequence.
+
+    Only the index is read when constructed; the point and label blocks are
+    memory-mapped the first time a frame is requested, which happens inside
+    each dataloader worker, so no per-frame file is ever opened.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, "rb") as f:
+            header = np.frombuffer(f.read(_HEADER_DTYPE.itemsize),
+                                   dtype=_HEADER_DTYPE)[0]
+            if header["magic"] != SHARD_MAGIC:
+                raise RuntimeError("{} is not a scan shard".format(filename))
+            if header["version"] != SHARD_VERSION:
+                raise RuntimeError("Unsupported shard version {}".format(header["version"]))
+            self.n_frames = int(header["n_frames"])
+            self.n_points = int(header["n_points"])
+            self.has_labels = bool(header["has_labels"])
+            self.names = [n.decode() for n in
+                          np.frombuffer(f.read(32 * self.n_frames), dtype="S32")]
+            self.offsets = np.frombuffer(f.read(8 * (self.n_frames + 1)),
+                                         dtype="<i8").astype(np.int64)
+        self._points = None
+        self._labels = None
+
+    def __len__(self):
+        return self.n_frames
+
+    def __repr__(self):
+        return "SequenceShard({})".format(self.filename)
+
+    def __getstate__(self):
+        # never pickle the mappings to the workers, they map the file again
+        state = self.__dict__.copy()
+        state["_points"] = None
+        state["_labels"] = None
+        return state
+
+    def _map(self):
+        _, _, points_at, labels_at = _layout(self.n_frames, self.n_points)
+        # read-only, frames are views of the page cache and must not be
+        # modified in place (LaserScan never does)
+        self._points = np.memmap(self.filename, dtype=np.float32, mode="r",
+                                 offset=points_at, shape=(self.n_points, 4))
+        if self.has_labels:
+            self._labels = np.memmap(self.filename, dtype=np.int32, mode="r",
+                                     offset=labels_at, shape=(self.n_points,))
+
+    def scan(self, index):
+        """ [n, 4] float32 x, y, z, remission of a frame (a view, no copy) """
+        if self._points is None:
+            self._map()
+        return np.asarray(self._points[self.offsets[index]:self.offsets[index + 1]])
+
+    def label(self, index):
+        """ [n] int32 raw label of a frame (a view, no copy) """
+        if not self.has_labels:
+            raise RuntimeError("{} contains no labels".format(self.filename))
+        if self._points is None:
+            self._map()
+        return np.asarray(self._labels[self.offsets[index]:self.offsets[index + 1]])
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+# This file is covered by the LICENSE file in the root of this project.
+
+import hashlib
+import os
+import queue
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+
+class Staging:
+    """Local copy (e.g. in /dev/shm) of the files of a dataset on slow storage.
+
+    The first read of a file goes to the dataset and leaves a copy under
+    directory/<root id>/sequences/XX/..., the next ones read the copy as long
+    as it has the size and mtime of the dataset file (a changed file is read
+    and staged again). The copies stay under budget bytes: to make room the
+    files of the least recently used sequences are evicted (their folder
+    mtime, touched on use, so all the dataloader workers sharing the directory
+    agree), file by file, so a worker reading one keeps its open copy. The
+    files that follow the one read can be staged ahead by a background thread.
+    """
+
+    # seconds between two touches of the folder of a sequence in use, and
+    # between two evictions (they walk the staged files)
+    TOUCH_EVERY = 5.0
+
+    def __init__(self, root, directory, budget, prefetch=8):
+        self.root = os.path.abspath(os.path.expanduser(root))
+        digest = hashlib.sha1(self.root.encode()).hexdigest()[:12]
+        self.directory = os.path.join(os.path.expanduser(directory), digest)
+        self.budget = budget
+        self.prefetch = prefetch
+        self.used = None
+        self.evicted = 0
+        self.touched = {}
+        self.lock = threading.Lock()
+        self.queue = None
+        self.queued = set()
+
+    def __getstate__(self):
+        # each worker starts its own prefetch thread
+        state = self.__dict__.copy()
+        state["lock"] = None
+        state["queue"] = None
+        state["queued"] = set()
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def local(self, path):
+        return os.path.join(self.directory, os.path.relpath(os.path.abspath(path), self.root))
+
+    def sequence(self, local):
+        """ Folder of the sequence of a staged file """
+        return os.path.dirname(os.path.dirname(local))
+
+    def fromfile(self, path, dtype, following=()):
+        """ np.fromfile(path, dtype), from the staged copy if there is an up
+            to date one (it is made otherwise), queueing the following files
+            to be staged
+        """
+        local = self.local(path)
+        source = os.stat(path)
+        data = None
+        if self.fresh(local, source):
+            try:
+                data = np.fromfile(local, dtype=dtype)
+            except (FileNotFoundError, ValueError):
+                pass
+        if data is None:
+            data = np.fromfile(path, dtype=dtype)
+            self.stage(local, data, source)
+        self.touch(self.sequence(local))
+        for path in following:
+            self.enqueue(path)
+        return data
+
+    def fresh(self, local, source):
+        """ Whether the staged copy local is there with the size and mtime of
+            the dataset file (its os.stat source). A stale copy is removed.
+        """
+        try:
+            copy = os.stat(local)
+        except OSError:
+            return False
+        if copy.st_size == source.st_size and copy.st_mtime_ns == source.st_mtime_ns:
+            return True
+        self.remove(local, copy.st_size)
+        return False
+
+    def remove(self, local, size):
+        """ Remove a staged copy, counting it off what is used if it was still
+            there (no other worker or thread removed it first)
+        """
+        try:
+            os.remove(local)
+        except OSError:
+            return
+        with self.lock:
+            if self.used is not None:
+                self.used -= size
+
+    def stage(self, local, data, source):
+        """ Store the bytes of a file that was just read (with the mtime of
+            its os.stat source), if they fit in the budget (once the least
+            recently used sequences are evicted)
+        """
+        with self.lock:
+            if self.used is None:
+                self.used = self.usage()
+            fits = self.used + data.nbytes <= self.budget
+        if not fits and time.time() - self.evicted > self.TOUCH_EVERY:
+            self.evict(keep=self.sequence(local), room=data.nbytes)
+            with self.lock:
+                fits = self.used + data.nbytes <= self.budget
+        if not fits:
+            return
+        try:
+            os.makedirs(os.path.dirname(local), exist_ok=True)
+            # write and link, so the copy is published whole and once: when the
+            # prefetch thread or another worker staged it first, the link fails
+            # and only their copy is counted
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(local), suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(data.tobytes())
+                os.utime(tmp, ns=(source.st_atime_ns, source.st_mtime_ns))
+                os.link(tmp, local)
+            finally:
+                os.remove(tmp)
+        except OSError:
+            # staged meanwhile, out of space (or gone): the dataset is read directly
+            return
+        with self.lock:
+            self.used += data.nbytes
+
+    def touch(self, sequence):
+        now = time.time()
+        if now - self.touched.get(sequence, 0) > self.TOUCH_EVERY:
+            self.touched[sequence] = now
+            try:
+                os.utime(sequence)
+            except OSError:
+                pass
+
+    def sequences(self):
+        """ (mtime, bytes, folder, [(file, bytes)]) of the staged sequences
+            (but the files being written)
+        """
+        folder = os.path.join(self.directory, "sequences")
+        try:
+            entries = list(os.scandir(folder))
+        except FileNotFoundError:
+            return []
+        sequences = []
+        for entry in entries:
+            staged = []
+            for root, _, files in os.walk(entry.path):
+                for name in sorted(files):
+                    if name.endswith(".tmp"):
+                        continue
+                    local = os.path.join(root, name)
+                    try:
+                        staged.append((local, os.path.getsize(local)))
+                    except OSError:
+                        pass
+            size = sum(size for _, size in staged)
+            try:
+                sequences.append((entry.stat().st_mtime, size, entry.path, staged))
+            except OSError:
+                pass
+        return sequences
+
+    def usage(self):
+        return sum(size for _, size, _, _ in self.sequences())
+
+    def evict(self, keep, room=0):
+        """ Remove the files of the least recently used sequences (but keep)
+            until room more bytes fit in the budget. The usage is measured
+            again, as the other workers stage and evict too. Files are removed
+            one by one (not the folders), a worker reading one of them keeps
+            reading its open copy and the next read goes to the dataset.
+        """
+        self.evicted = time.time()
+        sequences = sorted(self.sequences(), key=lambda sequence: sequence[0])
+        used = sum(size for _, size, _, _ in sequences)
+        for _, _, folder, staged in sequences:
+            if used + room <= self.budget:
+                break
+            if folder == keep:
+                continue
+            for local, size in staged:
+                if used + room <= self.budget:
+                    break
+                try:
+                    os.remove(local)
+                except OSError:
+                    continue
+                used -= size
+        with self.lock:
+            self.used = used
+
+    def enqueue(self, path):
+        with self.lock:
+            if self.queue is None:
+                self.queue = queue.Queue()
+                threading.Thread(target=self.prefetcher, daemon=True).start()
+            if path in self.queued:
+                return
+            self.queued.add(path)
+        self.queue.put(path)
+
+    def prefetcher(self):
+        while True:
+            path = self.queue.get()
+            local = self.local(path)
+            try:
+                source = os.stat(path)
+                if not self.fresh(local, source):
+                    self.stage(local, np.fromfile(path, dtype=np.uint8), source)
+            except (OSError, ValueError):
+                pass
+            with self.lock:
+                self.queued.discard(path)
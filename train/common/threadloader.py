@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# This file is covered by the LICENSE file in the root of this project.
+
+import collections
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ThreadLoader:
+    """In-process alternative to a DataLoader with worker processes.
+
+    The samples of each batch are loaded by a pool of threads of this process
+    (reading, trigonometry and fancy indexing in numpy release the GIL), so
+    there are no extra copies of python, numpy and torch per worker. At most
+    prefetch batches are in flight: the next batch is queued before the
+    current one is handed out. Iterates like a DataLoader with batch_sampler,
+    and the threads are kept from epoch to epoch (like persistent workers)
+    until close(), the end of a with block or the loader is collected. The
+    dataset must be safe to index from several threads.
+    """
+
+    def __init__(self, dataset, batch_sampler, workers, collate_fn, prefetch=2):
+        self.dataset = dataset
+        self.batch_sampler = batch_sampler
+        self.workers = max(workers, 1)
+        self.collate_fn = collate_fn
+        self.prefetch = max(prefetch, 1)
+        self.pool = None
+
+    def __len__(self):
+        return len(self.batch_sampler)
+
+    def submit(self, indices):
+        return [self.pool.submit(self.dataset.__getitem__, i) for i in indices]
+
+    def __iter__(self):
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(self.workers)
+        batches = iter(self.batch_sampler)
+        pending = collections.deque(self.submit(indices) for indices in
+                                    itertools.islice(batches, self.prefetch))
+        try:
+            while pending:
+                samples = [future.result() for future in pending.popleft()]
+                indices = next(batches, None)
+                if indices is not None:
+                    pending.append(self.submit(indices))
+                yield self.collate_fn(samples)
+        finally:
+            # stopped early, don't load what nobody will read
+            for futures in pending:
+                for future in futures:
+                    future.cancel()
+
+    def close(self, wait=True):
+        """ Stop the threads (they are started again by the next epoch) """
+        if self.pool is not None:
+            self.pool.shutdown(wait=wait)
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __del__(self):
+        # don't block the collector on a sample still loading
+        self.close(wait=False)
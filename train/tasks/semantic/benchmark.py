@@ -0,0 +1,505 @@
+#!/usr/bin/env python3
+# This file is covered by the LICENSE file in the root of this project.
+
+import argparse
+import multiprocessing
+import os
+import tempfile
+import time
+import tracemalloc
+import yaml
+import numpy as np
+import torch
+import __init__ as booger
+
+from common.laserscan import LaserScan
+from common.sampler import BlockShuffleSampler
+from tasks.semantic.dataset.kitti.parser import SemanticKitti, Parser
+from tasks.semantic.modules import SalsaNext, SalsaNext_ASPP
+from tasks.semantic.modules.deploy import deploy, max_difference
+from tasks.semantic.modules.backends import export_onnx, export_torchscript, OnnxModel
+from tasks.semantic.modules.precision import Precision
+from tasks.semantic.modules.losses.rmi.rmi import RMILoss
+
+
+def synthetic_scans(n_scans, n_points=120000, seed=0):
+    """ Random HDL64-like scans: points on 64 rings, ranges up to 80m """
+    rng = np.random.RandomState(seed)
+    scans = []
+    for _ in range(n_scans):
+        yaw = rng.uniform(-np.pi, np.pi, n_points)
+        pitch = np.deg2rad(rng.uniform(-24.8, 2.0, n_points))
+        depth = rng.uniform(2.0, 80.0, n_points)
+        scan = np.empty((n_points, 4), dtype=np.float32)
+        scan[:, 0] = depth * np.cos(pitch) * np.cos(yaw)
+        scan[:, 1] = depth * np.cos(pitch) * np.sin(yaw)
+        scan[:, 2] = depth * np.sin(pitch)
+        scan[:, 3] = rng.uniform(0.0, 1.0, n_points)
+        scans.append(scan)
+    return scans
+
+
+def dataset_scans(dataset, sequence, n_scans):
+    scan_path = os.path.join(dataset, "sequences",
+                             '{0:02d}'.format(sequence), "velodyne")
+    scan_files = sorted(os.path.join(scan_path, f) for f in os.listdir(scan_path)
+                        if f.endswith(".bin"))[:n_scans]
+    return [np.fromfile(f, dtype=np.float32).reshape((-1, 4)) for f in scan_files]
+
+
+def time_per_scan(fn, scans, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for scan in scans:
+            fn(scan)
+        best = min(best, (time.perf_counter() - start) / len(scans))
+    return best
+
+
+def bench_projection(scans, sensor, repeat):
+    """ Sort-free do_range_projection against the argsort reference """
+    def projector(method):
+        scan = LaserScan(project=False,
+                         H=sensor["img_prop"]["height"],
+                         W=sensor["img_prop"]["width"],
+                         fov_up=sensor["fov_up"],
+                         fov_down=sensor["fov_down"])
+
+        def fn(points):
+            scan.set_points(points[:, 0:3], points[:, 3])
+            getattr(scan, method)()
+            return scan
+        return fn
+
+    fields = ["proj_range", "proj_xyz", "proj_remission", "proj_idx", "proj_mask",
+              "proj_x", "proj_y", "unproj_range"]
+    new = projector("do_range_projection")
+    ref = projector("do_range_projection_argsort")
+    mismatch = 0
+    for points in scans:
+        a = {f: getattr(new(points), f).copy() for f in fields}
+        b = {f: getattr(ref(points), f) for f in fields}
+        mismatch += sum(not np.array_equal(a[f], b[f]) for f in fields)
+
+    t_ref = time_per_scan(ref, scans, repeat)
+    t_new = time_per_scan(new, scans, repeat)
+    print("Projection of {} scans, avg {:.0f} points".format(
+        len(scans), np.mean([len(s) for s in scans])))
+    print("  argsort   : {:8.2f} ms/scan".format(t_ref * 1000))
+    print("  sort-free : {:8.2f} ms/scan ({:.2f}x)".format(t_new * 1000, t_ref / t_new))
+    print("  outputs identical: {}".format(mismatch == 0))
+
+
+def bench_alloc(dataset, n_scans):
+    """ Memory allocated (numpy, traced by tracemalloc) to project a sample,
+        with a new scan for each sample against the dataset's pooled scan
+    """
+    n_scans = min(n_scans, len(dataset))
+
+    def measure(fresh):
+        peaks = []
+        for index in range(n_scans):
+            if fresh:
+                dataset.scan = None
+            tracemalloc.start()
+            dataset.project(index)
+            peaks.append(tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+        return np.mean(peaks) / 2 ** 20
+
+    measure(False)  # warm up the pool
+    fresh = measure(True)
+    pooled = measure(False)
+    print("Peak numpy allocation per projected sample ({} scans)".format(n_scans))
+    print("  new scan per sample: {:8.2f} MiB".format(fresh))
+    print("  pooled scan        : {:8.2f} MiB".format(pooled))
+
+
+def memory_mib(pids):
+    """ Memory of the processes: proportional set size (the pages they share
+        split between them, so forked workers aren't counted many times), or
+        resident size where the kernel has no smaps_rollup
+    """
+    total = 0
+    for pid in pids:
+        try:
+            with open("/proc/{}/smaps_rollup".format(pid)) as f:
+                total += sum(int(line.split()[1]) for line in f if line.startswith("Pss:"))
+        except OSError:
+            try:
+                with open("/proc/{}/status".format(pid)) as f:
+                    total += sum(int(line.split()[1]) for line in f if line.startswith("VmRSS:"))
+            except OSError:
+                pass
+    return total / 1024
+
+
+def bench_loader(make_parser, n_batches):
+    """ Samples per second and memory (trainer plus workers) of the train
+        loader with worker processes against the thread loader, with the same
+        number of workers
+    """
+    print("Train loader, {} batches".format(n_batches))
+    # threads first, so no worker process is still around when measuring them
+    for loader in ["thread", "process"]:
+        parser = make_parser(loader)
+        start = time.perf_counter()
+        first = None
+        n_samples = 0
+        peak = 0
+        for i, batch in enumerate(parser.get_train_set()):
+            if first is None:
+                # startup (workers, first projections) apart from the throughput
+                first = time.perf_counter()
+            else:
+                n_samples += batch["proj"].shape[0]
+            pids = [os.getpid()] + [p.pid for p in multiprocessing.active_children()]
+            peak = max(peak, memory_mib(pids))
+            if i + 1 >= n_batches:
+                break
+        elapsed = time.perf_counter() - first
+        print("  {:8s}: first batch {:6.2f} s, {:7.1f} samples/s, peak memory {:8.1f} MiB".format(
+            loader, first - start, n_samples / max(elapsed, 1e-9), peak))
+        del parser
+
+
+def drop_from_page_cache(files):
+    """ Ask the kernel to forget the cached pages of the files, so they are
+        read from the storage again
+    """
+    for f in files:
+        fd = os.open(f, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+
+def bench_locality(dataset, n_scans, block_sizes=(1, 4, 16, 64, 256)):
+    """ Randomness of the epoch order against the throughput of reading its
+        first scans (and labels) from a cold page cache, for block shuffles
+        of increasing block size
+    """
+    groups = [os.path.dirname(f) for f in dataset.scan_files]
+    files = dataset.scan_files + dataset.label_files
+    positions = np.arange(len(groups))
+    print("Block shuffle of {} scans, reading {} of them cold".format(len(groups), n_scans))
+    print("  block | adjacent | |rank corr| |    MB/s")
+    for block_size in block_sizes:
+        order = np.fromiter(iter(BlockShuffleSampler(groups, block_size)), dtype=np.int64)
+        # share of samples read right after the previous frame, and how much
+        # the epoch order still follows the file order (0 is random)
+        adjacent = np.mean(np.diff(order) == 1)
+        corr = abs(np.corrcoef(positions, order)[0, 1])
+
+        drop_from_page_cache(files)
+        start = time.perf_counter()
+        n_bytes = 0
+        for index in order[:n_scans]:
+            n_bytes += np.fromfile(dataset.scan_files[index], dtype=np.uint8).nbytes
+            if dataset.label_files:
+                n_bytes += np.fromfile(dataset.label_files[index], dtype=np.uint8).nbytes
+        elapsed = time.perf_counter() - start
+        print("  {:5d} | {:8.3f} | {:11.3f} | {:7.1f}".format(
+            block_size, adjacent, corr, n_bytes / 2 ** 20 / elapsed))
+
+
+def make_model(arch, nclasses, checkpoint=None):
+    """ SalsaNext (or the ASPP one) in eval mode, from a checkpoint or with
+        random weights and batchnorm statistics (so folding them is not trivial)
+    """
+    module = SalsaNext_ASPP if arch == "aspp" else SalsaNext
+    model = module.SalsaNext(nclasses)
+    if checkpoint is not None:
+        w_dict = torch.load(checkpoint, map_location=lambda storage, loc: storage)
+        state = {k.replace("module.", "", 1): v for k, v in w_dict["state_dict"].items()}
+        model.load_state_dict(state, strict=True)
+    else:
+        torch.manual_seed(0)
+        for bn in model.modules():
+            if isinstance(bn, torch.nn.BatchNorm2d):
+                bn.running_mean.uniform_(-1, 1)
+                bn.running_var.uniform_(0.5, 2)
+                bn.weight.data.uniform_(0.5, 1.5)
+                bn.bias.data.uniform_(-0.5, 0.5)
+    return model.eval()
+
+
+def time_forward(model, x, repeat):
+    with torch.no_grad():
+        model(x)
+        best = float("inf")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            model(x)
+            best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench_deploy(model, sensor, repeat):
+    """ Outputs and CPU latency of the model against its deploy() copy """
+    deployed = deploy(model)
+    x = torch.randn(1, 5, sensor["img_prop"]["height"], sensor["img_prop"]["width"])
+    diff, same = max_difference(model, deployed, x)
+    t_model = time_forward(model, x, repeat)
+    t_deployed = time_forward(deployed, x, repeat)
+    print("Batchnorm folding, input {}".format(list(x.shape)))
+    print("  max abs difference : {:.3g}".format(diff))
+    print("  same argmax        : {:.4%}".format(same))
+    print("  model    : {:8.1f} ms".format(t_model * 1000))
+    print("  deployed : {:8.1f} ms ({:.2f}x)".format(t_deployed * 1000, t_model / t_deployed))
+
+
+def bench_backends(model, sensor, repeat, threads=None):
+    """ CPU latency of the model with each inference backend, exported to a
+        temporary directory, and largest difference of their outputs to eager
+    """
+    if threads is not None:
+        torch.set_num_threads(threads)
+    x = torch.randn(1, 5, sensor["img_prop"]["height"], sensor["img_prop"]["width"])
+    backends = [("eager", model)]
+    with tempfile.TemporaryDirectory() as directory:
+        backends.append(("torchscript", export_torchscript(
+            model, x, os.path.join(directory, "model.pt"))))
+        try:
+            filename = os.path.join(directory, "model.onnx")
+            export_onnx(model, x, filename)
+            backends.append(("onnxruntime", OnnxModel(filename, threads)))
+        except ImportError as e:
+            print("Skipping onnxruntime:", e)
+
+        with torch.no_grad():
+            reference = model(x)
+        print("Backends, input {}, {} threads".format(list(x.shape), torch.get_num_threads()))
+        print("  backend     | latency ms | max abs difference")
+        for name, run in backends:
+            with torch.no_grad():
+                diff = (run(x) - reference).abs().max().item()
+            print("  {:11s} | {:10.1f} | {:.3g}".format(
+                name, time_forward(run, x, repeat) * 1000, diff))
+
+
+def train_step(model, x, y, losses, precision):
+    """ Forward, losses and backward of the trainer (no optimizer step),
+        returns the output, the loss and the bytes autograd kept for the
+        backward (the activations)
+    """
+    saved = [0]
+
+    def pack(tensor):
+        saved[0] += tensor.numel() * tensor.element_size()
+        return tensor
+
+    model.zero_grad()
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        with precision.autocast():
+            output = model(x)
+            loss = sum(loss_fn(output, y) for loss_fn in losses)
+    precision.backward(loss)
+    return output.detach().float(), loss.item(), saved[0]
+
+
+def bench_precision(model, sensor, repeat, batch_size, device):
+    """ Time and memory of a training step (NLL + RMI losses) per autocast
+        precision, and how far its outputs are from fp32. The model is in
+        eval mode so the outputs compare (no dropout, fixed batchnorms).
+    """
+    nclasses = model.nclasses
+    model = model.to(device).eval()
+    nll = torch.nn.NLLLoss().to(device)
+    losses = [lambda output, y: nll(torch.log(output.clamp(min=1e-8)), y),
+              RMILoss(num_classes=nclasses).to(device)]
+    torch.manual_seed(0)
+    x = torch.randn(batch_size, 5, sensor["img_prop"]["height"], sensor["img_prop"]["width"],
+                    device=device)
+    y = torch.randint(0, nclasses, (batch_size, x.shape[2], x.shape[3]), device=device)
+
+    precisions = ["fp32", "bf16"]
+    if device.type == "cuda":
+        precisions.append("fp16")
+        if not torch.cuda.is_bf16_supported():
+            precisions.remove("bf16")
+
+    print("Training step, input {}, {}".format(list(x.shape), device))
+    print("  precision | step ms | saved MiB | peak MiB | loss      | max abs diff | same argmax")
+    reference = None
+    for name in precisions:
+        precision = Precision(name, device)
+        if device.type == "cuda":
+            torch.cuda.reset_peak_memory_stats(device)
+        output, loss, saved = train_step(model, x, y, losses, precision)
+        best = float("inf")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            train_step(model, x, y, losses, precision)
+            if device.type == "cuda":
+                torch.cuda.synchronize(device)
+            best = min(best, time.perf_counter() - start)
+        peak = torch.cuda.max_memory_allocated(device) / 2 ** 20 if device.type == "cuda" else float("nan")
+        if reference is None:
+            reference = output
+        same = (output.argmax(dim=1) == reference.argmax(dim=1)).float().mean().item()
+        print("  {:9s} | {:7.1f} | {:9.1f} | {:8.1f} | {:9.5f} | {:12.3g} | {:10.4%}".format(
+            name, best * 1000, saved / 2 ** 20, peak, loss,
+            (output - reference).abs().max().item(), same))
+
+
+def make_dataset(dataset, sequence, data_cfg, sensor, gt=True):
+    DATA = yaml.safe_load(open(data_cfg, 'r'))
+    return SemanticKitti(root=dataset,
+                         sequences=[sequence],
+                         labels=DATA["labels"],
+                         color_map=DATA["color_map"],
+                         learning_map=DATA["learning_map"],
+                         learning_map_inv=DATA["learning_map_inv"],
+                         sensor=sensor,
+                         gt=gt)
+
+
+def make_parser(dataset, sequence, data_cfg, ARCH, loader, workers, batch_size):
+    DATA = yaml.safe_load(open(data_cfg, 'r'))
+    return Parser(root=dataset,
+                  train_sequences=[sequence],
+                  valid_sequences=[sequence],
+                  test_sequences=None,
+                  labels=DATA["labels"],
+                  color_map=DATA["color_map"],
+                  learning_map=DATA["learning_map"],
+                  learning_map_inv=DATA["learning_map_inv"],
+                  sensor=ARCH["dataset"]["sensor"],
+                  max_points=ARCH["dataset"]["max_points"],
+                  batch_size=batch_size,
+                  workers=workers,
+                  gt=True,
+                  shuffle_train=True,
+                  fields=["proj", "proj_mask", "proj_labels", "path_seq", "path_name"],
+                  loader=loader,
+                  prefetch=ARCH["dataset"].get("prefetch", 2))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser("./benchmark.py")
+    parser.add_argument(
+        '--bench', '-b',
+        type=str,
+        required=True,
+        choices=["projection", "alloc", "loader", "locality", "deploy", "backends", "precision"],
+        help='What to benchmark. No Default',
+    )
+    parser.add_argument(
+        '--arch_cfg', '-ac',
+        type=str,
+        required=False,
+        default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "../../../mambonet.yml"),
+        help='Architecture yaml cfg file, for the sensor. Defaults to %(default)s',
+    )
+    parser.add_argument(
+        '--data_cfg', '-dc',
+        type=str,
+        required=False,
+        default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "config/labels/semantic-kitti.yaml"),
+        help='Classification yaml cfg file. Defaults to %(default)s',
+    )
+    parser.add_argument(
+        '--dataset', '-d',
+        type=str,
+        required=False,
+        default=None,
+        help='Dataset to read scans from. Defaults to synthetic scans '
+             '(the dataset benchmarks need one)',
+    )
+    parser.add_argument(
+        '--sequence', '-s',
+        type=int,
+        required=False,
+        default=8,
+        help='Sequence to read scans from, with --dataset. Defaults to %(default)s',
+    )
+    parser.add_argument(
+        '--scans', '-n',
+        type=int,
+        required=False,
+        default=20,
+        help='Number of scans (of batches, for the loader). Defaults to %(default)s',
+    )
+    parser.add_argument(
+        '--repeat', '-r',
+        type=int,
+        required=False,
+        default=3,
+        help='Repetitions, the best one is reported. Defaults to %(default)s',
+    )
+    parser.add_argument(
+        '--workers', '-w',
+        type=int,
+        required=False,
+        default=None,
+        help='Loader workers (processes or threads), cpu threads for the backends. '
+             'Defaults to train workers of the arch cfg (all cpus for the backends)',
+    )
+    parser.add_argument(
+        '--batch_size',
+        type=int,
+        required=False,
+        default=None,
+        help='Batch size of the loader and of the training step. Defaults to train '
+             'batch_size of the arch cfg for the loader, 1 for the step',
+    )
+    parser.add_argument(
+        '--model', '-m',
+        type=str,
+        required=False,
+        default=None,
+        help='Checkpoint for the model benchmarks. Defaults to random weights',
+    )
+    parser.add_argument(
+        '--arch',
+        type=str,
+        required=False,
+        default="salsanext",
+        choices=["salsanext", "aspp"],
+        help='Network of the model benchmarks. Defaults to %(default)s',
+    )
+    FLAGS, unparsed = parser.parse_known_args()
+
+    ARCH = yaml.safe_load(open(FLAGS.arch_cfg, 'r'))
+    sensor = ARCH["dataset"]["sensor"]
+
+    if FLAGS.bench == "deploy":
+        DATA = yaml.safe_load(open(FLAGS.data_cfg, 'r'))
+        model = make_model(FLAGS.arch, len(DATA["learning_map_inv"]), FLAGS.model)
+        bench_deploy(model, sensor, FLAGS.repeat)
+    elif FLAGS.bench == "backends":
+        DATA = yaml.safe_load(open(FLAGS.data_cfg, 'r'))
+        model = make_model(FLAGS.arch, len(DATA["learning_map_inv"]), FLAGS.model)
+        if ARCH.get("infer", {}).get("fold_bn", False):
+            model = deploy(model)
+        bench_backends(model, sensor, FLAGS.repeat, FLAGS.workers)
+    elif FLAGS.bench == "precision":
+        DATA = yaml.safe_load(open(FLAGS.data_cfg, 'r'))
+        model = make_model(FLAGS.arch, len(DATA["learning_map_inv"]), FLAGS.model)
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        bench_precision(model, sensor, FLAGS.repeat, FLAGS.batch_size or 1, device)
+    elif FLAGS.bench == "projection":
+        if FLAGS.dataset is None:
+            scans = synthetic_scans(FLAGS.scans)
+        else:
+            scans = dataset_scans(FLAGS.dataset, FLAGS.sequence, FLAGS.scans)
+        bench_projection(scans, sensor, FLAGS.repeat)
+    else:
+        if FLAGS.dataset is None:
+            raise ValueError("--bench {} needs a --dataset".format(FLAGS.bench))
+        dataset = make_dataset(FLAGS.dataset, FLAGS.sequence, FLAGS.data_cfg, sensor)
+        if FLAGS.bench == "alloc":
+            bench_alloc(dataset, FLAGS.scans)
+        elif FLAGS.bench == "locality":
+            bench_locality(dataset, FLAGS.scans)
+        elif FLAGS.bench == "loader":
+            workers = FLAGS.workers if FLAGS.workers is not None else ARCH["train"]["workers"]
+            batch_size = FLAGS.batch_size if FLAGS.batch_size is not None else ARCH["train"]["batch_size"]
+            bench_loader(lambda loader: make_parser(FLAGS.dataset, FLAGS.sequence, FLAGS.data_cfg,
+                                                    ARCH, loader, workers, batch_size),
+                         FLAGS.scans)
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+# This file is covered by the LICENSE file in the root of this project.
+
+import argparse
+import multiprocessing
+import os
+import re
+import yaml
+import numpy as np
+import __init__ as booger
+
+from tasks.semantic.dataset.kitti.parser import SemanticKitti
+
+# channels of the network input, in the order of img_means/img_stds
+CHANNELS = ["range", "x", "y", "z", "remission"]
+
+# dataset of the worker processes (sent once, not with every chunk)
+dataset = None
+
+
+def init_worker(data):
+    global dataset
+    dataset = data
+
+
+def raw_label(data, index):
+    """ Original semantic label of each point of a scan """
+    if data.shards:
+        seq, frame = data.shard_frames[index]
+        label = data.shards[seq].label(frame)
+    else:
+        label = np.fromfile(data.label_files[index], dtype=np.int32)
+    return label & 0xFFFF
+
+
+def merge(a, b):
+    """ Merge two (count, mean, M2) Welford accumulators (Chan et al.) """
+    n_a, mean_a, m2_a = a
+    n_b, mean_b, m2_b = b
+    n = n_a + n_b
+    if n == 0:
+        return a
+    delta = mean_b - mean_a
+    mean = mean_a + delta * n_b / n
+    m2 = m2_a + m2_b + delta ** 2 * n_a * n_b / n
+    return n, mean, m2
+
+
+def stats(indices):
+    """ Welford accumulator of the channels over the valid pixels of the
+        projections of the scans, and histogram of their original labels
+    """
+    acc = (0, np.zeros(len(CHANNELS)), np.zeros(len(CHANNELS)))
+    hist = np.zeros(0, dtype=np.int64)
+    for index in indices:
+        sample = dataset.project(index)
+        mask = sample["proj_mask"] > 0
+        values = np.concatenate([sample["proj_range"][mask][:, None],
+                                 sample["proj_xyz"][mask],
+                                 sample["proj_remission"][mask][:, None]],
+                                axis=1).astype(np.float64)
+        if len(values):
+            mean = values.mean(axis=0)
+            acc = merge(acc, (len(values), mean, ((values - mean) ** 2).sum(axis=0)))
+        if dataset.gt:
+            counts = np.bincount(raw_label(dataset, index))
+            if len(counts) > len(hist):
+                hist = np.pad(hist, (0, len(counts) - len(hist)), "constant")
+            hist[:len(counts)] += counts
+    return acc, hist
+
+
+def replace_block(lines, key, children):
+    """ Replace the lines nested under the first "key:" line by children
+        (without indentation), keeping the key line and its comment
+    """
+    pattern = re.compile(r"^(\s*){}:".format(re.escape(key)))
+    for start, line in enumerate(lines):
+        match = pattern.match(line)
+        if match:
+            break
+    else:
+        raise ValueError("No {} in the config".format(key))
+    indent = len(match.group(1))
+    end = start + 1
+    child_indent = None
+    while end < len(lines):
+        stripped = lines[end].strip()
+        line_indent = len(lines[end]) - len(lines[end].lstrip())
+        if stripped and line_indent <= indent:
+            break
+        if stripped and child_indent is None:
+            child_indent = line_indent
+        end += 1
+    # keep the blank lines that separate the block from the next one
+    while end > start + 1 and not lines[end - 1].strip():
+        end -= 1
+    if child_indent is None:
+        child_indent = indent + 2
+    return (lines[:start + 1] +
+            [" " * child_indent + child + "\n" for child in children] +
+            lines[end:])
+
+
+def write_config(filename, blocks):
+    """ Edit the blocks of a config in place, line by line, so the comments
+        and the layout of the rest of the file are kept
+    """
+    with open(filename, "r") as f:
+        lines = f.readlines()
+    for key, children in blocks:
+        lines = replace_block(lines, key, children)
+    tmp = filename + ".tmp"
+    with open(tmp, "w") as f:
+        f.writelines(lines)
+    os.replace(tmp, filename)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser("./compute_stats.py")
+    parser.add_argument(
+        '--dataset', '-d',
+        type=str,
+        required=True,
+        help='Dataset to compute the statistics of. No Default',
+    )
+    parser.add_argument(
+        '--arch_cfg', '-ac',
+        type=str,
+        required=False,
+        default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "../../../mambonet.yml"),
+        help='Architecture yaml cfg file, with the sensor. Defaults to %(default)s',
+    )
+    parser.add_argument(
+        '--data_cfg', '-dc',
+        type=str,
+        required=False,
+        default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "config/labels/semantic-kitti.yaml"),
+        help='Classification yaml cfg file, with the splits. Defaults to %(default)s',
+    )
+    parser.add_argument(
+        '--split', '-s',
+        type=str,
+        required=False,
+        default="train",
+        choices=["train", "valid", "test"],
+        help='Split to compute the statistics of. Defaults to %(default)s',
+    )
+    parser.add_argument(
+        '--workers', '-w',
+        type=int,
+        required=False,
+        default=os.cpu_count(),
+        help='Worker processes. Defaults to the number of cpus (%(default)s)',
+    )
+    parser.add_argument(
+        '--write',
+        action='store_true',
+        help='Write img_means/img_stds to the arch cfg and the content to the '
+             'data cfg. Defaults to only printing them',
+    )
+    FLAGS, unparsed = parser.parse_known_args()
+
+    # print summary of what we will do
+    print("*" * 80)
+    print("INTERFACE:")
+    print("Dataset: ", FLAGS.dataset)
+    print("Arch cfg: ", FLAGS.arch_cfg)
+    print("Data cfg: ", FLAGS.data_cfg)
+    print("Split: ", FLAGS.split)
+    print("Workers: ", FLAGS.workers)
+    print("*" * 80)
+
+    ARCH = yaml.safe_load(open(FLAGS.arch_cfg, 'r'))
+    DATA = yaml.safe_load(open(FLAGS.data_cfg, 'r'))
+    data = SemanticKitti(root=FLAGS.dataset,
+                         sequences=DATA["split"][FLAGS.split],
+                         labels=DATA["labels"],
+                         color_map=DATA["color_map"],
+                         learning_map=DATA["learning_map"],
+                         learning_map_inv=DATA["learning_map_inv"],
+                         sensor=ARCH["dataset"]["sensor"],
+                         gt=FLAGS.split != "test",
+                         fields=["proj_range", "proj_xyz", "proj_remission", "proj_mask"])
+
+    # a few chunks per worker, merged as they come
+    workers = max(FLAGS.workers, 1)
+    chunks = np.array_split(np.arange(len(data)), workers * 4)
+    acc = (0, np.zeros(len(CHANNELS)), np.zeros(len(CHANNELS)))
+    hist = np.zeros(0, dtype=np.int64)
+    with multiprocessing.Pool(workers, initializer=init_worker, initargs=(data,)) as pool:
+        for chunk_acc, chunk_hist in pool.imap_unordered(stats, chunks):
+            acc = merge(acc, chunk_acc)
+            if len(chunk_hist) > len(hist):
+                hist = np.pad(hist, (0, len(chunk_hist) - len(hist)), "constant")
+            hist[:len(chunk_hist)] += chunk_hist
+
+    n, means, m2 = acc
+    stds = np.sqrt(m2 / max(n, 1))
+    print("{} scans, {} valid pixels".format(len(data), n))
+    for name, mean, std in zip(CHANNELS, means, stds):
+        print("  {:9s}: mean {:9.4f} std {:9.4f}".format(name, mean, std))
+
+    content = None
+    if data.gt:
+        total = max(hist.sum(), 1)
+        content = {key: float(hist[key]) / total if key < len(hist) else 0.0
+                   for key in DATA["labels"]}
+        print("Content (ratio of the points of each class):")
+        for key, ratio in content.items():
+            print("  {:3d} {:20s}: {}".format(key, DATA["labels"][key], ratio))
+
+    if FLAGS.write:
+        write_config(FLAGS.arch_cfg,
+                     [("img_means", ["- {:.4f}".format(m) for m in means]),
+                      ("img_stds", ["- {:.4f}".format(s) for s in stds])])
+        print("Wrote img_means and img_stds to", FLAGS.arch_cfg)
+        if content is not None:
+            write_config(FLAGS.data_cfg,
+                         [("content", ["{}: {}".format(key, ratio)
+                                       for key, ratio in content.items()])])
+            print("Wrote content to", FLAGS.data_cfg)
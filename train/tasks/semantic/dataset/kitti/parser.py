@@ -1,8 +1,19 @@
 import os
+import inspect
+import threading
 import numpy as np
 import torch
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, BatchSampler, RandomSampler, SequentialSampler
+from torch.utils.data.dataloader import default_collate
 from common.laserscan import LaserScan, SemLaserScan
+from common.projcache import ProjectionCache
+from common.shards import SequenceShard, SHARD_EXTENSION
+from common.manifest import Manifest
+from common.sampler import BucketBatchSampler, BlockShuffleSampler, rare_class_sampler
+from common.classindex import ClassIndex
+from common.threadloader import ThreadLoader
+from common.staging import Staging
+from common.qbin import decode_scan
 import torchvision
 
 import torch
@@ -20,44 +31,154 @@ from collections.abc import Sequence, Iterable
 import warnings
 
 
-EXTENSIONS_SCAN = ['.bin']
+EXTENSIONS_SCAN = ['.bin', '.qbin']
 EXTENSIONS_LABEL = ['.label']
 
+# DataLoader workers can live across epochs (torch >= 1.7)
+PERSISTENT_WORKERS = 'persistent_workers' in inspect.signature(
+    torch.utils.data.DataLoader.__init__).parameters
 
-def is_scan(filename):
-  return any(filename.endswith(ext) for ext in EXTENSIONS_SCAN)
+# where the scans are loaded: dataloader worker processes or threads of this process
+LOADERS = ['process', 'thread']
 
+# ways of batching the per point fields of the scans: padded to max_points,
+# concatenated with offsets, or padded to the largest scan of the batch
+POINT_BATCHING = ['padded', 'packed', 'batch_padded']
 
-def is_label(filename):
-  return any(filename.endswith(ext) for ext in EXTENSIONS_LABEL)
+# fields of a sample, in the order of the tuple returned when no fields are
+# selected (SemanticKitti fields=None)
+FIELDS = ['proj', 'proj_mask', 'proj_labels', 'unproj_labels', 'path_seq',
+          'path_name', 'proj_x', 'proj_y', 'proj_range', 'unproj_range',
+          'proj_xyz', 'unproj_xyz', 'proj_remission', 'unproj_remissions',
+          'unproj_n_points']
 
+# per point fields: padded to max_points, or concatenated by packed_collate
+POINT_FIELDS = ['unproj_labels', 'proj_x', 'proj_y', 'unproj_range',
+                'unproj_xyz', 'unproj_remissions']
 
-def my_collate(batch):
-    data = [item[0] for item in batch]
-    project_mask = [item[1] for item in batch]
-    proj_labels = [item[2] for item in batch]
-    data = torch.stack(data,dim=0)
-    project_mask = torch.stack(project_mask,dim=0)
-    proj_labels = torch.stack(proj_labels, dim=0)
+# padding value and tensor type of the per point fields
+POINT_TENSORS = {'unproj_labels': (-1, torch.int32),
+                 'proj_x': (-1, torch.long),
+                 'proj_y': (-1, torch.long),
+                 'unproj_range': (-1.0, torch.float),
+                 'unproj_xyz': (-1.0, torch.float),
+                 'unproj_remissions': (-1.0, torch.float)}
 
-    to_augment =(proj_labels == 12).nonzero()
-    to_augment_unique_12 = torch.unique(to_augment[:, 0])
 
-    to_augment = (proj_labels == 5).nonzero()
-    to_augment_unique_5 = torch.unique(to_augment[:, 0])
+def is_scan(filename):
+  return any(filename.endswith(ext) for ext in EXTENSIONS_SCAN)
 
-    to_augment = (proj_labels == 8).nonzero()
-    to_augment_unique_8 = torch.unique(to_augment[:, 0])
 
-    to_augment_unique = torch.cat((to_augment_unique_5,to_augment_unique_8,to_augment_unique_12),dim=0)
-    to_augment_unique = torch.unique(to_augment_unique)
+def is_label(filename):
+  return any(filename.endswith(ext) for ext in EXTENSIONS_LABEL)
 
-    for k in to_augment_unique:
-        data = torch.cat((data,torch.flip(data[k.item()], [2]).unsqueeze(0)),dim=0)
-        proj_labels = torch.cat((proj_labels,torch.flip(proj_labels[k.item()], [1]).unsqueeze(0)),dim=0)
-        project_mask = torch.cat((project_mask,torch.flip(project_mask[k.item()], [1]).unsqueeze(0)),dim=0)
 
-    return data, project_mask,proj_labels
+# [nclasses] uint8 lookup tables of the rare classes, per (classes, nclasses,
+# device), so the presence check needs no read of the labels on the host
+RARE_LUTS = {}
+
+
+def rare_lut(classes, nclasses, device):
+  key = (tuple(classes), nclasses, str(device))
+  if key not in RARE_LUTS:
+    rare = torch.zeros(nclasses, dtype=torch.uint8)
+    rare[list(classes)] = 1
+    RARE_LUTS[key] = rare.to(device)
+  return RARE_LUTS[key]
+
+
+def flip_rare_classes(data, project_mask, proj_labels, classes=(5, 8, 12),
+                      max_batch=None, nclasses=20):
+  """ Append a W-flipped copy of the scans in the batch that contain any of the
+      (rare) classes. data is [B,C,H,W], project_mask and proj_labels [B,H,W]
+      (xentropy labels, under nclasses). With max_batch the output always has
+      max_batch scans: extra flips are cut, missing ones are filled with flips
+      of the other scans, and a batch already bigger is cut to max_batch (no
+      flips), so the shapes stay the same from step to step.
+  """
+  B = proj_labels.shape[0]
+  if max_batch is not None and B >= max_batch:
+    return data[:max_batch], project_mask[:max_batch], proj_labels[:max_batch]
+
+  # which scans contain a rare class, one lookup for all classes
+  rare = rare_lut(classes, nclasses, proj_labels.device)
+  present = rare[proj_labels.long()].view(B, -1).max(dim=1)[0] > 0
+  index = torch.nonzero(present).view(-1)
+
+  if max_batch is not None:
+    n_flips = max_batch - B
+    others = torch.nonzero(present == 0).view(-1)
+    index = torch.cat((index, others)).repeat(n_flips // B + 1)[:n_flips]
+  if index.numel() == 0:
+    return data, project_mask, proj_labels
+
+  # the tensors may not be in the same device (e.g. mask kept in cpu)
+  def flipped(x):
+    return torch.flip(x[index.to(x.device)], [x.dim() - 1])
+
+  data = torch.cat((data, flipped(data)), dim=0)
+  project_mask = torch.cat((project_mask, flipped(project_mask)), dim=0)
+  proj_labels = torch.cat((proj_labels, flipped(proj_labels)), dim=0)
+  return data, project_mask, proj_labels
+
+
+def my_collate(batch, max_batch=None):
+  data = torch.stack([item[0] for item in batch], dim=0)
+  project_mask = torch.stack([item[1] for item in batch], dim=0)
+  proj_labels = torch.stack([item[2] for item in batch], dim=0)
+  return flip_rare_classes(data, project_mask, proj_labels, max_batch=max_batch)
+
+
+def batch_fields(batch):
+  """ Names and values (over the batch) of the fields of dict or tuple samples """
+  if isinstance(batch[0], dict):
+    names = list(batch[0].keys())
+    return names, [[item[name] for item in batch] for name in names]
+  return FIELDS, list(zip(*batch))
+
+
+def packed_collate(batch):
+  """ Collate scans without padding: the per point fields of the scans in the
+      batch are concatenated, and the number of points is replaced by the
+      [B+1] offsets of each scan in them (scan b has points offsets[b]:offsets[b+1])
+  """
+  names, fields = batch_fields(batch)
+  collated = []
+  for name, field in zip(names, fields):
+    if name in POINT_FIELDS:
+      # empty lists when there is no ground truth
+      collated.append(torch.cat(field) if torch.is_tensor(field[0]) else [])
+    elif name == "unproj_n_points":
+      offsets = torch.zeros(len(batch) + 1, dtype=torch.long)
+      torch.cumsum(torch.tensor(field, dtype=torch.long), dim=0, out=offsets[1:])
+      collated.append(offsets)
+    else:
+      collated.append(default_collate(field))
+  if isinstance(batch[0], dict):
+    return dict(zip(names, collated))
+  return collated
+
+
+def batch_padded_collate(batch):
+  """ Collate scans padding the per point fields to the largest scan of the
+      batch, instead of to max_points
+  """
+  names, fields = batch_fields(batch)
+  collated = []
+  for name, field in zip(names, fields):
+    if name in POINT_FIELDS and torch.is_tensor(field[0]):
+      fill, dtype = POINT_TENSORS[name]
+      n_points = max(points.shape[0] for points in field)
+      padded = torch.full((len(field), n_points) + tuple(field[0].shape[1:]), fill,
+                          dtype=dtype)
+      for b, points in enumerate(field):
+        padded[b, :points.shape[0]] = points
+      collated.append(padded)
+    else:
+      collated.append(default_collate(field))
+  if isinstance(batch[0], dict):
+    return dict(zip(names, collated))
+  return collated
 
 class SemanticKitti(Dataset):
 
@@ -69,8 +190,16 @@ class SemanticKitti(Dataset):
                learning_map_inv,    # inverse of previous (recover labels)
                sensor,              # sensor to parse scans from
                max_points=150000,   # max number of points present in dataset
-               gt=True,
-               transform=False):            # send ground truth?
+               gt=True,             # send ground truth?
+               transform=False,     # augment scans?
+               cache_dir=None,      # projection cache folder (None = no cache)
+               shard_dir=None,      # read packed sequence shards instead of files
+               point_batching="padded",  # pad points to max_points, or "packed"
+               fields=None,         # names of the fields to return (None = all, as tuple)
+               seed=None,           # seed of the augmentations (None = not reproducible)
+               staging_dir=None,    # local copy of the scans read (None = read in place)
+               staging_budget=16 * 2 ** 30,  # bytes the local copy can take
+               staging_prefetch=8):  # frames staged ahead of the one read
     # save deats
     self.root = os.path.join(root, "sequences")
     self.sequences = sequences
@@ -90,12 +219,37 @@ class SemanticKitti(Dataset):
     self.max_points = max_points
     self.gt = gt
     self.transform = transform
+    self.shard_dir = shard_dir
+    self.point_batching = point_batching
+    self.fields = fields
+    self.seed = seed
+
+    # stage the files read in a local directory (shards are memory-mapped,
+    # so there the page cache already plays that role)
+    self.staging = None
+    if staging_dir is not None and shard_dir is None:
+      self.staging = Staging(root, staging_dir, staging_budget, staging_prefetch)
+
+    # only cache what is deterministic, augmented scans change every epoch
+    self.cache = None
+    if cache_dir is not None and not self.transform:
+      self.cache = ProjectionCache(cache_dir,
+                                   config={"sensor": sensor,
+                                           "gt": gt,
+                                           "learning_map": learning_map})
 
     # get number of classes (can't be len(self.learning_map) because there
     # are multiple repeated entries, so the number that matters is how many
     # there are for the xentropy)
     self.nclasses = len(self.learning_map_inv)
 
+    # original to xentropy lookup table, built once
+    self.learning_lut = SemanticKitti.lut(self.learning_map)
+
+    # scan whose buffers are reused by all the projections, made on first
+    # use (so each dataloader worker, or loader thread, makes and owns its own)
+    self.local = threading.local()
+
     # sanity checks
 
     # make sure directory exists
@@ -116,10 +270,28 @@ class SemanticKitti(Dataset):
     # make sure sequences is a list
     assert(isinstance(self.sequences, list))
 
+    # make sure we know how to batch the points
+    assert(self.point_batching in POINT_BATCHING)
+
+    # make sure we know the fields
+    if self.fields is not None:
+      assert(all(field in FIELDS for field in self.fields))
+
     # placeholder for filenames
     self.scan_files = []
     self.label_files = []
 
+    # number of points of each scan (from the file sizes, before augmenting)
+    n_points = {}
+
+    # shard backend: one memory-mapped file per sequence, and the
+    # (sequence, frame) of each scan in the same order as scan_files
+    self.shards = {}
+    self.shard_frames = []
+
+    # listing of the sequences, kept from run to run
+    manifest = Manifest(root)
+
     # fill in with names, checking that all sequences are complete
     for seq in self.sequences:
       # to string
@@ -132,10 +304,24 @@ class SemanticKitti(Dataset):
       label_path = os.path.join(self.root, seq, "labels")
 
       # get files
-      scan_files = [os.path.join(dp, f) for dp, dn, fn in os.walk(
-          os.path.expanduser(scan_path)) for f in fn if is_scan(f)]
-      label_files = [os.path.join(dp, f) for dp, dn, fn in os.walk(
-          os.path.expanduser(label_path)) for f in fn if is_label(f)]
+      if self.shard_dir is not None:
+        # the paths are only names here, data comes from the shard
+        shard = SequenceShard(os.path.join(self.shard_dir, seq + SHARD_EXTENSION))
+        if self.gt and not shard.has_labels:
+          raise ValueError("Shard of sequence {} has no labels".format(seq))
+        self.shards[seq] = shard
+        scan_files = [os.path.join(scan_path, name + EXTENSIONS_SCAN[0])
+                      for name in shard.names]
+        label_files = []
+        if shard.has_labels:
+          label_files = [os.path.join(label_path, name + EXTENSIONS_LABEL[0])
+                         for name in shard.names]
+        self.shard_frames.extend((f, seq, i) for i, f in enumerate(scan_files))
+        n_points.update(zip(scan_files, np.diff(shard.offsets).tolist()))
+      else:
+        scan_files = [f for f in manifest.scans(seq) if is_scan(f)]
+        label_files = [f for f in manifest.labels(seq) if is_label(f)]
+        n_points.update(zip(manifest.scans(seq), manifest.point_counts(seq)))
 
       # check all scans have labels
       if self.gt:
@@ -146,9 +332,13 @@ class SemanticKitti(Dataset):
       self.scan_files.extend(scan_files)
       self.label_files.extend(label_files)
 
+    manifest.save()
+
     # sort for correspondance
     self.scan_files.sort()
     self.label_files.sort()
+    self.shard_frames = [(seq, i) for _, seq, i in sorted(self.shard_frames)]
+    self.n_points = [n_points[f] for f in self.scan_files]
 
     print("Using {} scans from sequences {}".format(len(self.scan_files),
                                                     self.sequences))
@@ -161,6 +351,70 @@ class SemanticKitti(Dataset):
     # JLLIU
     # print(scan_file)
     
+    if self.gt:
+      label_file = self.label_files[index]
+
+    # validation and test scans are never augmented, so their projection
+    # can be computed once and mapped back from the cache afterwards
+    if self.cache is not None:
+      if self.shards:
+        seq, frame = self.shard_frames[index]
+        key = self.cache.key(self.shards[seq].filename, frame=frame)
+      elif self.gt:
+        key = self.cache.key(scan_file, label_file)
+      else:
+        key = self.cache.key(scan_file)
+      sample = self.cache.get(key)
+      if sample is None:
+        sample = self.project(index)
+        self.cache.put(key, sample)
+    else:
+      sample = self.project(index)
+
+    # only build the fields that are asked for
+    fields = FIELDS if self.fields is None else self.fields
+    item = {}
+    for name in fields:
+      if name in POINT_FIELDS:
+        if name == "unproj_labels" and not self.gt:
+          item[name] = []
+        else:
+          item[name] = self.points_tensor(sample[name], *POINT_TENSORS[name])
+      elif name == "proj_labels" and not self.gt:
+        item[name] = []
+      elif name == "unproj_n_points":
+        item[name] = sample["unproj_range"].shape[0]
+      elif name in ("path_seq", "path_name"):
+        # get name and sequence
+        path_split = os.path.normpath(scan_file).split(os.sep)
+        item["path_seq"] = path_split[-3]
+        item["path_name"] = os.path.splitext(path_split[-1])[0] + ".label"
+      else:
+        # projections
+        item[name] = torch.from_numpy(sample[name])
+
+    # return
+    if self.fields is None:
+      return tuple(item[name] for name in FIELDS)
+    return {name: item[name] for name in fields}
+
+  def points_tensor(self, array, fill, dtype):
+    """ Tensor of the points of a per point field: as is when packing them,
+        or padded with fill to max_points
+    """
+    if self.point_batching != "padded":
+      # real points only, the collate concatenates or pads them
+      return torch.tensor(array, dtype=dtype)
+    # make a tensor of the uncompressed data (with the max num points)
+    tensor = torch.full((self.max_points,) + array.shape[1:], fill, dtype=dtype)
+    tensor[:array.shape[0]] = torch.from_numpy(array)
+    return tensor
+
+  def project(self, index):
+    """ Open scan (and label) at index and project it. Returns a dict of numpy
+        arrays without any padding, which is what the projection cache stores.
+    """
+    scan_file = self.scan_files[index]
     if self.gt:
       label_file = self.label_files[index]
 
@@ -169,62 +423,68 @@ class SemanticKitti(Dataset):
     flip_sign = False
     rot = False
     drop_points = False
+    # with a seed, the augmentation of a scan only depends on it and the index
+    rng = random
+    if self.seed is not None:
+      rng = random.Random("{}/{}".format(self.seed, index))
     if self.transform:
-        if random.random() > 0.5:
-            if random.random() > 0.5:
+        if rng.random() > 0.5:
+            if rng.random() > 0.5:
                 DA = True
-            if random.random() > 0.5:
+            if rng.random() > 0.5:
                 flip_sign = True
-            if random.random() > 0.5:
+            if rng.random() > 0.5:
                 rot = True
-            drop_points = random.uniform(0, 0.5)
+            drop_points = rng.uniform(0, 0.5)
 
-    if self.gt:
-      scan = SemLaserScan(self.color_map,
-                          project=True,
-                          H=self.sensor_img_H,
-                          W=self.sensor_img_W,
-                          fov_up=self.sensor_fov_up,
-                          fov_down=self.sensor_fov_down,
-                          DA=DA,
-                          flip_sign=flip_sign,
-                          drop_points=drop_points)
-    else:
-      scan = LaserScan(project=True,
-                       H=self.sensor_img_H,
-                       W=self.sensor_img_W,
-                       fov_up=self.sensor_fov_up,
-                       fov_down=self.sensor_fov_down,
-                       DA=DA,
-                       rot=rot,
-                       flip_sign=flip_sign,
-                       drop_points=drop_points)
+    if self.scan is None:
+      if self.gt:
+        self.scan = SemLaserScan(self.color_map,
+                                 project=True,
+                                 H=self.sensor_img_H,
+                                 W=self.sensor_img_W,
+                                 fov_up=self.sensor_fov_up,
+                                 fov_down=self.sensor_fov_down,
+                                 reuse=True,
+                                 training=True,
+                                 check_labels=False)
+      else:
+        self.scan = LaserScan(project=True,
+                              H=self.sensor_img_H,
+                              W=self.sensor_img_W,
+                              fov_up=self.sensor_fov_up,
+                              fov_down=self.sensor_fov_down,
+                              reuse=True)
+    scan = self.scan
+    if self.seed is not None:
+      scan.set_seed(rng.getrandbits(32))
+    scan.DA = DA
+    scan.flip_sign = flip_sign
+    scan.drop_points = drop_points
+    if not self.gt:
+      # (scans with labels are never rotated)
+      scan.rot = rot
 
     # open and obtain scan
-    scan.open_scan(scan_file)
+    if self.shards:
+      seq, frame = self.shard_frames[index]
+      scan.open_scan_array(self.shards[seq].scan(frame))
+    elif self.staging is not None:
+      data = self.staging.fromfile(scan_file, np.uint8, self.following(index))
+      scan.open_scan_array(decode_scan(scan_file, data))
+    else:
+      scan.open_scan(scan_file)
     if self.gt:
-      scan.open_label(label_file)
+      if self.shards:
+        scan.open_label_array(self.shards[seq].label(frame))
+      elif self.staging is not None:
+        scan.open_label_array(self.staging.fromfile(label_file, np.int32))
+      else:
+        scan.open_label(label_file)
       # map unused classes to used classes (also for projection)
-      scan.sem_label = self.map(scan.sem_label, self.learning_map)
-      scan.proj_sem_label = self.map(scan.proj_sem_label, self.learning_map)
-
-
-    #print("proj_x.shape: ",proj_x.shape)
-    #print("proj_y.shape: ",proj_y.shape)
-
-    # make a tensor of the uncompressed data (with the max num points)
-    unproj_n_points = scan.points.shape[0]
-    unproj_xyz = torch.full((self.max_points, 3), -1.0, dtype=torch.float)
-    unproj_xyz[:unproj_n_points] = torch.from_numpy(scan.points)
-    unproj_range = torch.full([self.max_points], -1.0, dtype=torch.float)
-    unproj_range[:unproj_n_points] = torch.from_numpy(scan.unproj_range)
-    unproj_remissions = torch.full([self.max_points], -1.0, dtype=torch.float)
-    unproj_remissions[:unproj_n_points] = torch.from_numpy(scan.remissions)
-    if self.gt:
-      unproj_labels = torch.full([self.max_points], -1.0, dtype=torch.int32)
-      unproj_labels[:unproj_n_points] = torch.from_numpy(scan.sem_label)
-    else:
-      unproj_labels = []
+      scan.sem_label = self.learning_lut[scan.sem_label]
+      # in place, proj_sem_label is a buffer the scan reuses
+      np.take(self.learning_lut, scan.proj_sem_label, out=scan.proj_sem_label)
 
 # JLLIU:  
 # 底下的 proj_xyz.shape:  torch.Size([64, 2048, 3]) 就是之前在 laserscan.py 看到的那個
@@ -244,44 +504,106 @@ class SemanticKitti(Dataset):
     print("proj_xyzi[50,50]: ", proj_xyzi[50,50])
     """
 
-    # get points and labels
-    proj_range = torch.from_numpy(scan.proj_range).clone()
-    proj_xyz = torch.from_numpy(scan.proj_xyz).clone()
-    proj_remission = torch.from_numpy(scan.proj_remission).clone()
-    proj_mask = torch.from_numpy(scan.proj_mask)
+    # only what is asked for, unless it goes to the cache (for any consumer)
+    fields = FIELDS if self.fields is None or self.cache is not None else self.fields
+
+    sample = {"unproj_range": scan.unproj_range}
+    if "proj" in fields:
+      # normalized network input
+      proj_mask = torch.from_numpy(scan.proj_mask)
+      proj = torch.cat([torch.from_numpy(scan.proj_range).unsqueeze(0),
+                        torch.from_numpy(scan.proj_xyz).permute(2, 0, 1),
+                        torch.from_numpy(scan.proj_remission).unsqueeze(0)])
+      proj = (proj - self.sensor_img_means[:, None, None]
+              ) / self.sensor_img_stds[:, None, None]
+      proj = proj * proj_mask.float()
+      sample["proj"] = proj.numpy()
+
+    # the projection buffers belong to the scan and are overwritten by the
+    # next sample, keep copies
+    for name in ("proj_mask", "proj_range", "proj_xyz", "proj_remission"):
+      if name in fields:
+        sample[name] = getattr(scan, name).copy()
+    points = {"proj_x": scan.proj_x,
+              "proj_y": scan.proj_y,
+              "unproj_xyz": scan.points,
+              "unproj_remissions": scan.remissions}
+    for name, array in points.items():
+      if name in fields:
+        sample[name] = array
     if self.gt:
-      proj_labels = torch.from_numpy(scan.proj_sem_label).clone()
-      proj_labels = proj_labels * proj_mask
-    else:
-      proj_labels = []
-    proj_x = torch.full([self.max_points], -1, dtype=torch.long)
-    proj_x[:unproj_n_points] = torch.from_numpy(scan.proj_x)
-    proj_y = torch.full([self.max_points], -1, dtype=torch.long)
-    proj_y[:unproj_n_points] = torch.from_numpy(scan.proj_y)
-    proj = torch.cat([proj_range.unsqueeze(0).clone(),
-                      proj_xyz.clone().permute(2, 0, 1),
-                      proj_remission.unsqueeze(0).clone()])
-    proj = (proj - self.sensor_img_means[:, None, None]
-            ) / self.sensor_img_stds[:, None, None]
-    proj = proj * proj_mask.float()
-
-    # get name and sequence
-    path_norm = os.path.normpath(scan_file)
-    path_split = path_norm.split(os.sep)
-    path_seq = path_split[-3]
-    path_name = path_split[-1].replace(".bin", ".label")
-
-    # return
-    return proj, proj_mask, proj_labels, unproj_labels, path_seq, path_name, proj_x, proj_y, proj_range, unproj_range, proj_xyz, unproj_xyz, proj_remission, unproj_remissions, unproj_n_points
+      if "proj_labels" in fields:
+        sample["proj_labels"] = scan.proj_sem_label * scan.proj_mask
+      if "unproj_labels" in fields:
+        sample["unproj_labels"] = scan.sem_label
+    return sample
 
   def __len__(self):
     return len(self.scan_files)
 
+  def following(self, index):
+    """ Scan (and label) files of the frames after index in its sequence,
+        for the staging to copy ahead
+    """
+    files = []
+    folder = os.path.dirname(self.scan_files[index])
+    for i in range(index + 1, min(index + 1 + self.staging.prefetch, len(self.scan_files))):
+      if os.path.dirname(self.scan_files[i]) != folder:
+        break
+      files.append(self.scan_files[i])
+      if self.gt:
+        files.append(self.label_files[i])
+    return files
+
+  @property
+  def scan(self):
+    return getattr(self.local, "scan", None)
+
+  @scan.setter
+  def scan(self, scan):
+    self.local.scan = scan
+
+  def __getstate__(self):
+    # workers make their own scan, don't send the buffers of this one
+    state = self.__dict__.copy()
+    del state["local"]
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self.local = threading.local()
+
+  def class_histograms(self):
+    """ [len(self), nclasses] points of each (learning) class in each scan,
+        from the class index of the dataset (built on first use)
+    """
+    if not self.gt:
+      raise ValueError("Class histograms need the labels (gt=True)")
+    index = ClassIndex(os.path.dirname(self.root), self.learning_lut)
+    if self.shards:
+      stamps = {seq: ClassIndex.stamp(shard.filename) for seq, shard in self.shards.items()}
+      keys = [ClassIndex.key(self.shards[seq].filename, stamps[seq], frame)
+              for seq, frame in self.shard_frames]
+
+      def read_label(i):
+        seq, frame = self.shard_frames[i]
+        return self.shards[seq].label(frame)
+    else:
+      # mtime and size of the label files, stat-ed here (only when indexing)
+      manifest = Manifest(os.path.dirname(self.root))
+      stamps = {}
+      for seq in self.sequences:
+        stamps.update(zip(manifest.labels(seq), manifest.stamps(seq, "labels", ".label")))
+      keys = [ClassIndex.key(f, stamps[f]) for f in self.label_files]
+
+      def read_label(i):
+        return np.fromfile(self.label_files[i], dtype=np.int32)
+    return index.histograms(keys, read_label)
+
   @staticmethod
-  def map(label, mapdict):
-    # put label from original values to xentropy
-    # or vice-versa, depending on dictionary values
-    # make learning map a lookup table
+  def lut(mapdict):
+    # make learning map a lookup table, so that mapping labels
+    # (from original values to xentropy, or vice-versa) is lut[label]
     maxkey = 0
     for key, data in mapdict.items():
       if isinstance(data, list):
@@ -300,10 +622,7 @@ class SemanticKitti(Dataset):
         lut[key] = data
       except IndexError:
         print("Wrong key ", key)
-    # do the mapping
-    return lut[label]
-
-  
+    return lut
 
 
 class Parser():
@@ -322,7 +641,23 @@ class Parser():
                batch_size,        # batch size for train and val
                workers,           # threads to load data
                gt=True,           # get gt?
-               shuffle_train=True):  # shuffle training set?
+               shuffle_train=True,   # shuffle training set?
+               cache_dir=None,    # projection cache for valid/test (None = off)
+               shard_dir=None,    # folder of packed sequence shards (None = files)
+               point_batching="padded",  # "padded" to max_points, "packed" with offsets or "batch_padded"
+               drop_last=True,    # drop the last incomplete batch?
+               fields=None,       # fields the samples have (None = all, as tuple)
+               bucket_batches=False,  # batch scans of similar size together?
+               rare_classes=None,  # oversample train scans with these classes (None = off)
+               rare_weight=2.0,  # how much more likely those scans are
+               aug_seed=None,  # seed of the train augmentations (None = not reproducible)
+               augment_train=True,  # augment the train scans in the workers?
+               loader="process",  # load with worker "process"es or "thread"s
+               prefetch=2,        # batches in flight with the thread loader
+               staging_dir=None,  # local copy of the scans read, e.g. in /dev/shm (None = off)
+               staging_budget=16 * 2 ** 30,  # bytes the local copy can take
+               staging_prefetch=8,  # frames staged ahead of the one read
+               block_shuffle=1):  # frames of a sequence read in a row when shuffling
     super(Parser, self).__init__()
 
     # if I am training, get the dataset
@@ -340,98 +675,161 @@ class Parser():
     self.workers = workers
     self.gt = gt
     self.shuffle_train = shuffle_train
+    self.cache_dir = cache_dir
+    self.shard_dir = shard_dir
+    self.point_batching = point_batching
+    self.drop_last = drop_last
+    self.fields = fields
+    self.bucket_batches = bucket_batches
+    self.rare_classes = rare_classes
+    self.rare_weight = rare_weight
+    self.aug_seed = aug_seed
+    self.augment_train = augment_train
+    self.loader = loader
+    self.prefetch = prefetch
+    self.staging_dir = staging_dir
+    self.staging_budget = staging_budget
+    self.staging_prefetch = staging_prefetch
+    self.block_shuffle = block_shuffle
+    assert(self.loader in LOADERS)
+    if self.bucket_batches and self.shuffle_train and self.block_shuffle > 1:
+      # the buckets sort the scans by size, undoing the blocks read in order
+      raise ValueError("bucket_batches and block_shuffle > 1 don't go together, "
+                       "bucketing loses the read order of the blocks")
+
+    # packed points need their own collate, padded ones are stacked as usual
+    self.collate_fn = default_collate
+    if self.point_batching == "packed":
+      self.collate_fn = packed_collate
+    elif self.point_batching == "batch_padded":
+      self.collate_fn = batch_padded_collate
 
     print("----------valid_sequences: ",valid_sequences)
 
     # number of classes that matters is the one for xentropy
     self.nclasses = len(self.learning_map_inv)
 
-    # Data loading code
-    self.train_dataset = SemanticKitti(root=self.root,
-                                       sequences=self.train_sequences,
-                                       labels=self.labels,
-                                       color_map=self.color_map,
-                                       learning_map=self.learning_map,
-                                       learning_map_inv=self.learning_map_inv,
-                                       sensor=self.sensor,
-                                       max_points=max_points,
-                                       transform=True,
-                                       gt=self.gt)
-
-    self.trainloader = torch.utils.data.DataLoader(self.train_dataset,
-                                                   batch_size=self.batch_size,
-                                                   shuffle=self.shuffle_train,
-                                                   num_workers=self.workers,
-                                                   drop_last=True)
-    assert len(self.trainloader) > 0
-    self.trainiter = iter(self.trainloader)
-
-    self.valid_dataset = SemanticKitti(root=self.root,
-                                       sequences=self.valid_sequences,
-                                       labels=self.labels,
-                                       color_map=self.color_map,
-                                       learning_map=self.learning_map,
-                                       learning_map_inv=self.learning_map_inv,
-                                       sensor=self.sensor,
-                                       max_points=max_points,
-                                       gt=self.gt)
-
-    self.validloader = torch.utils.data.DataLoader(self.valid_dataset,
-                                                   batch_size=self.batch_size,
-                                                   shuffle=False,
-                                                   num_workers=self.workers,
-                                                   drop_last=True)
-    assert len(self.validloader) > 0
-    self.validiter = iter(self.validloader)
-
-    if self.test_sequences:
-      self.test_dataset = SemanticKitti(root=self.root,
-                                        sequences=self.test_sequences,
-                                        labels=self.labels,
-                                        color_map=self.color_map,
-                                        learning_map=self.learning_map,
-                                        learning_map_inv=self.learning_map_inv,
-                                        sensor=self.sensor,
-                                        max_points=max_points,
-                                        gt=False)
-
-      self.testloader = torch.utils.data.DataLoader(self.test_dataset,
-                                                    batch_size=self.batch_size,
-                                                    shuffle=False,
-                                                    num_workers=self.workers,
-                                                    drop_last=True)
-      assert len(self.testloader) > 0
-      self.testiter = iter(self.testloader)
+    # label lookup tables, built once: label conversions are lut[label]
+    self.learning_lut = SemanticKitti.lut(self.learning_map)          # original -> xentropy
+    self.learning_inv_lut = SemanticKitti.lut(self.learning_map_inv)  # xentropy -> original
+    self.color_lut = SemanticKitti.lut(self.color_map)                # original -> color
+    self.xentropy_color_lut = self.color_lut[self.learning_inv_lut]   # xentropy -> color
+    self.original_color_lut = self.xentropy_color_lut[self.learning_lut]  # original -> xentropy -> color
+    self.torch_luts = {}
+
+    # datasets, loaders and iterators of each split, built when first used
+    # (so no worker is started for a split that is never read)
+    self.datasets = {}
+    self.loaders = {}
+    self.iters = {}
+
+  def get_dataset(self, split):
+    if split not in self.datasets:
+      if split == "train":
+        # training scans are augmented, so never cached
+        sequences, gt, transform, cache_dir = self.train_sequences, self.gt, self.augment_train, None
+      elif split == "valid":
+        sequences, gt, transform, cache_dir = self.valid_sequences, self.gt, False, self.cache_dir
+      elif split == "test":
+        if not self.test_sequences:
+          raise ValueError("No test sequences to get")
+        sequences, gt, transform, cache_dir = self.test_sequences, False, False, self.cache_dir
+      else:
+        raise ValueError("Unknown split {}".format(split))
+      self.datasets[split] = SemanticKitti(root=self.root,
+                                           sequences=sequences,
+                                           labels=self.labels,
+                                           color_map=self.color_map,
+                                           learning_map=self.learning_map,
+                                           learning_map_inv=self.learning_map_inv,
+                                           sensor=self.sensor,
+                                           max_points=self.max_points,
+                                           transform=transform,
+                                           gt=gt,
+                                           cache_dir=cache_dir,
+                                           shard_dir=self.shard_dir,
+                                           point_batching=self.point_batching,
+                                           fields=self.fields,
+                                           seed=self.aug_seed if transform else None,
+                                           staging_dir=self.staging_dir,
+                                           staging_budget=self.staging_budget,
+                                           staging_prefetch=self.staging_prefetch)
+    return self.datasets[split]
+
+  def get_loader(self, split):
+    if split not in self.loaders:
+      kwargs = {}
+      if self.workers > 0 and PERSISTENT_WORKERS:
+        # keep the workers (and their scans) alive from epoch to epoch
+        kwargs["persistent_workers"] = True
+      dataset = self.get_dataset(split)
+      shuffle = self.shuffle_train and split == "train"
+      sampler = None
+      if self.rare_classes is not None and split == "train":
+        # scans with rare classes drawn more often, from the class index
+        sampler = rare_class_sampler(dataset.class_histograms(),
+                                     self.rare_classes, self.rare_weight)
+      elif shuffle and self.block_shuffle > 1:
+        # shuffled blocks of consecutive frames of a sequence, for read-ahead
+        sampler = BlockShuffleSampler([os.path.dirname(f) for f in dataset.scan_files],
+                                      self.block_shuffle)
+      if self.bucket_batches:
+        # batches of scans of similar size, from the index of point counts
+        batch_sampler = BucketBatchSampler(dataset.n_points,
+                                           self.batch_size,
+                                           drop_last=self.drop_last,
+                                           shuffle=shuffle,
+                                           sampler=sampler)
+      else:
+        if sampler is None:
+          sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+        batch_sampler = BatchSampler(sampler, self.batch_size, self.drop_last)
+      if self.loader == "thread":
+        self.loaders[split] = ThreadLoader(dataset,
+                                           batch_sampler,
+                                           workers=self.workers,
+                                           collate_fn=self.collate_fn,
+                                           prefetch=self.prefetch)
+      else:
+        self.loaders[split] = torch.utils.data.DataLoader(dataset,
+                                                          batch_sampler=batch_sampler,
+                                                          num_workers=self.workers,
+                                                          collate_fn=self.collate_fn,
+                                                          **kwargs)
+      assert len(self.loaders[split]) > 0
+    return self.loaders[split]
+
+  def get_batch(self, split):
+    if split not in self.iters:
+      self.iters[split] = iter(self.get_loader(split))
+    return next(self.iters[split])
 
   def get_train_batch(self):
-    scans = self.trainiter.next()
-    return scans
+    return self.get_batch("train")
 
   def get_train_set(self):
-    return self.trainloader
+    return self.get_loader("train")
 
   def get_valid_batch(self):
-    scans = self.validiter.next()
-    return scans
+    return self.get_batch("valid")
 
   def get_valid_set(self):
-    return self.validloader
+    return self.get_loader("valid")
 
   def get_test_batch(self):
-    scans = self.testiter.next()
-    return scans
+    return self.get_batch("test")
 
   def get_test_set(self):
-    return self.testloader
+    return self.get_loader("test")
 
   def get_train_size(self):
-    return len(self.trainloader)
+    return len(self.get_loader("train"))
 
   def get_valid_size(self):
-    return len(self.validloader)
+    return len(self.get_loader("valid"))
 
   def get_test_size(self):
-    return len(self.testloader)
+    return len(self.get_loader("test"))
 
   def get_n_classes(self):
     return self.nclasses
@@ -442,19 +840,33 @@ class Parser():
   def get_xentropy_class_string(self, idx):
     return self.labels[self.learning_map_inv[idx]]
 
+  def get_lut(self, name, device=None):
+    """ Lookup table (e.g. "learning_inv_lut") as a torch tensor in device,
+        kept for the next calls, so labels in device map with one gather
+    """
+    device = torch.device("cpu") if device is None else torch.device(device)
+    key = (name, str(device))
+    if key not in self.torch_luts:
+      self.torch_luts[key] = torch.from_numpy(getattr(self, name)).long().to(device)
+    return self.torch_luts[key]
+
+  def map(self, label, name):
+    # numpy labels map with the numpy lut, tensors with the one in their device
+    if torch.is_tensor(label):
+      return self.get_lut(name, label.device)[label.long()]
+    return getattr(self, name)[label]
+
   def to_original(self, label):
     # put label in original values
-    return SemanticKitti.map(label, self.learning_map_inv)
+    return self.map(label, "learning_inv_lut")
 
   def to_xentropy(self, label):
     # put label in xentropy values
-    return SemanticKitti.map(label, self.learning_map)
+    return self.map(label, "learning_lut")
 
   def to_color(self, label):
-    # put label in original values
-    label = SemanticKitti.map(label, self.learning_map_inv)
-    # put label in color
-    return SemanticKitti.map(label, self.color_map)
+    # put label in original values, and then in color
+    return self.map(label, "xentropy_color_lut")
 
   """def get_bin_info (self, index):
     self.SemanticKitti()
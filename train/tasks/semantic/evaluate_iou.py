@@ -11,6 +11,8 @@ import __init__ as booger
 
 from tasks.semantic.modules.ioueval import iouEval
 from common.laserscan import SemLaserScan
+from common.shards import SequenceShard, SHARD_EXTENSION
+from common.manifest import Manifest
 
 # possible splits
 splits = ['train','valid','test']
@@ -21,44 +23,32 @@ def save_to_log(logdir,logfile,message):
     return
 
 def eval(test_sequences,splits,pred):
-    # get scan paths
+    # get scan and label paths, or (shard, frame) pairs if reading shards
     scan_names = []
-    for sequence in test_sequences:
-        sequence = '{0:02d}'.format(int(sequence))
-        scan_paths = os.path.join(FLAGS.dataset, "sequences",
-                                  str(sequence), "velodyne")
-        # populate the scan names
-        seq_scan_names = [os.path.join(dp, f) for dp, dn, fn in os.walk(
-            os.path.expanduser(scan_paths)) for f in fn if ".bin" in f]
-        seq_scan_names.sort()
-        scan_names.extend(seq_scan_names)
-    #print(scan_names)
-
-    # get label paths
     label_names = []
-    for sequence in test_sequences:
-        sequence = '{0:02d}'.format(int(sequence))
-        label_paths = os.path.join(FLAGS.dataset, "sequences",
-                                   str(sequence), "labels")
-        # populate the label names
-        seq_label_names = [os.path.join(dp, f) for dp, dn, fn in os.walk(
-            os.path.expanduser(label_paths)) for f in fn if ".label" in f]
-        seq_label_names.sort()
-        label_names.extend(seq_label_names)
-    #print(label_names)
+    if FLAGS.shards is not None:
+        for sequence in test_sequences:
+            sequence = '{0:02d}'.format(int(sequence))
+            shard = SequenceShard(os.path.join(FLAGS.shards,
+                                               sequence + SHARD_EXTENSION))
+            scan_names.extend((shard, i) for i in range(len(shard)))
+        label_names = scan_names
+    else:
+        # populate the scan and label names (from the dataset manifest)
+        manifest = Manifest(FLAGS.dataset)
+        for sequence in test_sequences:
+            scan_names.extend(manifest.scans(sequence))
+            label_names.extend(manifest.labels(sequence))
+        manifest.save()
+        #print(scan_names)
+        #print(label_names)
 
     # get predictions paths
-    
+    manifest = Manifest(FLAGS.predictions)
     pred_names = []
     for sequence in test_sequences:
-        sequence = '{0:02d}'.format(int(sequence))
-        pred_paths = os.path.join(FLAGS.predictions, "sequences",
-                                  sequence, "predictions")
-        # populate the label names
-        seq_pred_names = [os.path.join(dp, f) for dp, dn, fn in os.walk(
-            os.path.expanduser(pred_paths)) for f in fn if ".label" in f]
-        seq_pred_names.sort()
-        pred_names.extend(seq_pred_names)  
+        pred_names.extend(manifest.labels(sequence, "predictions"))
+    manifest.save()
     print("pred_names", pred_names)
 
     # check that I have the same number of files
@@ -74,15 +64,23 @@ def eval(test_sequences,splits,pred):
         print("evaluating label ", label_file, "with", pred_file)
         # open label
         label = SemLaserScan(project=False)
-        label.open_scan(scan_file)
-        label.open_label(label_file)
+        if FLAGS.shards is not None:
+            shard, frame = scan_file
+            label.open_scan_array(shard.scan(frame))
+            label.open_label_array(shard.label(frame))
+        else:
+            label.open_scan(scan_file)
+            label.open_label(label_file)
         u_label_sem = remap_lut[label.sem_label]  # remap to xentropy format
         if FLAGS.limit is not None:
             u_label_sem = u_label_sem[:FLAGS.limit]
 
         # open prediction
         pred = SemLaserScan(project=False)
-        pred.open_scan(scan_file)
+        if FLAGS.shards is not None:
+            pred.open_scan_array(shard.scan(frame))
+        else:
+            pred.open_scan(scan_file)
         pred.open_label(pred_file)
         u_pred_sem = remap_lut[pred.sem_label]  # remap to xentropy format
         if FLAGS.limit is not None:
@@ -159,6 +157,15 @@ if __name__ == '__main__':
         default="config/labels/semantic-kitti.yaml",
         help='Dataset config file. Defaults to %(default)s',
     )
+    parser.add_argument(
+        '--shards',
+        type=str,
+        required=False,
+        default=None,
+        help='Read scans and labels from the sequence shards in this directory'
+             ' (see pack_shards.py) instead of the dataset files.'
+             ' Defaults to %(default)s',
+    )
     parser.add_argument(
         '--limit', '-l',
         type=int,
@@ -183,6 +190,7 @@ if __name__ == '__main__':
     print("Split: ", FLAGS.split)
     print("Config: ", FLAGS.data_cfg)
     print("Limit: ", FLAGS.limit)
+    print("Shards: ", FLAGS.shards)
     print("*" * 80)
 
     # assert split
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# This file is covered by the LICENSE file in the root of this project.
+
+import argparse
+import os
+import yaml
+import torch
+import __init__ as booger
+
+from tasks.semantic.modules.SalsaNext import SalsaNext
+from tasks.semantic.modules.deploy import deploy
+from tasks.semantic.modules.backends import (export_onnx, export_torchscript, load_checkpoint,
+                                             ONNX_NAME, TORCHSCRIPT_NAME)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser("./export.py")
+    parser.add_argument(
+        '--model', '-m',
+        type=str,
+        required=True,
+        help='Directory of the trained model (with arch_cfg.yaml and data_cfg.yaml). '
+             'No Default',
+    )
+    parser.add_argument(
+        '--output', '-o',
+        type=str,
+        required=False,
+        default=None,
+        help='Directory to write the exported models to. Defaults to the model '
+             'directory, where infer.py --backend looks for them',
+    )
+    parser.add_argument(
+        '--format', '-f',
+        type=str,
+        nargs='+',
+        required=False,
+        default=["torchscript", "onnx"],
+        choices=["torchscript", "onnx"],
+        help='Formats to export to. Defaults to %(default)s',
+    )
+    FLAGS, unparsed = parser.parse_known_args()
+    if FLAGS.output is None:
+        FLAGS.output = FLAGS.model
+
+    # print summary of what we will do
+    print("*" * 80)
+    print("INTERFACE:")
+    print("Model: ", FLAGS.model)
+    print("Output: ", FLAGS.output)
+    print("Formats: ", FLAGS.format)
+    print("*" * 80)
+
+    ARCH = yaml.safe_load(open(os.path.join(FLAGS.model, "arch_cfg.yaml"), 'r'))
+    DATA = yaml.safe_load(open(os.path.join(FLAGS.model, "data_cfg.yaml"), 'r'))
+
+    # the network the Trainer builds (and User runs), other checkpoints fail
+    model = SalsaNext(len(DATA["learning_map_inv"]))
+    load_checkpoint(model, os.path.join(FLAGS.model, "SalsaNext_valid_best"))
+    model.eval()
+    if ARCH.get("infer", {}).get("fold_bn", False):
+        model = deploy(model)
+
+    # batch size and width are dynamic in the onnx model, traced at sensor size
+    sensor = ARCH["dataset"]["sensor"]
+    example = torch.zeros(1, 5, sensor["img_prop"]["height"], sensor["img_prop"]["width"])
+    os.makedirs(FLAGS.output, exist_ok=True)
+    if "torchscript" in FLAGS.format:
+        filename = os.path.join(FLAGS.output, TORCHSCRIPT_NAME)
+        export_torchscript(model, example, filename)
+        print("Wrote", filename)
+    if "onnx" in FLAGS.format:
+        filename = os.path.join(FLAGS.output, ONNX_NAME)
+        export_onnx(model, example, filename)
+        print("Wrote", filename)
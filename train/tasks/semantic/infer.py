@@ -11,6 +11,7 @@ import shutil
 import __init__ as booger
 
 from tasks.semantic.modules.user import *
+from tasks.semantic.modules.backends import BACKENDS
 def str2bool(v):
     if isinstance(v, bool):
        return v
@@ -67,6 +68,17 @@ if __name__ == '__main__':
         help='Split to evaluate on. One of ' +
              str(splits) + '. Defaults to %(default)s',
     )
+    parser.add_argument(
+        '--backend', '-b',
+        type=str,
+        required=False,
+        default="eager",
+        choices=BACKENDS,
+        help='Engine to run the network with, torchscript and onnxruntime run '
+             'the models written to the model folder by export.py, int8 the one '
+             'of quantize_model.py (on cpu). '
+             'Defaults to %(default)s',
+    )
     FLAGS, unparsed = parser.parse_known_args()
 
     # print summary of what we will do
@@ -78,6 +90,7 @@ if __name__ == '__main__':
     print("Uncertainty", FLAGS.uncertainty)
     #print("Monte Carlo Sampling", FLAGS.mc)
     print("infering", FLAGS.split)
+    print("backend", FLAGS.backend)
     print("----------\n")
     #print("Commit hash (training version): ", str(
     #    subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD']).strip()))
@@ -140,5 +153,6 @@ if __name__ == '__main__':
         quit()
 
     # create user and infer dataset
-    user = User(ARCH, DATA, FLAGS.dataset, FLAGS.log, FLAGS.model,FLAGS.split,FLAGS.uncertainty)
+    user = User(ARCH, DATA, FLAGS.dataset, FLAGS.log, FLAGS.model,FLAGS.split,FLAGS.uncertainty,
+                backend=FLAGS.backend)
     user.infer()
@@ -246,7 +246,7 @@ class UpBlock(nn.Module):
 
     def forward(self, x, skip):
         
-        upA = nn.PixelShuffle(2)(x)
+        upA = F.pixel_shuffle(x, 2)
         if self.drop_out:
             upA = self.dropout1(upA)
         # print("================before upB", upA.shape)
@@ -315,8 +315,6 @@ class SalsaNext(nn.Module):
 
     def forward(self, x):
         # input dimension = [2048 x 64 x 5]
-        in_channel = int(x.shape[1])
-        # print("in_channel: ", in_channel)
         downCntx = self.downCntx(x)
         downCntx = self.downCntx2(downCntx)
         downCntx = self.downCntx3(downCntx)          # [2048 x 64 x 32]
@@ -218,7 +218,7 @@ class UpBlock(nn.Module):
 
     def forward(self, x, skip):
         
-        upA = nn.PixelShuffle(2)(x)
+        upA = F.pixel_shuffle(x, 2)
         if self.drop_out:
             upA = self.dropout1(upA)
 
@@ -286,8 +286,6 @@ class SalsaNext(nn.Module):
 
     def forward(self, x):
         # input dimension = [2048 x 64 x 5]
-        in_channel = int(x.shape[1])
-        # print("in_channel: ", in_channel)
         downCntx = self.downCntx(x)
         downCntx = self.downCntx2(downCntx)
         downCntx = self.downCntx3(downCntx)          # [2048 x 128 x 32]
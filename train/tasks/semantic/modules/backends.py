@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# This file is covered by the LICENSE file in the root of this project.
+
+import os
+
+import torch
+import torch.nn as nn
+
+# engines User can run the network with, eager is the model itself and the
+# others run what export.py (quantize_model.py for int8) wrote in the model
+# directory
+BACKENDS = ["eager", "torchscript", "onnxruntime", "int8"]
+# backends that only run on cpu, User keeps their inputs there
+CPU_BACKENDS = ["int8"]
+TORCHSCRIPT_NAME = "SalsaNext.pt"
+ONNX_NAME = "SalsaNext.onnx"
+INT8_NAME = "SalsaNext_int8.pt"
+
+
+def single(model):
+    """ The network inside a DataParallel, on cpu and in eval mode """
+    if isinstance(model, nn.DataParallel):
+        model = model.module
+    return model.cpu().eval()
+
+
+def load_checkpoint(model, filename):
+    """ Load a checkpoint of the Trainer (saved from the DataParallel model)
+        in model, failing before load_state_dict when it is the checkpoint
+        of another network (e.g. SalsaNext_ASPP or SalsaNextUncertainty)
+    """
+    w_dict = torch.load(filename, map_location=lambda storage, loc: storage)
+    state_dict = {k.replace("module.", "", 1): v for k, v in w_dict['state_dict'].items()}
+    expected = model.state_dict()
+    missing = sorted(set(expected) - set(state_dict))
+    unexpected = sorted(set(state_dict) - set(expected))
+    reshaped = sorted(k for k in set(expected) & set(state_dict)
+                      if expected[k].shape != state_dict[k].shape)
+    if missing or unexpected or reshaped:
+        raise ValueError("{} is not a checkpoint of {} ({} missing, {} unexpected and {} "
+                         "reshaped weights, e.g. {}), only that network can be exported".format(
+                             filename, type(model).__name__, len(missing), len(unexpected),
+                             len(reshaped), (missing + unexpected + reshaped)[:3]))
+    model.load_state_dict(state_dict, strict=True)
+    return model
+
+
+def export_torchscript(model, example, filename):
+    """ Trace the model with an example [B,5,H,W] input and save it """
+    with torch.no_grad():
+        traced = torch.jit.trace(single(model), example)
+    traced.save(filename)
+    return traced
+
+
+def export_onnx(model, example, filename, opset_version=11):
+    """ Save the model as ONNX, with dynamic batch size and width """
+    axes = {0: "batch", 3: "width"}
+    with torch.no_grad():
+        torch.onnx.export(single(model), example, filename,
+                          input_names=["proj"],
+                          output_names=["probabilities"],
+                          dynamic_axes={"proj": axes, "probabilities": axes},
+                          opset_version=opset_version)
+
+
+class OnnxModel:
+    """ONNX Runtime session that is called like the torch model.
+
+    Takes and returns torch tensors (on the device of the input), so User
+    doesn't know which engine runs. onnxruntime is only needed for it.
+    """
+
+    def __init__(self, filename, threads=None):
+        try:
+            import onnxruntime
+        except ImportError:
+            raise ImportError("The onnxruntime backend needs the onnxruntime package")
+        options = onnxruntime.SessionOptions()
+        if threads is not None:
+            options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(filename, options,
+                                                    providers=onnxruntime.get_available_providers())
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, x):
+        output = self.session.run(None, {self.input_name: x.detach().cpu().numpy()})[0]
+        return torch.from_numpy(output).to(x.device)
+
+    def eval(self):
+        return self
+
+    def cuda(self):
+        # onnxruntime places the session itself (CUDA provider, if installed)
+        return self
+
+
+def load_exported(backend, modeldir):
+    """ Model exported by export.py to modeldir, run with backend """
+    if backend == "torchscript":
+        return torch.jit.load(os.path.join(modeldir, TORCHSCRIPT_NAME), map_location="cpu")
+    if backend == "onnxruntime":
+        return OnnxModel(os.path.join(modeldir, ONNX_NAME))
+    if backend == "int8":
+        from tasks.semantic.modules.quantization import load
+        return load(os.path.join(modeldir, INT8_NAME))
+    raise ValueError("Unknown exported backend {}".format(backend))
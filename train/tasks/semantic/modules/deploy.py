@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# This file is covered by the LICENSE file in the root of this project.
+
+import copy
+
+import torch
+import torch.nn as nn
+
+# BatchNorms whose output only reaches a 1x1 convolution (through the concat
+# of the block), per block class: (bn, conv, slice of the conv input).
+# The blocks run conv -> LeakyReLU -> BN, so a BN can't go into the conv
+# before it, only into the (unpadded 1x1) conv after it.
+FOLDS = {
+    "ResBlock": [("bn3", "conv5", 2)],   # concat(bn1, bn2, bn3) -> conv5
+    "UpBlock": [("bn3", "conv4", 2)],    # concat(bn1, bn2, bn3) -> conv4
+}
+
+
+class ChannelAffine(nn.Module):
+    """Eval-mode BatchNorm as a fused per-channel scale and bias."""
+
+    def __init__(self, scale, bias):
+        super(ChannelAffine, self).__init__()
+        self.register_buffer("scale", scale.view(1, -1, 1, 1))
+        self.register_buffer("bias", bias.view(1, -1, 1, 1))
+
+    def forward(self, x):
+        return torch.addcmul(self.bias, x, self.scale)
+
+
+def bn_affine(bn):
+    """ (scale, bias) of the eval-mode BatchNorm: bn(x) = x * scale + bias """
+    scale = bn.weight.detach() / torch.sqrt(bn.running_var + bn.eps)
+    bias = bn.bias.detach() - bn.running_mean * scale
+    return scale, bias
+
+
+def fold_bn_into_conv(bn, conv, start=0):
+    """ Fold bn, applied to the input channels start:start+C of the 1x1 conv,
+        into the weights and bias of the conv
+    """
+    assert conv.kernel_size == (1, 1) and conv.padding == (0, 0) and conv.groups == 1
+    scale, bias = bn_affine(bn)
+    channels = slice(start, start + bn.num_features)
+    weight = conv.weight.detach()
+    if conv.bias is None:
+        conv.bias = nn.Parameter(torch.zeros(conv.out_channels, device=weight.device))
+    with torch.no_grad():
+        # conv(x * s + b) = (W * s) x + (W b + c)
+        conv.bias += weight[:, channels, 0, 0] @ bias
+        conv.weight[:, channels] *= scale.view(1, -1, 1, 1)
+
+
+def deploy(model):
+    """ Copy of a SalsaNext (or SalsaNext_ASPP) for inference, with the eval
+        BatchNorms folded into the following 1x1 convs where that is exact
+        (their output only goes to such a conv, without padding) and turned
+        into a ChannelAffine everywhere else. Works on DataParallel models.
+    """
+    model = copy.deepcopy(model).eval()
+    net = model.module if isinstance(model, nn.DataParallel) else model
+
+    for block in net.modules():
+        for bn_name, conv_name, index in FOLDS.get(type(block).__name__, []):
+            bn = getattr(block, bn_name)
+            fold_bn_into_conv(bn, getattr(block, conv_name), index * bn.num_features)
+            setattr(block, bn_name, nn.Identity())
+
+    # the last decoder block only feeds the (1x1) logits
+    if hasattr(net, "upBlock4") and hasattr(net, "logits"):
+        fold_bn_into_conv(net.upBlock4.bn4, net.logits)
+        net.upBlock4.bn4 = nn.Identity()
+
+    for block in list(net.modules()):
+        for name, child in list(block.named_children()):
+            if isinstance(child, nn.BatchNorm2d):
+                setattr(block, name, ChannelAffine(*bn_affine(child)))
+    return model
+
+
+def max_difference(model, deployed, x):
+    """ Largest absolute difference between the outputs of the model and of
+        its deployed copy, and share of pixels with the same argmax
+    """
+    with torch.no_grad():
+        a = model.eval()(x)
+        b = deployed.eval()(x)
+    same = (a.argmax(dim=1) == b.argmax(dim=1)).float().mean()
+    return (a - b).abs().max().item(), same.item()
@@ -15,6 +15,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 from tasks.semantic.modules.losses.rmi import rmi_utils
+from tasks.semantic.modules.precision import full_precision
 
 
 _euler_num = 2.718281828				# 	euler number
@@ -179,39 +180,42 @@ class RMILoss(nn.Module):
 		# combine the high dimension points from label and probability map. new shape [N, C, radius * radius, H, W]
 		la_vectors, pr_vectors = rmi_utils.map_get_pairs(labels_4D, probs_4D, radius=self.rmi_radius, is_combine=0)
 
-		la_vectors = la_vectors.view([n, c, self.half_d, -1]).type(torch.cuda.DoubleTensor).requires_grad_(False)
-		pr_vectors = pr_vectors.view([n, c, self.half_d, -1]).type(torch.cuda.DoubleTensor)
-
-		# small diagonal matrix, shape = [1, 1, radius * radius, radius * radius]
-		diag_matrix = torch.eye(self.half_d).unsqueeze(dim=0).unsqueeze(dim=0)
-
-		# the mean and covariance of these high dimension points
-		# Var(X) = E(X^2) - E(X) E(X), N * Var(X) = X^2 - X E(X)
-		la_vectors = la_vectors - la_vectors.mean(dim=3, keepdim=True)
-		la_cov = torch.matmul(la_vectors, la_vectors.transpose(2, 3))
-
-		pr_vectors = pr_vectors - pr_vectors.mean(dim=3, keepdim=True)
-		pr_cov = torch.matmul(pr_vectors, pr_vectors.transpose(2, 3))
-		# https://github.com/pytorch/pytorch/issues/7500
-		# waiting for batched torch.cholesky_inverse()
-		pr_cov_inv = torch.inverse(pr_cov + diag_matrix.type_as(pr_cov) * _POS_ALPHA)
-		# if the dimension of the point is less than 9, you can use the below function
-		# to acceleration computational speed.
-		#pr_cov_inv = utils.batch_cholesky_inverse(pr_cov + diag_matrix.type_as(pr_cov) * _POS_ALPHA)
-
-		la_pr_cov = torch.matmul(la_vectors, pr_vectors.transpose(2, 3))
-		# the approxiamation of the variance, det(c A) = c^n det(A), A is in n x n shape;
-		# then log det(c A) = n log(c) + log det(A).
-		# appro_var = appro_var / n_points, we do not divide the appro_var by number of points here,
-		# and the purpose is to avoid underflow issue.
-		# If A = A^T, A^-1 = (A^-1)^T.
-		appro_var = la_cov - torch.matmul(la_pr_cov.matmul(pr_cov_inv), la_pr_cov.transpose(-2, -1))
-		#appro_var = la_cov - torch.chain_matmul(la_pr_cov, pr_cov_inv, la_pr_cov.transpose(-2, -1))
-		#appro_var = torch.div(appro_var, n_points.type_as(appro_var)) + diag_matrix.type_as(appro_var) * 1e-6
-
-		# The lower bound. If A is nonsingular, ln( det(A) ) = Tr( ln(A) ).
-		rmi_now = 0.5 * rmi_utils.log_det_by_cholesky(appro_var + diag_matrix.type_as(appro_var) * _POS_ALPHA)
-		#rmi_now = 0.5 * torch.logdet(appro_var + diag_matrix.type_as(appro_var) * _POS_ALPHA)
+		# the covariances, inverse and cholesky log det in float64 (on any device),
+		# outside of autocast, which would run the matmuls in half precision
+		with full_precision(probs_4D.device):
+			la_vectors = la_vectors.view([n, c, self.half_d, -1]).double().requires_grad_(False)
+			pr_vectors = pr_vectors.view([n, c, self.half_d, -1]).double()
+
+			# small diagonal matrix, shape = [1, 1, radius * radius, radius * radius]
+			diag_matrix = torch.eye(self.half_d).unsqueeze(dim=0).unsqueeze(dim=0)
+
+			# the mean and covariance of these high dimension points
+			# Var(X) = E(X^2) - E(X) E(X), N * Var(X) = X^2 - X E(X)
+			la_vectors = la_vectors - la_vectors.mean(dim=3, keepdim=True)
+			la_cov = torch.matmul(la_vectors, la_vectors.transpose(2, 3))
+
+			pr_vectors = pr_vectors - pr_vectors.mean(dim=3, keepdim=True)
+			pr_cov = torch.matmul(pr_vectors, pr_vectors.transpose(2, 3))
+			# https://github.com/pytorch/pytorch/issues/7500
+			# waiting for batched torch.cholesky_inverse()
+			pr_cov_inv = torch.inverse(pr_cov + diag_matrix.type_as(pr_cov) * _POS_ALPHA)
+			# if the dimension of the point is less than 9, you can use the below function
+			# to acceleration computational speed.
+			#pr_cov_inv = utils.batch_cholesky_inverse(pr_cov + diag_matrix.type_as(pr_cov) * _POS_ALPHA)
+
+			la_pr_cov = torch.matmul(la_vectors, pr_vectors.transpose(2, 3))
+			# the approxiamation of the variance, det(c A) = c^n det(A), A is in n x n shape;
+			# then log det(c A) = n log(c) + log det(A).
+			# appro_var = appro_var / n_points, we do not divide the appro_var by number of points here,
+			# and the purpose is to avoid underflow issue.
+			# If A = A^T, A^-1 = (A^-1)^T.
+			appro_var = la_cov - torch.matmul(la_pr_cov.matmul(pr_cov_inv), la_pr_cov.transpose(-2, -1))
+			#appro_var = la_cov - torch.chain_matmul(la_pr_cov, pr_cov_inv, la_pr_cov.transpose(-2, -1))
+			#appro_var = torch.div(appro_var, n_points.type_as(appro_var)) + diag_matrix.type_as(appro_var) * 1e-6
+
+			# The lower bound. If A is nonsingular, ln( det(A) ) = Tr( ln(A) ).
+			rmi_now = 0.5 * rmi_utils.log_det_by_cholesky(appro_var + diag_matrix.type_as(appro_var) * _POS_ALPHA)
+			#rmi_now = 0.5 * torch.logdet(appro_var + diag_matrix.type_as(appro_var) * _POS_ALPHA)
 
 		# mean over N samples. sum over classes.
 		rmi_per_class = rmi_now.view([-1, self.num_classes]).mean(dim=0).float()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# This file is covered by the LICENSE file in the root of this project.
+
+import contextlib
+
+import torch
+
+# compute types of the forward passes and losses, "fp32" is autocast off
+PRECISIONS = {"fp32": None, "fp16": torch.float16, "bf16": torch.bfloat16}
+
+
+def full_precision(device):
+    """ Region where autocast is off (numerically touchy parts of a loss run
+        in the types of their inputs), nothing with a torch without autocast
+    """
+    if not hasattr(torch, "autocast"):
+        return contextlib.ExitStack()
+    return torch.autocast(device.type, enabled=False)
+
+
+class Precision:
+    """Mixed precision (autocast) of the forward passes and losses.
+
+    fp16 is cuda only and scales the losses so small gradients don't flush
+    to zero, bf16 has the range of fp32 and runs on cuda and cpu without
+    scaling. Needs torch >= 1.10 when not fp32.
+    """
+
+    def __init__(self, precision, device):
+        if precision not in PRECISIONS:
+            raise ValueError("Unknown precision {}, choose one of {}".format(
+                precision, list(PRECISIONS)))
+        self.precision = precision
+        self.dtype = PRECISIONS[precision]
+        self.device = torch.device(device)
+        if self.dtype == torch.float16 and self.device.type != "cuda":
+            raise ValueError("fp16 needs cuda, use bf16 on the cpu")
+        # one loss scaler per optimizer, so an overflow in the gradients of
+        # one model (the discriminator) doesn't back off the scale of another
+        self.scalers = {}
+
+    @property
+    def enabled(self):
+        return self.dtype is not None
+
+    def autocast(self):
+        if not self.enabled:
+            return contextlib.ExitStack()
+        return torch.autocast(self.device.type, dtype=self.dtype)
+
+    def scaler(self, optimizer=None):
+        """ The loss scaler of optimizer, None when not fp16 """
+        if self.dtype != torch.float16:
+            return None
+        if optimizer not in self.scalers:
+            self.scalers[optimizer] = torch.cuda.amp.GradScaler()
+        return self.scalers[optimizer]
+
+    def backward(self, loss, optimizer=None):
+        scaler = self.scaler(optimizer)
+        if scaler is None:
+            loss.backward()
+        else:
+            scaler.scale(loss).backward()
+
+    def step(self, loss, optimizer):
+        """ loss.backward() and optimizer.step(), with loss scaling for fp16
+            (the step is skipped when the scaled gradients overflowed). The
+            scale of the optimizer is updated after each of its steps, the
+            generator steps twice an iteration so its scaler sees both.
+        """
+        self.backward(loss, optimizer)
+        scaler = self.scaler(optimizer)
+        if scaler is None:
+            optimizer.step()
+        else:
+            scaler.step(optimizer)
+            scaler.update()
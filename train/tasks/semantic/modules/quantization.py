@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# This file is covered by the LICENSE file in the root of this project.
+
+import copy
+import time
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from tasks.semantic.modules.ioueval import iouEval
+
+# extra file of the saved int8 model with the quantized engine it was packed
+# for (fbgemm/x86 on intel and amd, qnnpack on arm), set again when loading
+ENGINE_FILE = "quantized_engine"
+
+
+def default_engine():
+    engines = torch.backends.quantized.supported_engines
+    for engine in ("x86", "fbgemm", "qnnpack"):
+        if engine in engines:
+            return engine
+    raise RuntimeError("This torch build has no quantized engine")
+
+
+def qconfig_mapping(engine, qat=False):
+    """ Default int8 qconfigs of the engine, with the softmax left in fp32
+        (quantized to 1/256 steps the small probabilities become 0, which the
+        log of the losses doesn't take well)
+    """
+    from torch.ao.quantization import (get_default_qconfig_mapping,
+                                       get_default_qat_qconfig_mapping)
+
+    if qat:
+        mapping = get_default_qat_qconfig_mapping(engine)
+    else:
+        mapping = get_default_qconfig_mapping(engine)
+    return mapping.set_object_type(F.softmax, None)
+
+
+def prepare(model, example, engine=None):
+    """ Copy of the fp32 model (or of the one in a DataParallel) with
+        observers on the activations, to be calibrated by running scans
+        through it. Post-training static quantization with FX, per channel
+        weights and per tensor activations (needs torch >= 1.13).
+    """
+    from torch.ao.quantization.quantize_fx import prepare_fx
+
+    engine = engine or default_engine()
+    torch.backends.quantized.engine = engine
+    if isinstance(model, nn.DataParallel):
+        model = model.module
+    model = copy.deepcopy(model).cpu().eval()
+    return prepare_fx(model, qconfig_mapping(engine), (example,))
+
+
+def prepare_qat(model, example, engine=None):
+    """ The model (or the one in a DataParallel) with fake quantization of
+        the weights and activations, for quantization aware training. Not a
+        copy: the convs and linears are swapped for QAT ones that keep the
+        same parameters, so an optimizer of the model still updates them.
+        Nothing is fused: SalsaNext runs conv -> LeakyReLU -> BN, which is no
+        pattern of the FX fuser, so the BNs stay standalone ops.
+    """
+    from torch.ao.quantization.quantize_fx import prepare_qat_fx
+
+    engine = engine or default_engine()
+    torch.backends.quantized.engine = engine
+    if isinstance(model, nn.DataParallel):
+        model = model.module
+    return prepare_qat_fx(model.train(), qconfig_mapping(engine, qat=True), (example,))
+
+
+def float_state_dict(qat_model, float_model):
+    """ State dict of float_model (the one qat_model was prepared from) with
+        the weights trained with fake quantization, but without the fake
+        quantizers and observers, so it loads in the float network (modules
+        FX left out of the graph, as unused ones, keep their weights)
+    """
+    state = float_model.state_dict()
+    for name, value in qat_model.state_dict().items():
+        if name in state:
+            state[name] = value
+    return state
+
+
+def calibrate(prepared, loader, n_scans):
+    """ Run the first n_scans scans of the loader through the observers """
+    seen = 0
+    with torch.no_grad():
+        for sample in loader:
+            proj_in = sample["proj"][:n_scans - seen]
+            prepared(proj_in)
+            seen += len(proj_in)
+            if seen >= n_scans:
+                break
+    return seen
+
+
+def convert(prepared, example, filename=None):
+    """ int8 model from the calibrated (or QAT) one, which is left as it is,
+        traced to TorchScript (and saved to filename, for the int8 backend of
+        User)
+    """
+    from torch.ao.quantization.quantize_fx import convert_fx
+
+    if isinstance(prepared, nn.DataParallel):
+        prepared = prepared.module
+    quantized = convert_fx(copy.deepcopy(prepared).cpu().eval())
+    with torch.no_grad():
+        traced = torch.jit.trace(quantized, example)
+    if filename is not None:
+        torch.jit.save(traced, filename,
+                       _extra_files={ENGINE_FILE: torch.backends.quantized.engine})
+    return traced
+
+
+def evaluate(model, loader, n_classes, ignore, n_scans=None):
+    """ mIoU and IoU per class of the model on the projections of the loader
+        (as the trainer validates), on cpu, and its mean latency per scan
+    """
+    evaluator = iouEval(n_classes, torch.device("cpu"), ignore)
+    seconds = 0.0
+    seen = 0
+    with torch.no_grad():
+        for sample in loader:
+            proj_in, proj_labels = sample["proj"], sample["proj_labels"].long()
+            if n_scans is not None:
+                proj_in, proj_labels = proj_in[:n_scans - seen], proj_labels[:n_scans - seen]
+            start = time.perf_counter()
+            output = model(proj_in)
+            seconds += time.perf_counter() - start
+            evaluator.addBatch(output.argmax(dim=1), proj_labels)
+            seen += len(proj_in)
+            if n_scans is not None and seen >= n_scans:
+                break
+    miou, iou = evaluator.getIoU()
+    return miou.item(), iou, seconds / max(seen, 1)
+
+
+def load(filename):
+    """ Saved int8 model, with its quantized engine selected """
+    extra = {ENGINE_FILE: ""}
+    model = torch.jit.load(filename, map_location="cpu", _extra_files=extra)
+    engine = extra[ENGINE_FILE]
+    if isinstance(engine, bytes):
+        engine = engine.decode()
+    if engine:
+        torch.backends.quantized.engine = engine
+    return model
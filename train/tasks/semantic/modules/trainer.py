@@ -13,6 +13,7 @@ import torch.optim as optim
 from matplotlib import pyplot as plt
 from torch.autograd import Variable
 from common.avgmeter import *
+from common.augment import BatchAugment
 from common.logger import Logger
 from common.sync_batchnorm.batchnorm import convert_model
 from common.warmupLR import *
@@ -21,6 +22,9 @@ from tasks.semantic.modules.ioueval import *
 from tasks.semantic.modules.SalsaNext import *
 from tasks.semantic.modules.SalsaNextAdf import *
 from tasks.semantic.modules.Lovasz_Softmax import Lovasz_softmax
+from tasks.semantic.modules.backends import INT8_NAME
+from tasks.semantic.modules import quantization
+from tasks.semantic.modules.precision import Precision
 from tasks.semantic.dataset.kitti.parser import *
 import tasks.semantic.modules.adf as adf
 
@@ -721,6 +725,46 @@ class Trainer():
                      "best_train_iou": 0,
                      "best_val_iou": 0}
 
+        # projection cache for the splits that are not augmented
+        cache_dir = None
+        cache_cfg = self.ARCH["dataset"].get("proj_cache", {})
+        if cache_cfg.get("use", False):
+            cache_dir = cache_cfg["path"]
+
+        # draw the train scans with rare classes more often
+        rare_sampling_cfg = self.ARCH["train"].get("rare_sampling", {})
+        rare_classes = None
+        if rare_sampling_cfg.get("use", False):
+            rare_classes = rare_sampling_cfg.get("classes", [5, 8, 12])
+
+        # augmentations of whole batches, after collate, instead of (or on
+        # top of) the ones of each scan in the dataloader workers
+        self.batch_augment = None
+        batch_augment_cfg = self.ARCH["train"].get("batch_augment", {})
+        if batch_augment_cfg.get("use", False):
+            self.batch_augment = BatchAugment(self.ARCH["dataset"]["sensor"]["img_means"],
+                                              self.ARCH["dataset"]["sensor"]["img_stds"],
+                                              flip=batch_augment_cfg.get("flip", 0.0),
+                                              roll=batch_augment_cfg.get("roll", 0.0),
+                                              rotate=batch_augment_cfg.get("rotate", 0.0))
+
+        # packed sequence shards instead of one file per scan
+        shard_dir = None
+        shard_cfg = self.ARCH["dataset"].get("shards", {})
+        if shard_cfg.get("use", False):
+            shard_dir = shard_cfg["path"]
+
+        # local copy of the scans read from the dataset storage
+        staging_dir = None
+        staging_cfg = self.ARCH["dataset"].get("staging", {})
+        if staging_cfg.get("use", False):
+            staging_dir = staging_cfg["path"]
+
+        # fields the train and valid loops use (the rest is never built)
+        fields = ["proj", "proj_mask", "proj_labels", "path_seq", "path_name"]
+        if self.ARCH["train"]["save_bins"]:
+            fields += ["proj_xyz", "proj_remission"]
+
         # get the data
         parserModule = imp.load_source("parserModule",
                                        booger.TRAIN_PATH + '/tasks/semantic/dataset/' +
@@ -739,7 +783,24 @@ class Trainer():
                                           workers=self.ARCH["train"]["workers"],
                                           gt=True,
                                           # 想要在 show_scan=True 時看到連續畫面，就把這邊改False即可
-                                          shuffle_train=True)
+                                          shuffle_train=True,
+                                          cache_dir=cache_dir,
+                                          shard_dir=shard_dir,
+                                          point_batching=self.ARCH["dataset"].get("point_batching", "padded"),
+                                          fields=fields,
+                                          bucket_batches=self.ARCH["dataset"].get("bucket_batches", False),
+                                          rare_classes=rare_classes,
+                                          rare_weight=rare_sampling_cfg.get("weight", 2.0),
+                                          aug_seed=self.ARCH["train"].get("aug_seed", None),
+                                          augment_train=batch_augment_cfg.get("workers", True),
+                                          loader=self.ARCH["dataset"].get("loader", "process"),
+                                          prefetch=self.ARCH["dataset"].get("prefetch", 2),
+                                          staging_dir=staging_dir,
+                                          staging_budget=int(staging_cfg.get("budget_gb", 16) * 2 ** 30),
+                                          staging_prefetch=staging_cfg.get("prefetch", 8),
+                                          block_shuffle=self.ARCH["dataset"].get("block_shuffle", 1))
+
+        self.set_train_modes(parserModule)
 
         # weights for loss (and bias)
 
@@ -777,6 +838,11 @@ class Trainer():
             self.model.cuda()
 
 
+        # mixed precision of the forward passes and losses
+        self.precision = Precision(self.ARCH["train"].get("precision", "fp32"), self.device)
+        if self.qat is not None and self.precision.enabled:
+            raise ValueError("Quantization aware training runs in fp32, set train.precision to fp32")
+
         self.discriminator = Discriminator().to(self.device)
         # loss function
         # class_criterion = nn.CrossEntropyLoss()
@@ -817,6 +883,13 @@ class Trainer():
                                 map_location=lambda storage, loc: storage)
             self.discriminator.load_state_dict(torch.load(path + "/SalsaNext_valid_best_D"))
             self.model.load_state_dict(w_dict['state_dict'], strict=True)
+            # checkpoints are of the float network, the fake quantization of
+            # the QAT epochs (observed ranges) is in SalsaNext_qat
+            if self.qat is not None and w_dict['epoch'] + 1 > self.qat_start:
+                self.start_qat()
+                qat_dict = torch.load(path + "/SalsaNext_qat",
+                                      map_location=lambda storage, loc: storage)
+                self.model.load_state_dict(qat_dict['state_dict'], strict=True)
             self.optimizer.load_state_dict(w_dict['optimizer'])
             self.epoch = w_dict['epoch'] + 1
             self.scheduler.load_state_dict(w_dict['scheduler'])
@@ -825,6 +898,53 @@ class Trainer():
             print("info", w_dict['info'])
 
 
+    def set_train_modes(self, parserModule):
+        # add flipped copies of the scans with rare classes to train batches
+        self.rare_flip = None
+        rare_flip_cfg = self.ARCH["train"].get("rare_flip", {})
+        if rare_flip_cfg.get("use", False):
+            self.rare_flip = rare_flip_cfg
+            self.flip_rare_classes = parserModule.flip_rare_classes
+
+        # quantization aware training for the last epochs (None = off)
+        self.qat = None
+        self.qat_active = False
+        qat_cfg = self.ARCH["train"].get("qat", {})
+        if qat_cfg.get("use", False):
+            self.qat = qat_cfg
+            self.qat_start = self.ARCH["train"]["max_epochs"] - qat_cfg.get("epochs", 5)
+
+    def example_input(self, device):
+        sensor = self.ARCH["dataset"]["sensor"]
+        return torch.zeros(1, 5, sensor["img_prop"]["height"], sensor["img_prop"]["width"],
+                           device=device)
+
+    def start_qat(self):
+        """ Swap the model for its fake quantized version (same parameters,
+            so the optimizer and scheduler carry on)
+        """
+        print("Starting quantization aware training")
+        self.float_model = self.model
+        self.model = nn.DataParallel(quantization.prepare_qat(
+            self.model, self.example_input(self.device), self.qat.get("engine", None)))
+        self.model_single = self.model
+        self.qat_active = True
+
+    def model_state_dict(self):
+        """ State dict of the float SalsaNext, what User and export.py load,
+            also in the QAT epochs (the fake quantization is left out)
+        """
+        if self.qat_active:
+            return quantization.float_state_dict(self.model, self.float_model)
+        return self.model.state_dict()
+
+    def validate_int8(self, val_loader):
+        """ mIoU of the real int8 model converted from the QAT one, on cpu """
+        quantized = quantization.convert(self.model, self.example_input("cpu"))
+        iou, _, _ = quantization.evaluate(quantized, val_loader, self.parser.get_n_classes(),
+                                          self.ignore_class, self.qat.get("eval_scans", None))
+        return iou
+
     def calculate_estimate(self, epoch, iter):
         estimate = int((self.data_time_t.avg + self.batch_time_t.avg) * \
                        (self.parser.get_train_size() * self.ARCH['train']['max_epochs'] - (
@@ -894,6 +1014,8 @@ class Trainer():
 
         # train for n epochs
         for epoch in range(self.epoch, self.ARCH["train"]["max_epochs"]):
+            if self.qat is not None and not self.qat_active and epoch >= self.qat_start:
+                self.start_qat()
 
             # train for 1 epoch
             acc, iou, loss, update_mean,hetero_l = self.train_epoch(train_loader=self.parser.get_train_set(),
@@ -919,18 +1041,22 @@ class Trainer():
             self.info["train_hetero"] = hetero_l
 
             # remember best iou and save checkpoint
-            state = {'epoch': epoch, 'state_dict': self.model.state_dict(),
+            state = {'epoch': epoch, 'state_dict': self.model_state_dict(),
                      'optimizer': self.optimizer.state_dict(),
                      'info': self.info,
                      'scheduler': self.scheduler.state_dict()
                      }
             save_checkpoint(state, self.log, suffix="")
             save_checkpoint(self.discriminator.state_dict(), self.log, suffix="_D")
+            if self.qat_active:
+                # the fake quantized model, to resume in the QAT epochs
+                save_checkpoint({'epoch': epoch, 'state_dict': self.model.state_dict()},
+                                self.log, suffix="_qat")
 
             if self.info['train_iou'] > self.info['best_train_iou']:
                 print("Best mean iou in training set so far, save model!")
                 self.info['best_train_iou'] = self.info['train_iou']
-                state = {'epoch': epoch, 'state_dict': self.model.state_dict(),
+                state = {'epoch': epoch, 'state_dict': self.model_state_dict(),
                          'optimizer': self.optimizer.state_dict(),
                          'info': self.info,
                          'scheduler': self.scheduler.state_dict()
@@ -959,6 +1085,12 @@ class Trainer():
                 self.info["valid_iou"] = iou
                 self.info['valid_heteros'] = hetero_l
 
+                # valid_iou is the one of the fake quantized model
+                if self.qat_active:
+                    self.info["valid_iou_int8"] = self.validate_int8(self.parser.get_valid_set())
+                    print("Validation set int8 model: IoU avg {:.3f}".format(
+                        self.info["valid_iou_int8"]))
+
             # remember best iou and save checkpoint
             if self.info['valid_iou'] > self.info['best_val_iou']:
                 print("Best mean iou in validation so far, save model!")
@@ -966,7 +1098,7 @@ class Trainer():
                 self.info['best_val_iou'] = self.info['valid_iou']
 
                 # save the weights!
-                state = {'epoch': epoch, 'state_dict': self.model.state_dict(),
+                state = {'epoch': epoch, 'state_dict': self.model_state_dict(),
                          'optimizer': self.optimizer.state_dict(),
                          'info': self.info,
                          'scheduler': self.scheduler.state_dict()
@@ -982,7 +1114,7 @@ class Trainer():
                 print("*" * 80)
 
                 # save the weights!
-                state = {'epoch': epoch, 'state_dict': self.model.state_dict(),
+                state = {'epoch': epoch, 'state_dict': self.model_state_dict(),
                          'optimizer': self.optimizer.state_dict(),
                          'info': self.info,
                          'scheduler': self.scheduler.state_dict()
@@ -1002,6 +1134,12 @@ class Trainer():
                                 img_summary=self.ARCH["train"]["save_scans"],
                                 imgs=rand_img)
 
+        # the real int8 model, for User (infer.py --backend int8)
+        if self.qat_active:
+            filename = os.path.join(self.log, INT8_NAME)
+            quantization.convert(self.model, self.example_input("cpu"), filename)
+            print("Saved the int8 model to", filename)
+
         print('Finished Training')
 
         return
@@ -1030,7 +1168,10 @@ class Trainer():
         model.train()
         discriminator.train()
         end = time.time()
-        for i, (in_vol, proj_mask, proj_labels, _, path_seq, path_name, _, _, _, _, proj_xyz, _, proj_remission, _, _) in enumerate(train_loader):
+        for i, sample in enumerate(train_loader):
+            in_vol, proj_mask, proj_labels = sample["proj"], sample["proj_mask"], sample["proj_labels"]
+            path_seq, path_name = sample["path_seq"], sample["path_name"]
+            proj_xyz, proj_remission = sample.get("proj_xyz"), sample.get("proj_remission")
             loss_D, loss_S = 0.0, 0.0
             # measure data loading time
             self.data_time_t.update(time.time() - end)
@@ -1040,6 +1181,18 @@ class Trainer():
             if self.gpu:
                 proj_labels = proj_labels.cuda().long()
 
+            # batched augmentations, where the data is
+            if self.batch_augment is not None:
+                in_vol, proj_mask, proj_labels = self.batch_augment(in_vol, proj_mask, proj_labels)
+
+            # batched flip of the scans with rare classes, where the data is
+            if self.rare_flip is not None:
+                in_vol, proj_mask, proj_labels = self.flip_rare_classes(
+                    in_vol, proj_mask, proj_labels,
+                    classes=self.rare_flip.get("classes", [5, 8, 12]),
+                    max_batch=self.rare_flip.get("max_batch", None),
+                    nclasses=self.parser.get_n_classes())
+
             # compute output
 
             "Generator, output semantic answer"
@@ -1047,9 +1200,10 @@ class Trainer():
             #  Train Generator, 生成假資料
             # ---------------------
             # print("========= Generator start =========")
-            output = model(in_vol)  # output.shape = 2048 x 64 x 20, proj_labels.shape = 2048 x 64
+            with self.precision.autocast():
+                output = model(in_vol)  # output.shape = 2048 x 64 x 20, proj_labels.shape = 2048 x 64
             patch = (1, 64 , 2048)
-            Tensor = torch.cuda.FloatTensor
+            Tensor = torch.cuda.FloatTensor if self.gpu else torch.FloatTensor
             # proj_labels = ground truth
             proj_labels = proj_labels.float()
             proj_labels_dis = proj_labels.unsqueeze(1)
@@ -1060,10 +1214,10 @@ class Trainer():
             semantic_answer = Variable(output.argmax(dim=1).float(), requires_grad=True)
             semantic_answer = semantic_answer.unsqueeze(1)
             # print("semantic_answer.grad: ", semantic_answer.grad)
-            loss_m = criterion(torch.log(output.clamp(min=1e-8)), proj_labels.long()) + self.ls(output, proj_labels.long())
+            with self.precision.autocast():
+                loss_m = criterion(torch.log(output.clamp(min=1e-8)), proj_labels.long()) + self.ls(output, proj_labels.long())
             optimizer.zero_grad()
-            loss_m.backward()
-            optimizer.step()
+            self.precision.step(loss_m, optimizer)
 
             # ---------------------
             #  Train Discriminator, detach 是因為 train discriminator 時，Generator 要固定不變
@@ -1073,20 +1227,21 @@ class Trainer():
             "torch.cat 的內容就是加上 Conditional GAN 的限制條件"
             # fake
             in_vol_cat_fake = torch.cat((in_vol, semantic_answer), 1)   # [2048 x 64 x 6]
-            logit_fake = discriminator(in_vol_cat_fake.detach())              # fake_logit = [1]
-            loss_fake = self.criterion_GAN(logit_fake, fake)
+            with self.precision.autocast():
+                logit_fake = discriminator(in_vol_cat_fake.detach())              # fake_logit = [1]
+                loss_fake = self.criterion_GAN(logit_fake, fake)
 
             # real
             in_vol_cat_real = torch.cat((in_vol, proj_labels_dis), 1)  # [2048 x 64 x 6]
-            logit_real = discriminator(in_vol_cat_real.detach())            # real_logit = [1]
-            loss_real = self.criterion_GAN(logit_real, valid)
+            with self.precision.autocast():
+                logit_real = discriminator(in_vol_cat_real.detach())            # real_logit = [1]
+                loss_real = self.criterion_GAN(logit_real, valid)
 
             #loss
             loss = (loss_real + loss_fake) / 2
             optimizer_D.zero_grad()
             loss_D += loss.item()
-            loss.backward()
-            optimizer_D.step()
+            self.precision.step(loss, optimizer_D)
 
             # ---------------------
             #  Train Generator (從頭到尾)
@@ -1096,7 +1251,8 @@ class Trainer():
             "Generator, 套入剛剛的 discriminator 並且 loss 加入 GAN LOSS"
 
             # generate
-            output = model(in_vol)  # output.shape = 2048 x 64 x 20, proj_labels.shape = 2048 x 64
+            with self.precision.autocast():
+                output = model(in_vol)  # output.shape = 2048 x 64 x 20, proj_labels.shape = 2048 x 64
 
             # semantic_answer = fake image
             semantic_answer = Variable(output.argmax(dim=1).float(), requires_grad=True)
@@ -1104,12 +1260,12 @@ class Trainer():
             in_vol_cat_fake = torch.cat((in_vol, semantic_answer), 1)   # [2048 x 64 x 6]
 
             # 因為公式是 D(G(z)) ,所以這邊要做 discriminate，這邊不用detach，因為這邊D的過程必須影響G
-            f_logit = discriminator(in_vol_cat_fake)
+            with self.precision.autocast():
+                f_logit = discriminator(in_vol_cat_fake)
 
-            loss_m = criterion(torch.log(output.clamp(min=1e-8)), proj_labels.long()) + self.ls(output, proj_labels.long()) + self.criterion_GAN(f_logit, valid)
+                loss_m = criterion(torch.log(output.clamp(min=1e-8)), proj_labels.long()) + self.ls(output, proj_labels.long()) + self.criterion_GAN(f_logit, valid)
             optimizer.zero_grad()
-            loss_m.backward()
-            optimizer.step()
+            self.precision.step(loss_m, optimizer)
 
 
 # ===============================================================================================================================
@@ -1249,7 +1405,10 @@ class Trainer():
 
         with torch.no_grad():
             end = time.time()
-            for i, (in_vol, proj_mask, proj_labels, _, path_seq, path_name, _, _, _, _, proj_xyz, _, proj_remission, _, _) in enumerate(val_loader):
+            for i, sample in enumerate(val_loader):
+                in_vol, proj_mask, proj_labels = sample["proj"], sample["proj_mask"], sample["proj_labels"]
+                path_seq, path_name = sample["path_seq"], sample["path_name"]
+                proj_xyz, proj_remission = sample.get("proj_xyz"), sample.get("proj_remission")
                 if not self.multi_gpu and self.gpu:
                     in_vol = in_vol.cuda()
                     proj_mask = proj_mask.cuda()
@@ -1257,11 +1416,12 @@ class Trainer():
                     proj_labels = proj_labels.cuda(non_blocking=True).long()
 
                 # compute output
-                output = model(in_vol)
-                log_out = torch.log(output.clamp(min=1e-8))
-                jacc = self.ls(output, proj_labels)
-                wce = criterion(log_out, proj_labels)
-                loss = wce + jacc
+                with self.precision.autocast():
+                    output = model(in_vol)
+                    log_out = torch.log(output.clamp(min=1e-8))
+                    jacc = self.ls(output, proj_labels)
+                    wce = criterion(log_out, proj_labels)
+                    loss = wce + jacc
 
                 # measure accuracy and record loss
                 argmax = output.argmax(dim=1)
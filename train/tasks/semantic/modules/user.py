@@ -18,11 +18,15 @@ import numpy as np
 
 from tasks.semantic.modules.SalsaNext import *
 #from tasks.semantic.modules.SalsaNextUncertainty import *
-from tasks.semantic.postproc.KNN import KNN
+from tasks.semantic.postproc.KNN import KNN, batch_index
+from tasks.semantic.modules.deploy import deploy
+from tasks.semantic.modules.backends import BACKENDS, CPU_BACKENDS, load_exported
+from tasks.semantic.modules.precision import Precision
 
 
 class User():
-  def __init__(self, ARCH, DATA, datadir, logdir, modeldir,split,uncertainty,mc=30):
+  def __init__(self, ARCH, DATA, datadir, logdir, modeldir,split,uncertainty,mc=30,
+               backend="eager"):
     # parameters
     self.ARCH = ARCH
     self.DATA = DATA
@@ -32,6 +36,33 @@ class User():
     self.uncertainty = uncertainty
     self.split = split
     self.mc = mc
+    if backend not in BACKENDS:
+      raise ValueError("Unknown backend {}, choose one of {}".format(backend, BACKENDS))
+    if backend != "eager" and uncertainty:
+      raise ValueError("The uncertainty model only runs with the eager backend")
+    self.backend = backend
+
+    # projection cache for the splits that are not augmented
+    cache_dir = None
+    cache_cfg = self.ARCH["dataset"].get("proj_cache", {})
+    if cache_cfg.get("use", False):
+      cache_dir = cache_cfg["path"]
+
+    # packed sequence shards instead of one file per scan
+    shard_dir = None
+    shard_cfg = self.ARCH["dataset"].get("shards", {})
+    if shard_cfg.get("use", False):
+      shard_dir = shard_cfg["path"]
+
+    # scans per batch, their points are packed (no padding) and split back
+    # with the offsets. The uncertainty model only handles one scan
+    batch_size = self.ARCH.get("infer", {}).get("batch_size", 1)
+    if self.uncertainty:
+      batch_size = 1
+
+    # fields infer_subset uses (the rest is never built)
+    fields = ["proj", "path_seq", "path_name", "proj_x", "proj_y",
+              "proj_range", "unproj_range", "unproj_n_points"]
 
     # get the data
     parserModule = imp.load_source("parserModule",
@@ -47,10 +78,17 @@ class User():
                                       learning_map_inv=self.DATA["learning_map_inv"],
                                       sensor=self.ARCH["dataset"]["sensor"],
                                       max_points=self.ARCH["dataset"]["max_points"],
-                                      batch_size=1,
+                                      batch_size=batch_size,
                                       workers=self.ARCH["train"]["workers"],
                                       gt=True,
-                                      shuffle_train=False)
+                                      shuffle_train=False,
+                                      cache_dir=cache_dir,
+                                      shard_dir=shard_dir,
+                                      point_batching="packed",
+                                      drop_last=False,
+                                      fields=fields,
+                                      loader=self.ARCH["dataset"].get("loader", "process"),
+                                      prefetch=self.ARCH["dataset"].get("prefetch", 2))
 
     # concatenate the encoder and the head
     with torch.no_grad():
@@ -61,6 +99,9 @@ class User():
             w_dict = torch.load(modeldir + "/SalsaNext",
                                 map_location=lambda storage, loc: storage)
             self.model.load_state_dict(w_dict['state_dict'], strict=True)
+        elif self.backend != "eager":
+            # exported by export.py (already folded if fold_bn was set)
+            self.model = load_exported(self.backend, modeldir)
         else:
             self.model = SalsaNext(self.parser.get_n_classes())
             # 遇到平行化(一堆.module報錯)的問題時，註解下面那行
@@ -68,6 +109,9 @@ class User():
             w_dict = torch.load(modeldir + "/SalsaNext_valid_best",
                                 map_location=lambda storage, loc: storage)
             self.model.load_state_dict(w_dict['state_dict'], strict=True)
+            # fold the batchnorms, they are constant at inference
+            if self.ARCH.get("infer", {}).get("fold_bn", False):
+                self.model = deploy(self.model)
 
     # use knn post processing?
     self.post = None
@@ -78,14 +122,21 @@ class User():
     # GPU?
     self.gpu = False
     self.model_single = self.model
-    self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    use_gpu = torch.cuda.is_available() and self.backend not in CPU_BACKENDS
+    self.device = torch.device("cuda" if use_gpu else "cpu")
     print("Infering in device: ", self.device)
-    if torch.cuda.is_available() and torch.cuda.device_count() > 0:
+    if use_gpu and torch.cuda.device_count() > 0:
       cudnn.benchmark = True
       cudnn.fastest = True
       self.gpu = True
       self.model.cuda()
 
+    # mixed precision of the network (eager only, the exported ones have theirs)
+    precision = self.ARCH.get("infer", {}).get("precision", "fp32")
+    if precision != "fp32" and (self.backend != "eager" or self.uncertainty):
+      raise ValueError("infer.precision {} needs the eager backend".format(precision))
+    self.precision = Precision(precision, self.device)
+
   def infer(self):
     cnn = []
     knn = []
@@ -130,15 +181,14 @@ class User():
     with torch.no_grad():
       end = time.time()
 
-      for i, (proj_in, proj_mask, _, _, path_seq, path_name, p_x, p_y, proj_range, unproj_range, _, _, _, _, npoints) in enumerate(loader):
-        # first cut to rela size (batch size one allows it)
-        p_x = p_x[0, :npoints]
-        p_y = p_y[0, :npoints]
-        proj_range = proj_range[0, :npoints]
-        unproj_range = unproj_range[0, :npoints]
-        path_seq = path_seq[0]
-        path_name = path_name[0]
-
+      for i, sample in enumerate(loader):
+        proj_in = sample["proj"]
+        path_seq, path_name = sample["path_seq"], sample["path_name"]
+        p_x, p_y = sample["proj_x"], sample["proj_y"]
+        proj_range, unproj_range = sample["proj_range"], sample["unproj_range"]
+        # points of all the scans in the batch come concatenated, scan b has
+        # points offsets[b]:offsets[b+1]
+        offsets = sample["unproj_n_points"]
         if self.gpu:
           proj_in = proj_in.cuda()
           p_x = p_x.cuda()
@@ -146,6 +196,7 @@ class User():
           if self.post:
             proj_range = proj_range.cuda()
             unproj_range = unproj_range.cuda()
+            offsets = offsets.cuda()
 
         #compute output
         if self.uncertainty:
@@ -158,13 +209,16 @@ class User():
             log_var2, proj_output2 = self.model(proj_in)
             proj_output = proj_output_r.var(dim=0, keepdim=True).mean(dim=1)
             log_var2 = log_var_r.var(dim=0, keepdim=True).mean(dim=1)
+            path_seq = path_seq[0]
+            path_name = path_name[0]
             if self.post:
                 # knn postproc
                 unproj_argmax = self.post(proj_range,
                                           unproj_range,
                                           proj_argmax,
                                           p_x,
-                                          p_y)
+                                          p_y,
+                                          offsets)
             else:
                 # put in original pointcloud using indexes
                 unproj_argmax = proj_argmax[p_y, p_x]
@@ -223,8 +277,9 @@ class User():
 
             print(total_time / total_frames)
         else:
-            proj_output = self.model(proj_in)
-            proj_argmax = proj_output[0].argmax(dim=0)
+            with self.precision.autocast():
+                proj_output = self.model(proj_in)
+            proj_argmax = proj_output.argmax(dim=1)
             if torch.cuda.is_available():
                 torch.cuda.synchronize()
             res = time.time() - end
@@ -247,10 +302,11 @@ class User():
                                           unproj_range,
                                           proj_argmax,
                                           p_x,
-                                          p_y)
+                                          p_y,
+                                          offsets)
             else:
                 # put in original pointcloud using indexes
-                unproj_argmax = proj_argmax[p_y, p_x]
+                unproj_argmax = proj_argmax[batch_index(offsets.to(p_x.device)), p_y, p_x]
 
             # measure elapsed time
             if torch.cuda.is_available():
@@ -261,15 +317,17 @@ class User():
             knn.append(res)
             end = time.time()
 
-            # save scan
-            # get the first scan in batch and project scan
+            # save scans
+            # get the points of all scans in batch
             pred_np = unproj_argmax.cpu().numpy()
             pred_np = pred_np.reshape((-1)).astype(np.int32)
 
             # map to original label
             pred_np = to_orig_fn(pred_np)
 
-            # save scan
-            path = os.path.join(self.logdir, "sequences",
-                                path_seq, "predictions", path_name)
-            pred_np.tofile(path)
+            # save each scan
+            offsets = offsets.cpu().numpy()
+            for b in range(len(path_name)):
+                path = os.path.join(self.logdir, "sequences",
+                                    path_seq[b], "predictions", path_name[b])
+                pred_np[offsets[b]:offsets[b + 1]].tofile(path)
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# This file is covered by the LICENSE file in the root of this project.
+
+import argparse
+import os
+import __init__ as booger
+
+from common.qbin import QBIN_EXTENSION
+from common.shards import pack_sequence, SHARD_EXTENSION
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser("./pack_shards.py")
+    parser.add_argument(
+        '--dataset', '-d',
+        type=str,
+        required=True,
+        help='Dataset to pack. No Default',
+    )
+    parser.add_argument(
+        '--output', '-o',
+        type=str,
+        required=False,
+        default=None,
+        help='Directory to write one shard per sequence to. '
+             'Defaults to DATASET/shards',
+    )
+    parser.add_argument(
+        '--sequences', '-s',
+        type=int,
+        nargs='+',
+        required=False,
+        default=None,
+        help='Sequences to pack. Defaults to all in the dataset',
+    )
+    FLAGS, unparsed = parser.parse_known_args()
+    if FLAGS.output is None:
+        FLAGS.output = os.path.join(FLAGS.dataset, "shards")
+
+    # print summary of what we will do
+    print("*" * 80)
+    print("INTERFACE:")
+    print("Dataset: ", FLAGS.dataset)
+    print("Output: ", FLAGS.output)
+    print("Sequences: ", FLAGS.sequences)
+    print("*" * 80)
+
+    root = os.path.join(FLAGS.dataset, "sequences")
+    if FLAGS.sequences is None:
+        sequences = sorted(s for s in os.listdir(root) if s.isdigit())
+    else:
+        sequences = ['{0:02d}'.format(s) for s in FLAGS.sequences]
+    os.makedirs(FLAGS.output, exist_ok=True)
+
+    for seq in sequences:
+        scan_path = os.path.join(root, seq, "velodyne")
+        label_path = os.path.join(root, seq, "labels")
+        scan_files = sorted(os.path.join(scan_path, f)
+                            for f in os.listdir(scan_path)
+                            if f.endswith((".bin", QBIN_EXTENSION)))
+        label_files = []
+        if os.path.isdir(label_path):
+            label_files = sorted(os.path.join(label_path, f)
+                                 for f in os.listdir(label_path) if f.endswith(".label"))
+        out_file = os.path.join(FLAGS.output, seq + SHARD_EXTENSION)
+        frames, points = pack_sequence(scan_files, label_files, out_file)
+        print("Packed seq {} ({} frames, {} points, labels: {}) in {}".format(
+            seq, frames, points, bool(label_files), out_file))
@@ -33,6 +33,15 @@ def get_gaussian_kernel(kernel_size=3, sigma=2, channels=1):
     return gaussian_kernel
 
 
+def batch_index(offsets):
+    """ [N] scan in the batch of each point, from the [B+1] offsets of the
+        scans in the concatenated points (see packed_collate in the parser)
+    """
+    counts = offsets[1:] - offsets[:-1]
+    return torch.repeat_interleave(
+        torch.arange(counts.shape[0], device=offsets.device), counts)
+
+
 class KNN(nn.Module):
     def __init__(self, params, nclasses):
         super().__init__()
@@ -51,10 +60,10 @@ class KNN(nn.Module):
         print("nclasses:", self.nclasses)
         print("*" * 80)
 
-    def forward(self, proj_range, unproj_range, proj_argmax, px, py):
-        ''' Warning! Only works for un-batched pointclouds.
-            If they come batched we need to iterate over the batch dimension or do
-            something REALLY smart to handle unaligned number of points in memory
+    def forward(self, proj_range, unproj_range, proj_argmax, px, py, offsets=None):
+        ''' Works on one pointcloud ([H,W] images and its points), or on a batch
+            ([B,H,W] images) with the points of all the scans concatenated and
+            their [B+1] offsets (scan b has points offsets[b]:offsets[b+1])
         '''
         # get device
         if proj_range.is_cuda:
@@ -62,8 +71,13 @@ class KNN(nn.Module):
         else:
             device = torch.device("cpu")
 
+        # un-batched pointcloud is a batch of one
+        if proj_range.dim() == 2:
+            proj_range = proj_range[None, ...]
+            proj_argmax = proj_argmax[None, ...]
+
         # sizes of projection scan
-        H, W = proj_range.shape
+        B, H, W = proj_range.shape
 
         # number of points
         P = unproj_range.shape
@@ -76,12 +90,16 @@ class KNN(nn.Module):
         pad = int((self.search - 1) / 2)
 
         # unfold neighborhood to get nearest neighbors for each pixel (range image)
-        proj_unfold_k_rang = F.unfold(proj_range[None, None, ...],
+        proj_unfold_k_rang = F.unfold(proj_range[:, None, ...],
                                       kernel_size=(self.search, self.search),
                                       padding=(pad, pad))
+        proj_unfold_k_rang = self.flatten_batch(proj_unfold_k_rang)
 
-        # index with px, py to get ALL the pcld points
+        # index with px, py to get ALL the pcld points (and the scan they
+        # come from, the images of the batch are now side by side)
         idx_list = py * W + px
+        if offsets is not None:
+            idx_list = idx_list + batch_index(offsets) * (H * W)
         unproj_unfold_k_rang = proj_unfold_k_rang[:, :, idx_list]
 
         # WARNING, THIS IS A HACK
@@ -111,9 +129,10 @@ class KNN(nn.Module):
             self.knn, dim=1, largest=False, sorted=False)
 
         # do the same unfolding with the argmax
-        proj_unfold_1_argmax = F.unfold(proj_argmax[None, None, ...].float(),
+        proj_unfold_1_argmax = F.unfold(proj_argmax[:, None, ...].float(),
                                         kernel_size=(self.search, self.search),
                                         padding=(pad, pad)).long()
+        proj_unfold_1_argmax = self.flatten_batch(proj_unfold_1_argmax)
         unproj_unfold_1_argmax = proj_unfold_1_argmax[:, :, idx_list]
 
         # get the top k predictions from the knn at each pixel
@@ -140,3 +159,9 @@ class KNN(nn.Module):
         knn_argmax_out = knn_argmax_out.view(P)
 
         return knn_argmax_out
+
+    def flatten_batch(self, unfolded):
+        """ [B, k*k, H*W] unfolded images to [1, k*k, B*H*W] """
+        if unfolded.shape[0] == 1:
+            return unfolded
+        return unfolded.permute(1, 0, 2).reshape(1, unfolded.shape[1], -1)
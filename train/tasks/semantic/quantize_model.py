@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# This file is covered by the LICENSE file in the root of this project.
+
+import argparse
+import os
+import yaml
+import torch
+import __init__ as booger
+
+from tasks.semantic.dataset.kitti.parser import Parser
+from tasks.semantic.modules.SalsaNext import SalsaNext
+from tasks.semantic.modules.backends import INT8_NAME
+from tasks.semantic.modules import quantization
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser("./quantize_model.py")
+    parser.add_argument(
+        '--dataset', '-d',
+        type=str,
+        required=True,
+        help='Dataset to calibrate and evaluate on (the valid split). No Default',
+    )
+    parser.add_argument(
+        '--model', '-m',
+        type=str,
+        required=True,
+        help='Directory of the trained model, the int8 model is written next to it. '
+             'No Default',
+    )
+    parser.add_argument(
+        '--calibration', '-c',
+        type=int,
+        required=False,
+        default=300,
+        help='Valid scans to calibrate the activation ranges with. Defaults to %(default)s',
+    )
+    parser.add_argument(
+        '--eval_scans', '-e',
+        type=int,
+        required=False,
+        default=None,
+        help='Valid scans of the fp32/int8 report. Defaults to all of them',
+    )
+    parser.add_argument(
+        '--engine',
+        type=str,
+        required=False,
+        default=None,
+        choices=torch.backends.quantized.supported_engines,
+        help='Quantized engine of the cpu it runs on. Defaults to x86/fbgemm, '
+             'else qnnpack (arm)',
+    )
+    parser.add_argument(
+        '--threads', '-t',
+        type=int,
+        required=False,
+        default=None,
+        help='Cpu threads of the latency report. Defaults to torch default',
+    )
+    FLAGS, unparsed = parser.parse_known_args()
+
+    # print summary of what we will do
+    print("*" * 80)
+    print("INTERFACE:")
+    print("Dataset: ", FLAGS.dataset)
+    print("Model: ", FLAGS.model)
+    print("Calibration scans: ", FLAGS.calibration)
+    print("Eval scans: ", FLAGS.eval_scans)
+    print("*" * 80)
+
+    if FLAGS.threads is not None:
+        torch.set_num_threads(FLAGS.threads)
+
+    ARCH = yaml.safe_load(open(os.path.join(FLAGS.model, "arch_cfg.yaml"), 'r'))
+    DATA = yaml.safe_load(open(os.path.join(FLAGS.model, "data_cfg.yaml"), 'r'))
+
+    # one scan per batch, so the latency is per scan
+    data = Parser(root=FLAGS.dataset,
+                  train_sequences=DATA["split"]["train"],
+                  valid_sequences=DATA["split"]["valid"],
+                  test_sequences=None,
+                  labels=DATA["labels"],
+                  color_map=DATA["color_map"],
+                  learning_map=DATA["learning_map"],
+                  learning_map_inv=DATA["learning_map_inv"],
+                  sensor=ARCH["dataset"]["sensor"],
+                  max_points=ARCH["dataset"]["max_points"],
+                  batch_size=1,
+                  workers=ARCH["train"]["workers"],
+                  gt=True,
+                  shuffle_train=False,
+                  drop_last=False,
+                  fields=["proj", "proj_labels"])
+    n_classes = data.get_n_classes()
+    ignore = [c for c, ignored in DATA["learning_ignore"].items() if ignored]
+
+    model = SalsaNext(n_classes)
+    w_dict = torch.load(os.path.join(FLAGS.model, "SalsaNext_valid_best"),
+                        map_location=lambda storage, loc: storage)
+    # checkpoints are saved from the DataParallel model
+    model.load_state_dict({k.replace("module.", "", 1): v
+                           for k, v in w_dict['state_dict'].items()}, strict=True)
+    model.eval()
+
+    sensor = ARCH["dataset"]["sensor"]
+    example = torch.zeros(1, 5, sensor["img_prop"]["height"], sensor["img_prop"]["width"])
+    prepared = quantization.prepare(model, example, FLAGS.engine)
+    seen = quantization.calibrate(prepared, data.get_valid_set(), FLAGS.calibration)
+    print("Calibrated on {} scans ({} engine)".format(seen, torch.backends.quantized.engine))
+    filename = os.path.join(FLAGS.model, INT8_NAME)
+    quantized = quantization.convert(prepared, example, filename)
+    print("Wrote", filename)
+
+    # report, on the same cpu threads
+    results = {}
+    for name, net in (("fp32", model), ("int8", quantized)):
+        results[name] = quantization.evaluate(net, data.get_valid_set(), n_classes, ignore, FLAGS.eval_scans)
+    print("model | mIoU   | ms/scan")
+    for name, (miou, _, latency) in results.items():
+        print("{:5s} | {:6.2%} | {:7.1f}".format(name, miou, latency * 1000))
+    print("int8 speedup {:.2f}x, mIoU {:+.2%}".format(
+        results["fp32"][2] / max(results["int8"][2], 1e-12),
+        results["int8"][0] - results["fp32"][0]))
+    print("class            | fp32 IoU | int8 IoU")
+    for c in range(n_classes):
+        if c in ignore:
+            continue
+        print("{:16s} | {:8.2%} | {:8.2%}".format(
+            data.get_xentropy_class_string(c),
+            results["fp32"][1][c].item(), results["int8"][1][c].item()))
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# This file is covered by the LICENSE file in the root of this project.
+
+import argparse
+import os
+import shutil
+import yaml
+import numpy as np
+import __init__ as booger
+
+from common.laserscan import LaserScan
+from common.qbin import quantize_file, QBIN_EXTENSION
+
+
+def link_or_copy(src, dst):
+    # labels are stored as they are (uint16 semantic + uint16 instance)
+    if os.path.exists(dst):
+        return
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def pixels(scan, points):
+    """ Pixel of each point in the range image of the sensor """
+    scan.set_points(points[:, 0:3], points[:, 3])
+    scan.project_points()
+    return scan.proj_y * scan.proj_W + scan.proj_x
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser("./quantize_scans.py")
+    parser.add_argument(
+        '--dataset', '-d',
+        type=str,
+        required=True,
+        help='Dataset to quantize. No Default',
+    )
+    parser.add_argument(
+        '--output', '-o',
+        type=str,
+        required=True,
+        help='Dataset to write the quantized scans (and the labels) to. No Default',
+    )
+    parser.add_argument(
+        '--sequences', '-s',
+        type=int,
+        nargs='+',
+        required=False,
+        default=None,
+        help='Sequences to quantize. Defaults to all in the dataset',
+    )
+    parser.add_argument(
+        '--arch_cfg', '-ac',
+        type=str,
+        required=False,
+        default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "../../../mambonet.yml"),
+        help='Architecture yaml cfg file, for the sensor of the error report. '
+             'Defaults to %(default)s',
+    )
+    FLAGS, unparsed = parser.parse_known_args()
+
+    # print summary of what we will do
+    print("*" * 80)
+    print("INTERFACE:")
+    print("Dataset: ", FLAGS.dataset)
+    print("Output: ", FLAGS.output)
+    print("Sequences: ", FLAGS.sequences)
+    print("*" * 80)
+
+    sensor = yaml.safe_load(open(FLAGS.arch_cfg, 'r'))["dataset"]["sensor"]
+    scan = LaserScan(project=False,
+                     H=sensor["img_prop"]["height"],
+                     W=sensor["img_prop"]["width"],
+                     fov_up=sensor["fov_up"],
+                     fov_down=sensor["fov_down"])
+
+    root = os.path.join(FLAGS.dataset, "sequences")
+    if FLAGS.sequences is None:
+        sequences = sorted(s for s in os.listdir(root) if s.isdigit())
+    else:
+        sequences = ['{0:02d}'.format(s) for s in FLAGS.sequences]
+
+    print("seq | scans |  bin MB | qbin MB | ratio | xyz err max/mean (mm) | "
+          "remission err max | pixels moved")
+    for seq in sequences:
+        scan_path = os.path.join(root, seq, "velodyne")
+        label_path = os.path.join(root, seq, "labels")
+        out_scan_path = os.path.join(FLAGS.output, "sequences", seq, "velodyne")
+        out_label_path = os.path.join(FLAGS.output, "sequences", seq, "labels")
+        os.makedirs(out_scan_path, exist_ok=True)
+
+        names = sorted(f for f in os.listdir(scan_path) if f.endswith(".bin"))
+        size_in = size_out = 0
+        err_max = err_sum = rem_max = 0.0
+        n_points = moved = 0
+        for name in names:
+            scan_file = os.path.join(scan_path, name)
+            out_file = os.path.join(out_scan_path, os.path.splitext(name)[0] + QBIN_EXTENSION)
+            original, decoded = quantize_file(scan_file, out_file)
+            size_in += os.path.getsize(scan_file)
+            size_out += os.path.getsize(out_file)
+
+            err = np.abs(decoded[:, 0:3] - original[:, 0:3])
+            if len(original):
+                err_max = max(err_max, float(err.max()))
+                rem_max = max(rem_max, float(np.abs(decoded[:, 3] - original[:, 3]).max()))
+            err_sum += float(err.sum())
+            n_points += len(original)
+            # points that land in another pixel of the range image
+            moved += int(np.count_nonzero(pixels(scan, original) != pixels(scan, decoded)))
+
+        if os.path.isdir(label_path):
+            os.makedirs(out_label_path, exist_ok=True)
+            for name in sorted(os.listdir(label_path)):
+                if name.endswith(".label"):
+                    link_or_copy(os.path.join(label_path, name),
+                                 os.path.join(out_label_path, name))
+
+        print("{:>3} | {:5d} | {:7.1f} | {:7.1f} | {:5.2f} | {:9.2f} / {:9.3f} | {:17.4f} | {:11.4%}".format(
+            seq, len(names), size_in / 2 ** 20, size_out / 2 ** 20,
+            size_in / max(size_out, 1), err_max * 1000,
+            err_sum * 1000 / max(3 * n_points, 1), rem_max,
+            moved / max(n_points, 1)))
@@ -8,6 +8,7 @@ import __init__ as booger
 
 from common.laserscan import LaserScan, SemLaserScan
 from common.laserscanvis import LaserScanVis
+from common.manifest import Manifest
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser("./visualize.py")
@@ -102,27 +103,27 @@ if __name__ == '__main__':
         quit()
 
     # populate the pointclouds
-    scan_names = [os.path.join(dp, f) for dp, dn, fn in os.walk(
-        os.path.expanduser(scan_paths)) for f in fn]
-    scan_names.sort()
+    manifest = Manifest(FLAGS.dataset)
+    scan_names = manifest.scans(FLAGS.sequence)
+    manifest.save()
 
     # does sequence folder exist?
     if not FLAGS.ignore_semantics:
         if FLAGS.predictions is not None:
-            label_paths = os.path.join(FLAGS.predictions, "sequences",
-                                       FLAGS.sequence, "predictions")
+            label_root, label_folder = FLAGS.predictions, "predictions"
         else:
-            label_paths = os.path.join(FLAGS.dataset, "sequences",
-                                       FLAGS.sequence, "labels")
+            label_root, label_folder = FLAGS.dataset, "labels"
+        label_paths = os.path.join(label_root, "sequences",
+                                   FLAGS.sequence, label_folder)
         if os.path.isdir(label_paths):
             print("Labels folder exists! Using labels from %s" % label_paths)
         else:
             print("Labels folder doesn't exist! Exiting...")
             quit()
         # populate the pointclouds
-        label_names = [os.path.join(dp, f) for dp, dn, fn in os.walk(
-            os.path.expanduser(label_paths)) for f in fn]
-        label_names.sort()
+        manifest = Manifest(label_root)
+        label_names = manifest.labels(FLAGS.sequence, label_folder)
+        manifest.save()
 
         # check that there are same amount of labels and scans
         if not FLAGS.ignore_safety:
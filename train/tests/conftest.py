@@ -0,0 +1,7 @@
+# This file is covered by the LICENSE file in the root of this project.
+import os
+import sys
+
+# the modules import each other as "common.*" and "tasks.*", from train/
+TRAIN_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, TRAIN_PATH)
@@ -0,0 +1,57 @@
+# This file is covered by the LICENSE file in the root of this project.
+import os
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from common.classindex import ClassIndex
+from common.manifest import Manifest
+
+
+def write_label(folder, frame, label):
+    path = os.path.join(folder, "{:06d}.label".format(frame))
+    tmp = path + ".tmp"
+    np.asarray(label, dtype=np.int32).tofile(tmp)
+    os.replace(tmp, path)
+    return path
+
+
+def histograms(root, lut, reads):
+    manifest = Manifest(root)
+    files = manifest.labels("00")
+    keys = [ClassIndex.key(f, stamp) for f, stamp in zip(files, manifest.stamps("00", "labels", ".label"))]
+
+    def read_label(i):
+        reads.append(i)
+        return np.fromfile(files[i], dtype=np.int32)
+    return ClassIndex(root, lut).histograms(keys, read_label)
+
+
+def test_histograms_from_manifest_stamps(tmp_path):
+    root = str(tmp_path)
+    folder = os.path.join(root, "sequences", "00", "labels")
+    os.makedirs(folder)
+    write_label(folder, 0, [0, 1, 1])
+    write_label(folder, 1, [2, 2, 2, 1])
+    lut = np.array([0, 1, 2], dtype=np.int32)
+
+    reads = []
+    assert histograms(root, lut, reads).tolist() == [[1, 2, 0], [0, 1, 3]]
+    assert reads == [0, 1]
+
+    # indexed: no label read again
+    reads = []
+    assert histograms(root, lut, reads).tolist() == [[1, 2, 0], [0, 1, 3]]
+    assert reads == []
+
+    # a label rewritten in place (same size, the folder doesn't change)
+    folder_mtime = os.stat(folder).st_mtime_ns
+    path = os.path.join(folder, "000001.label")
+    st = os.stat(path)
+    np.array([1, 1, 1, 1], dtype=np.int32).tofile(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+    assert os.stat(folder).st_mtime_ns == folder_mtime
+    reads = []
+    assert histograms(root, lut, reads).tolist() == [[1, 2, 0], [0, 4, 0]]
+    assert reads == [1]
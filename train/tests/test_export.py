@@ -0,0 +1,60 @@
+# This file is covered by the LICENSE file in the root of this project.
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from tasks.semantic.modules.backends import (OnnxModel, export_onnx, export_torchscript,
+                                             load_checkpoint)
+from tasks.semantic.modules.SalsaNext import SalsaNext
+from tasks.semantic.modules.SalsaNext_ASPP import SalsaNext as SalsaNextASPP
+
+
+def save_checkpoint(model, filename):
+    # as the Trainer does, from the DataParallel model
+    torch.save({"state_dict": torch.nn.DataParallel(model).state_dict()}, filename)
+
+
+@pytest.fixture(scope="module")
+def model():
+    torch.manual_seed(0)
+    return SalsaNext(20).eval()
+
+
+def test_load_checkpoint(tmp_path, model):
+    filename = str(tmp_path / "SalsaNext_valid_best")
+    save_checkpoint(model, filename)
+    loaded = load_checkpoint(SalsaNext(20), filename)
+    for name, value in model.state_dict().items():
+        assert torch.equal(loaded.state_dict()[name], value)
+
+
+def test_load_checkpoint_of_another_network(tmp_path):
+    filename = str(tmp_path / "SalsaNext_valid_best")
+    save_checkpoint(SalsaNextASPP(20), filename)
+    with pytest.raises(ValueError, match="not a checkpoint of SalsaNext"):
+        load_checkpoint(SalsaNext(20), filename)
+
+
+def test_export_torchscript(tmp_path, model):
+    x = torch.randn(1, 5, 32, 64)
+    traced = export_torchscript(model, x, str(tmp_path / "SalsaNext.pt"))
+    loaded = torch.jit.load(str(tmp_path / "SalsaNext.pt"))
+    with torch.no_grad():
+        reference = model(x)
+        assert torch.allclose(traced(x), reference, atol=1e-5)
+        assert torch.allclose(loaded(x), reference, atol=1e-5)
+
+
+def test_export_onnx(tmp_path, model):
+    pytest.importorskip("onnx")
+    pytest.importorskip("onnxruntime")
+    filename = str(tmp_path / "SalsaNext.onnx")
+    export_onnx(model, torch.zeros(1, 5, 32, 64), filename)
+    session = OnnxModel(filename)
+    # batch size and width are dynamic
+    x = torch.randn(2, 5, 32, 128)
+    with torch.no_grad():
+        reference = model(x)
+    output = session(x)
+    assert output.shape == reference.shape
+    assert torch.allclose(output, reference, atol=1e-4)
@@ -0,0 +1,50 @@
+# This file is covered by the LICENSE file in the root of this project.
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("scipy")
+
+from common.laserscan import LaserScan
+
+H, W = 16, 64
+
+
+def project(points, remissions, argsort):
+    scan = LaserScan(project=False, H=H, W=W)
+    scan.set_points(points, remissions)
+    if argsort:
+        scan.do_range_projection_argsort()
+    else:
+        scan.do_range_projection()
+    return scan
+
+
+def random_scan(rng, n, duplicated):
+    points = rng.uniform(-20, 20, (n, 3)).astype(np.float32)
+    points[:, 2] = rng.uniform(-3, 0.5, n)
+    remissions = rng.uniform(0, 1, n).astype(np.float32)
+    if duplicated:
+        # exact copies of some points (same depth and pixel), shuffled in
+        copies = rng.randint(0, n, n // 2)
+        points = np.concatenate([points, points[copies]])
+        remissions = np.concatenate([remissions, rng.uniform(0, 1, copies.size).astype(np.float32)])
+        order = rng.permutation(points.shape[0])
+        points, remissions = points[order], remissions[order]
+    return points, remissions
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("duplicated", [False, True])
+def test_range_projection_matches_argsort(seed, duplicated):
+    rng = np.random.RandomState(seed)
+    # a few thousand points on a small image, so pixels get several points
+    points, remissions = random_scan(rng, 3000, duplicated)
+
+    scan = project(points, remissions, argsort=False)
+    reference = project(points, remissions, argsort=True)
+
+    np.testing.assert_array_equal(scan.proj_idx, reference.proj_idx)
+    np.testing.assert_array_equal(scan.proj_mask, reference.proj_mask)
+    np.testing.assert_array_equal(scan.proj_range, reference.proj_range)
+    np.testing.assert_array_equal(scan.proj_xyz, reference.proj_xyz)
+    np.testing.assert_array_equal(scan.proj_remission, reference.proj_remission)
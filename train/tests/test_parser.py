@@ -0,0 +1,61 @@
+# This file is covered by the LICENSE file in the root of this project.
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from tasks.semantic.dataset.kitti.parser import flip_rare_classes
+
+
+def make_batch(B, rare_scans):
+    data = torch.arange(B * 2 * 4 * 6, dtype=torch.float).view(B, 2, 4, 6)
+    mask = torch.ones(B, 4, 6, dtype=torch.int32)
+    labels = torch.ones(B, 4, 6, dtype=torch.long)
+    for b in rare_scans:
+        labels[b, 0, 0] = 8
+    return data, mask, labels
+
+
+def test_flips_scans_with_rare_classes():
+    data, mask, labels = make_batch(4, [1, 3])
+    out, out_mask, out_labels = flip_rare_classes(data, mask, labels)
+    assert out.shape[0] == 6
+    assert torch.equal(out[4], torch.flip(data[1], [2]))
+    assert torch.equal(out[5], torch.flip(data[3], [2]))
+    assert torch.equal(out_labels[5], torch.flip(labels[3], [1]))
+    assert out_mask.shape[0] == 6
+
+
+def test_max_batch_fills_with_flips():
+    data, mask, labels = make_batch(3, [2])
+    out, out_mask, out_labels = flip_rare_classes(data, mask, labels, max_batch=5)
+    assert [out.shape[0], out_mask.shape[0], out_labels.shape[0]] == [5, 5, 5]
+    # the rare scan first, then the others
+    assert torch.equal(out[3], torch.flip(data[2], [2]))
+    assert torch.equal(out[4], torch.flip(data[0], [2]))
+
+
+def test_max_batch_caps_bigger_batches():
+    data, mask, labels = make_batch(6, [0, 5])
+    out, out_mask, out_labels = flip_rare_classes(data, mask, labels, max_batch=4)
+    assert [out.shape[0], out_mask.shape[0], out_labels.shape[0]] == [4, 4, 4]
+    assert torch.equal(out, data[:4])
+
+
+def make_parser(**kwargs):
+    from tasks.semantic.dataset.kitti.parser import Parser
+
+    learning_map = {0: 0, 1: 1}
+    return Parser(root="/nonexistent", train_sequences=[0], valid_sequences=[1],
+                  test_sequences=None, labels={0: "unlabeled", 1: "car"},
+                  color_map={0: [0, 0, 0], 1: [255, 0, 0]}, learning_map=learning_map,
+                  learning_map_inv=learning_map,
+                  sensor={"img_prop": {"height": 4, "width": 6}, "fov_up": 3, "fov_down": -25,
+                          "img_means": [0] * 5, "img_stds": [1] * 5},
+                  max_points=10, batch_size=2, workers=0, **kwargs)
+
+
+def test_bucket_batches_reject_block_shuffle():
+    make_parser(bucket_batches=True)
+    make_parser(block_shuffle=8)
+    with pytest.raises(ValueError, match="block_shuffle"):
+        make_parser(bucket_batches=True, block_shuffle=8)
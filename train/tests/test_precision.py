@@ -0,0 +1,56 @@
+# This file is covered by the LICENSE file in the root of this project.
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from tasks.semantic.modules.precision import Precision
+
+cuda = pytest.mark.skipif(not torch.cuda.is_available(), reason="fp16 needs cuda")
+
+
+def make_model(device):
+    model = torch.nn.Linear(4, 1).to(device)
+    return model, torch.optim.SGD(model.parameters(), lr=0.1)
+
+
+@pytest.mark.parametrize("name", ["fp32", "bf16"])
+def test_step_cpu(name):
+    precision = Precision(name, "cpu")
+    model, optimizer = make_model("cpu")
+    before = model.weight.detach().clone()
+    with precision.autocast():
+        loss = model(torch.ones(2, 4)).float().sum()
+    precision.step(loss, optimizer)
+    assert precision.scaler(optimizer) is None
+    assert not torch.equal(before, model.weight)
+
+
+@cuda
+def test_fp16_scaler_per_optimizer():
+    precision = Precision("fp16", "cuda")
+    generator, optimizer = make_model("cuda")
+    discriminator, optimizer_D = make_model("cuda")
+    x = torch.ones(2, 4, device="cuda")
+
+    for _ in range(3):
+        # generator, discriminator (overflowing), generator again, as train_epoch
+        with precision.autocast():
+            loss = generator(x).float().sum()
+        optimizer.zero_grad()
+        precision.step(loss, optimizer)
+
+        with precision.autocast():
+            loss = discriminator(x).float().sum() * float("inf")
+        optimizer_D.zero_grad()
+        precision.step(loss, optimizer_D)
+
+        with precision.autocast():
+            loss = generator(x).float().sum()
+        optimizer.zero_grad()
+        precision.step(loss, optimizer)
+
+    scale = precision.scaler(optimizer).get_scale()
+    # the discriminator overflows every time and backs off its own scale only
+    assert precision.scaler(optimizer_D).get_scale() == 65536.0 * 0.5 ** 3
+    assert scale == 65536.0
+    assert torch.isfinite(generator.weight).all()
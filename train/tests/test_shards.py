@@ -0,0 +1,55 @@
+# This file is covered by the LICENSE file in the root of this project.
+import os
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from common.qbin import QBIN_EXTENSION, quantize_file
+from common.shards import SequenceShard, pack_sequence
+
+
+def write_frames(folder, n_frames, rng):
+    os.makedirs(folder)
+    scans, labels, scan_files, label_files = [], [], [], []
+    for frame in range(n_frames):
+        scan = rng.uniform(-30, 30, (rng.randint(10, 50), 4)).astype(np.float32)
+        scan[:, 3] = rng.uniform(0, 1, len(scan))
+        label = rng.randint(0, 260, len(scan)).astype(np.int32)
+        scan_files.append(os.path.join(folder, "{:06d}.bin".format(frame)))
+        label_files.append(os.path.join(folder, "{:06d}.label".format(frame)))
+        scan.tofile(scan_files[-1])
+        label.tofile(label_files[-1])
+        scans.append(scan)
+        labels.append(label)
+    return scans, labels, scan_files, label_files
+
+
+@pytest.mark.parametrize("quantized", [False, True])
+def test_pack_sequence(tmp_path, quantized):
+    scans, labels, scan_files, label_files = write_frames(
+        str(tmp_path / "00"), 3, np.random.RandomState(0))
+    if quantized:
+        decoded = []
+        for i, scan_file in enumerate(scan_files):
+            scan_files[i] = os.path.splitext(scan_file)[0] + QBIN_EXTENSION
+            decoded.append(quantize_file(scan_file, scan_files[i])[1])
+        scans = decoded
+
+    out_file = str(tmp_path / "00.shard")
+    frames, points = pack_sequence(scan_files, label_files, out_file)
+    assert (frames, points) == (3, sum(len(scan) for scan in scans))
+
+    shard = SequenceShard(out_file)
+    assert shard.names == ["000000", "000001", "000002"]
+    for i in range(3):
+        np.testing.assert_array_equal(shard.scan(i), scans[i])
+        np.testing.assert_array_equal(shard.label(i), labels[i])
+
+
+def test_pack_sequence_bin_and_qbin_of_a_frame(tmp_path):
+    _, _, scan_files, _ = write_frames(str(tmp_path / "00"), 1, np.random.RandomState(0))
+    qbin_file = os.path.splitext(scan_files[0])[0] + QBIN_EXTENSION
+    quantize_file(scan_files[0], qbin_file)
+    with pytest.raises(ValueError):
+        pack_sequence(scan_files + [qbin_file], [], str(tmp_path / "00.shard"))
@@ -0,0 +1,64 @@
+# This file is covered by the LICENSE file in the root of this project.
+import os
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from common.staging import Staging
+
+
+def write_scan(root, seq, frame, values):
+    folder = os.path.join(root, "sequences", seq, "velodyne")
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, "{:06d}.bin".format(frame))
+    np.asarray(values, dtype=np.uint8).tofile(path)
+    return path
+
+
+def test_changed_file_is_staged_again(tmp_path):
+    root = str(tmp_path / "dataset")
+    path = write_scan(root, "00", 0, [1, 2, 3])
+    staging = Staging(root, str(tmp_path / "staging"), budget=2 ** 20)
+
+    assert staging.fromfile(path, np.uint8).tolist() == [1, 2, 3]
+    assert os.path.exists(staging.local(path))
+
+    write_scan(root, "00", 0, [4, 5, 6, 7])
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+    assert staging.fromfile(path, np.uint8).tolist() == [4, 5, 6, 7]
+    assert np.fromfile(staging.local(path), dtype=np.uint8).tolist() == [4, 5, 6, 7]
+    assert staging.used == 4
+
+
+def test_file_staged_twice_is_counted_once(tmp_path):
+    root = str(tmp_path / "dataset")
+    path = write_scan(root, "00", 0, [1, 2, 3])
+    staging = Staging(root, str(tmp_path / "staging"), budget=2 ** 20)
+    data = np.fromfile(path, dtype=np.uint8)
+
+    # the prefetch thread and a worker both read it before either staged it
+    staging.stage(staging.local(path), data, os.stat(path))
+    staging.stage(staging.local(path), data, os.stat(path))
+    assert staging.used == 3
+    assert staging.usage() == 3
+
+
+def test_evict_removes_files_not_folders(tmp_path):
+    root = str(tmp_path / "dataset")
+    old = [write_scan(root, "00", frame, [frame] * 10) for frame in range(3)]
+    new = write_scan(root, "01", 0, [9] * 10)
+    staging = Staging(root, str(tmp_path / "staging"), budget=2 ** 20)
+    for path in old + [new]:
+        staging.fromfile(path, np.uint8)
+    os.utime(staging.sequence(staging.local(old[0])), (0, 0))
+
+    staging.budget = 25
+    staging.evict(keep=staging.sequence(staging.local(new)), room=0)
+
+    # just the files needed to fit, the folder of the sequence stays
+    assert staging.used == 20
+    assert sum(os.path.exists(staging.local(path)) for path in old) == 1
+    assert os.path.isdir(os.path.dirname(staging.local(old[0])))
+    assert os.path.exists(staging.local(new))
@@ -0,0 +1,38 @@
+# This file is covered by the LICENSE file in the root of this project.
+import gc
+import threading
+
+from common.threadloader import ThreadLoader
+
+
+def loader_threads():
+    return [t for t in threading.enumerate() if t.name.startswith("ThreadPoolExecutor")]
+
+
+def make_loader():
+    batches = [[0, 1], [2, 3], [4]]
+    return ThreadLoader(list(range(5)), batches, workers=2, collate_fn=list)
+
+
+def test_batches_in_order():
+    with make_loader() as loader:
+        for _ in range(2):
+            assert list(loader) == [[0, 1], [2, 3], [4]]
+
+
+def test_threads_stop():
+    before = set(loader_threads())
+    with make_loader() as loader:
+        list(loader)
+        assert set(loader_threads()) - before
+    assert set(loader_threads()) == before
+
+    loader = make_loader()
+    list(loader)
+    started = set(loader_threads()) - before
+    assert started
+    del loader
+    gc.collect()
+    for thread in started:
+        thread.join(timeout=5)
+        assert not thread.is_alive()
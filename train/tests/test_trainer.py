@@ -0,0 +1,66 @@
+# This file is covered by the LICENSE file in the root of this project.
+import types
+
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("cv2")
+pytest.importorskip("tensorflow")  # common.logger
+
+from tasks.semantic.modules.trainer import Trainer
+
+
+def make_trainer(train_cfg):
+    trainer = Trainer.__new__(Trainer)
+    trainer.ARCH = {"train": dict(train_cfg, max_epochs=10)}
+    return trainer
+
+
+def flip(data, project_mask, proj_labels, classes=(5, 8, 12), max_batch=None):
+    return data, project_mask, proj_labels
+
+
+def test_rare_flip_without_qat():
+    trainer = make_trainer({"rare_flip": {"use": True}, "qat": {"use": False}})
+    trainer.set_train_modes(types.SimpleNamespace(flip_rare_classes=flip))
+    assert trainer.rare_flip == {"use": True}
+    assert trainer.flip_rare_classes is flip
+    assert trainer.qat is None
+
+
+def test_qat_without_rare_flip():
+    trainer = make_trainer({"qat": {"use": True, "epochs": 3}})
+    trainer.set_train_modes(types.SimpleNamespace(flip_rare_classes=flip))
+    assert trainer.rare_flip is None
+    assert trainer.qat_start == 7
+
+
+def test_qat_checkpoint_loads_in_float_salsanext(tmp_path):
+    import torch
+    import torch.nn as nn
+    from tasks.semantic.modules.SalsaNext import SalsaNext
+    from tasks.semantic.modules.backends import load_checkpoint
+
+    trainer = make_trainer({"qat": {"use": True}})
+    trainer.ARCH["dataset"] = {"sensor": {"img_prop": {"height": 32, "width": 64}}}
+    trainer.set_train_modes(types.SimpleNamespace(flip_rare_classes=flip))
+    trainer.device = torch.device("cpu")
+    trainer.model = nn.DataParallel(SalsaNext(20))
+    trainer.start_qat()
+
+    # a step of QAT, so the weights differ from the ones prepared
+    optimizer = torch.optim.SGD(trainer.model.parameters(), lr=0.1)
+    trainer.model(torch.randn(2, 5, 32, 64)).sum().backward()
+    optimizer.step()
+
+    state_dict = trainer.model_state_dict()
+    model = nn.DataParallel(SalsaNext(20))
+    model.load_state_dict(state_dict, strict=True)
+    qat_state = trainer.model.state_dict()
+    for name, value in model.state_dict().items():
+        if name in qat_state:
+            assert torch.equal(value, qat_state[name])
+
+    filename = str(tmp_path / "SalsaNext_valid_best")
+    torch.save({"state_dict": state_dict}, filename)
+    load_checkpoint(SalsaNext(20), filename)